@@ -51,7 +51,7 @@ riskApp.config(['$routeProvider', function($routeProvider) {
          resolve    : {
             data: function(UserFactory, $q) {
                var dfd = $q.defer();
-               UserFactory.get({'cash':true, 'share':true, 'pending':true, 'holdings':true, 'codes':true, 'history':true, 'birthday':true}, function(result) {
+               UserFactory.get({'cash':true, 'share':true, 'pending':true, 'holdings':true, 'birthday':true}, function(result) {
                   dfd.resolve({ success: true, response : result });
                 }, function(error) {
                   dfd.resolve({ success : false, response : error });
@@ -78,7 +78,7 @@ riskApp.config(['$routeProvider', function($routeProvider) {
          resolve    : {
             data: function(UserFactory, $q) {
                var dfd = $q.defer();
-               UserFactory.get({'history': true}, function(result) {
+               UserFactory.get({'history': true, 'page_size': 50}, function(result) {
                   dfd.resolve({ success: true, response : result });
                 }, function(error) {
                   dfd.resolve({ success : false, response : error });
@@ -239,3 +239,50 @@ riskApp.factory('OrderFactory', ['$resource', function($resource) {
 riskApp.factory('AccountFactory', ['$resource', function($resource) {
    return $resource('/account');
 }]);
+
+// Factory which long-polls for quote changes and the player's fills, pushed
+// by the server as the execution cron runs
+riskApp.factory('UpdateFactory', ['$http', '$timeout', function($http, $timeout) {
+   return {
+      // Calls onUpdate with the updates to the quotes of the given stock codes
+      // (and the player's fills) as they arrive, until the returned function
+      // is called. Updates with reset set mean some were missed, so the
+      // current state should be loaded again. While the market is closed the
+      // server says how many seconds to wait before polling again (retry).
+      subscribe: function(symbols, onUpdate) {
+         var stopped = false;
+         var poll = function(since) {
+            if (stopped) {
+               return;
+            }
+            var params = {'symbols': symbols.join(',')};
+            if (since != null) {
+               params.since = since;
+            }
+            $http.get('/updates', {params: params}).then(function(response) {
+               if (stopped) {
+                  return;
+               }
+               if (since != null) {
+                  onUpdate(response.data);
+               }
+               $timeout(function() {
+                  poll(response.data.seq);
+               }, (response.data.retry || 0) * 1000);
+            }, function(response) {
+               // Subscribe again after a pause, reloading what was missed
+               $timeout(function() {
+                  if (!stopped) {
+                     onUpdate({'reset': true});
+                  }
+                  poll(null);
+               }, 5000);
+            });
+         };
+         poll(null);
+         return function() {
+            stopped = true;
+         };
+      }
+   };
+}]);
@@ -2,9 +2,24 @@
 
 var riskControllers = angular.module('riskControllers', ["chart.js"]);
 
+// Converts the columns served by /history into rows in the format of the
+// Yahoo historicaldata table (newest first), as the charts expect
+function historyQuotes(history) {
+   var quotes = [];
+   angular.forEach(history, function(series, symbol) {
+      for (var i = 0; i < series.date.length; i++) {
+         quotes.push({'Symbol': symbol, 'Date': series.date[i], 'Open': series.open[i],
+            'High': series.high[i], 'Low': series.low[i], 'Close': series.close[i],
+            'Volume': series.volume[i]});
+      }
+   });
+   quotes.sort(function(a, b) { return a.Date < b.Date ? 1 : (a.Date > b.Date ? -1 : 0); });
+   return quotes;
+}
+
 // Handles everything relating to the quote page
-riskControllers.controller('QuoteController', ['$scope', '$log', '$http', '$templateCache', '$q', 'UserFactory', 'OrderFactory', '$modal', 'user',
-   function($scope, $log, $http, $templateCache, $q, UserFactory, OrderFactory, $modal, user) {
+riskControllers.controller('QuoteController', ['$scope', '$log', '$http', '$templateCache', '$q', 'UserFactory', 'OrderFactory', 'UpdateFactory', '$modal', 'user',
+   function($scope, $log, $http, $templateCache, $q, UserFactory, OrderFactory, UpdateFactory, $modal, user) {
    $scope.loggedIn = user.success;
    $scope.pageElements = [];
 
@@ -64,8 +79,16 @@ riskControllers.controller('QuoteController', ['$scope', '$log', '$http', '$temp
             var parameter = JSON.stringify({'stock': $scope.stock.code, 'max_bid': parseFloat($scope.quote.Bid), 'min_ask': parseFloat($scope.quote.Ask), 'avg_volume': parseFloat($scope.quote.AverageDailyVolume)});
             $http.post('/depth', parameter).success(function(response) {
                $scope.depth = response;
-               $scope.depthBids = $scope.$eval($scope.depth.bids);
-               $scope.depthAsks = $scope.$eval($scope.depth.asks);
+               // Depth arrives as flat lists of [price in cents, volume, ...]
+               var toLevels = function(flat) {
+                  var levels = {};
+                  for (var i = 0; i < flat.length; i += 2) {
+                     levels[(flat[i] / 100).toFixed(2)] = [flat[i + 1]];
+                  }
+                  return levels;
+               };
+               $scope.depthBids = toLevels($scope.depth.bids);
+               $scope.depthAsks = toLevels($scope.depth.asks);
 
                //Get a list of depth bids in descending order
                $scope.depthKeys = [];
@@ -152,12 +175,8 @@ riskControllers.controller('QuoteController', ['$scope', '$log', '$http', '$temp
       $scope.getCurrentDate();
 
       // URL to get historical prices of selected stock
-      $scope.historicalURL = "https://query.yahooapis.com/v1/public/yql?q=" +
-         "select%20*%20from%20yahoo.finance.historicaldata%20where%20symbol%20%3D%20%22" +
-         $scope.stock.code + "%22%20and%20startDate%20%3D%20%22" +
-         $scope.d1 + "%22%20and%20endDate%20%3D%20%22" +
-         $scope.d2 + "%22&format=json&diagnostics=false&" +
-         "env=store%3A%2F%2Fdatatables.org%2Falltableswithkeys";
+      $scope.historicalURL = "/history?symbols=" + $scope.stock.code +
+         "&start=" + $scope.d1 + "&end=" + $scope.d2;
 
       // Initialise chart
       $scope.chartConfig = {
@@ -190,7 +209,7 @@ riskControllers.controller('QuoteController', ['$scope', '$log', '$http', '$temp
       $http({method: 'GET', url: $scope.historicalURL, cache: $templateCache})
       .then(function(response) {
          $scope.historicalStatus = response.status;
-         $scope.historicalDataQuote = response.data.query.results.quote;
+         $scope.historicalDataQuote = historyQuotes(response.data);
 
          // Create data for graphs
          $scope.chartPrices = [];
@@ -449,12 +468,7 @@ riskControllers.controller('QuoteController', ['$scope', '$log', '$http', '$temp
       $scope.processingHistory = "Processing...";
       $scope.getCurrentDate();
 
-      $scope.asxURL = "https://query.yahooapis.com/v1/public/yql?q=" +
-         "select%20*%20from%20yahoo.finance.historicaldata%20where%20symbol%20%3D%20%22" +
-         "ASX.AX%22%20and%20startDate%20%3D%20%22" +
-         $scope.d1 + "%22%20and%20endDate%20%3D%20%22" +
-         $scope.d2 + "%22&format=json&diagnostics=false&" +
-         "env=store%3A%2F%2Fdatatables.org%2Falltableswithkeys";
+      $scope.asxURL = "/history?symbols=ASX.AX&start=" + $scope.d1 + "&end=" + $scope.d2;
 
       // grab ASX historical data over same timeframe for ASX overlay
       $http({method: 'GET', url: $scope.asxURL, cache: $templateCache})
@@ -463,7 +477,7 @@ riskControllers.controller('QuoteController', ['$scope', '$log', '$http', '$temp
          if ($scope.asxStatus != 200) {
             $scope.processingHistory = "Something went wrong with the Yahoo api query";
          }
-         $scope.asxDataQuote = response.data.query.results.quote;
+         $scope.asxDataQuote = historyQuotes(response.data);
 
          $scope.asxPrices = [];
          // Maybe += 5
@@ -528,8 +542,32 @@ riskControllers.controller('QuoteController', ['$scope', '$log', '$http', '$temp
       $scope.fetchNews();
       $scope.fetchHistoricalPrices();
       $scope.fetchDividends();
+      $scope.subscribe();
+   };
+
+   // Keeps the quote of the selected stock up to date with the prices pushed
+   // after each run of the execution cron
+   $scope.subscribe = function() {
+      if ($scope.unsubscribe) {
+         $scope.unsubscribe();
+      }
+      var code = $scope.stock.code;
+      $scope.unsubscribe = UpdateFactory.subscribe([code], function(updates) {
+         if (updates.reset) {
+            $scope.fetchCurrentInfo();
+         } else if (updates.quotes[code] && $scope.quote) {
+            angular.extend($scope.quote, updates.quotes[code]);
+            $scope.price = parseFloat($scope.quote.LastTradePriceOnly);
+         }
+      });
    };
 
+   $scope.$on('$destroy', function() {
+      if ($scope.unsubscribe) {
+         $scope.unsubscribe();
+      }
+   });
+
    // Modal to handle displaying company list
    $scope.openCompanyList = function (error) {
          $scope.selection = "";
@@ -748,8 +786,8 @@ riskControllers.controller('FormController', ['$scope', '$log', '$http', '$templ
 }]);
 
 //Porfolio controller
-riskControllers.controller('PortfolioController', ['$scope', '$http', '$timeout', '$q', '$templateCache', '$location', '$modal', 'UserFactory', 'OrderFactory', 'data', 'ngToast',
-      function($scope, $http, $timeout, $q, $templateCache, $location, $modal, UserFactory, OrderFactory, data, ngToast) {
+riskControllers.controller('PortfolioController', ['$scope', '$http', '$timeout', '$q', '$templateCache', '$location', '$modal', 'UserFactory', 'OrderFactory', 'UpdateFactory', 'data', 'ngToast',
+      function($scope, $http, $timeout, $q, $templateCache, $location, $modal, UserFactory, OrderFactory, UpdateFactory, data, ngToast) {
 
    $scope.refresh = function(chart) {
       var deferred = $scope.getPortfolio();
@@ -783,12 +821,10 @@ riskControllers.controller('PortfolioController', ['$scope', '$http', '$timeout'
    // Gets the information from the user to populate the portfolio
    $scope.getPortfolio = function() {
       var deferred = $q.defer();
-      UserFactory.get({'cash':true, 'share':true, 'pending':true, 'holdings':true, 'codes':true, 'history':true}, function(response){
+      UserFactory.get({'cash':true, 'share':true, 'pending':true, 'holdings':true}, function(response){
          $scope.loggedIn = true;
          $scope.user = response;
-         $scope.codes = $scope.user.codes;
          $scope.holdings = $scope.user.holdings;
-         $scope.transHistory = $scope.user.history;
          deferred.resolve();
       }, function(response) {
          $scope.status = "Failed to view portfolio!"
@@ -800,21 +836,6 @@ riskControllers.controller('PortfolioController', ['$scope', '$http', '$timeout'
 
    // Initialises the variables for the portfolio chart
    $scope.initPortfolioChart = function() {
-       // Get todays date in the form (yyyy-mm-dd)
-      var today = new Date();
-      var dd = today.getDate();
-      var mm = today.getMonth()+1; //January is 0
-      var yyyy = today.getFullYear();
-      if(dd<10) dd='0'+dd;
-      if(mm<10) mm='0'+mm;
-      $scope.tday = yyyy + "-" + mm + "-" + dd;
-
-      // Initialise the users first share to be today
-      $scope.firstTradeDate = $scope.tday;
-
-      // The dates the shares are held
-      $scope.shareDates = {};
-
       // Initialise the chart
       $scope.chartConfig = {
          options: {
@@ -908,67 +929,6 @@ riskControllers.controller('PortfolioController', ['$scope', '$http', '$timeout'
       $scope.processing = "";
    }
 
-   // Gets the number of a particular stock owned at a particular date
-   // by following all the transactions up to that date
-   $scope.getNumSharesOwned = function(code, date) {
-      var quantity = 0;
-      angular.forEach($scope.transHistory, function(transaction) {
-         var time = transaction.timestamp;
-
-         if (new Date(time.substring(0,10)).getTime() > new Date(date).getTime()) {
-            // We don't want to pay attention to transactions after our date
-         } else {
-            if (transaction.type == 'buy' && transaction.stock == code) {
-               quantity += transaction.quantity;
-            } else if (transaction.type == 'sell' && transaction.stock == code) {
-               quantity -= transaction.quantity;
-            }
-         }
-      });
-      return quantity;
-   }
-
-
-   // Gets the share price at a certain date
-   $scope.getSharePriceAtDate = function(code, date) {
-      var price = 1;
-      angular.forEach($scope.historicalDataQuote, function(obj) {
-         // Checks to see if the date is +- an hour (to account for daylight savings)
-         // and if so, that is the share price for the date
-         var historicalDate = new Date(obj.Date).getTime();
-         var dateUpper = new Date(date);
-         dateUpper.setHours(dateUpper.getHours() + 1);
-         var dateLower = new Date(date);
-         dateLower.setHours(dateLower.getHours() - 1);
-         if (obj.Symbol == code && historicalDate <= dateUpper.getTime() && historicalDate >= dateLower.getTime()) {
-            price = obj.Close;
-         }
-      });
-      return price;
-   }
-
-   // Gets the latest version of the user's cash (history) at a certain date
-   $scope.getCashHistory = function(code, date) {
-      var cash = -1;
-      var latestTimestamp = "";
-      angular.forEach($scope.transHistory, function(transaction) {
-         var time = transaction.timestamp;
-         // Ensures you get the most recent cash history for that date
-         // Handles daylight savings
-         var timestampDate = new Date(time.substring(0,10)).getTime()
-         var dateUpper = new Date(date);
-         dateUpper.setHours(dateUpper.getHours() + 1);
-         var dateLower = new Date(date);
-         dateLower.setHours(dateLower.getHours() - 1);
-         if (timestampDate >= dateLower && timestampDate <= dateUpper &&
-            (latestTimestamp == "" || timestampDate > new Date(latestTimestamp).getTime())) {
-            cash = transaction.cashHistory;
-            latestTimestamp = time;
-         }
-      });
-      return cash;
-   }
-
    // With the user having no transaction history or only having
    // transaction history for one day - just return the max value for their previous days
    // and their total portfolio value for the last day
@@ -997,149 +957,28 @@ riskControllers.controller('PortfolioController', ['$scope', '$http', '$timeout'
       // Initialise the variables
       $scope.initPortfolioChart();
       $scope.processing = "Processing ...";
-      var i = 0;
-      var codeString = "";
-      // Get the date of when the user bought each share and sold each share
-      // and store that information in a hash
-      angular.forEach($scope.codes, function(date, code) {
-         // Get the first trade ever for this user (i.e. the starting date to collect the data)
-         if (date < $scope.firstTradeDate) {
-            $scope.firstTradeDate = date;
-         }
-
-         // Dates are in the format:
-         // yyyy-mm-dd~yyyy-mm-dd (i.e. startDate~endDate)
-         // or yyyy-mm-dd if not sold.
-         var start;
-         var end;
-         if (date.length > 10) {
-            start = date.substring(0,10);
-            end = date.substring(11,20);
-         } else {
-            start = new Date(date);
-            end = new Date($scope.tday);
-            end.setDate(end.getDate() - 1);
-         }
-         $scope.shareDates[code] = [start, end];
 
-         // Prepare the code format for the URL by combining
-         // all the stock codes together in one string
-         if (i == 0) {
-            codeString = codeString + "%22" + code;
+      // The daily value of the portfolio is built by the server in one response
+      $http({method: 'GET', url: '/portfolio'}).then(function(response) {
+         var series = response.data;
+         if (series.date && series.date.length > 1) {
+            var chartPrices = [];
+            for (var i = 0; i < series.date.length; i++) {
+               var yyyy = series.date[i].substring(0,4);
+               var mm   = series.date[i].substring(5,7)-1;
+               var dd   = series.date[i].substring(8,10);
+               chartPrices.push([Date.UTC(yyyy, mm, dd), series.total[i]]);
+            }
+            $scope.drawPortfolioChart(chartPrices);
          } else {
-            codeString = codeString + "%22%2C%20%22" + code;
+            // With the user having no transaction history or only having
+            // transaction history for one day - just return their total
+            // portfolio value for each day
+            $scope.drawPortfolioChart($scope.getPortfolioValue());
          }
-         i += 1;
-
+      }, function(response) {
+         $scope.drawPortfolioChart($scope.getPortfolioValue());
       });
-
-      var yesterday = new Date();
-      yesterday.setDate(yesterday.getDate() - 1);
-
-      // Get the data if the portfolio has been up for at least a day and has at least one stock
-      if (codeString != "" && (new Date($scope.birthday)).getTime() < yesterday.getTime() && $scope.user)  {
-         codeString = codeString + "%22";
-
-
-         // Construct the URL getting all the shares historical prices between the start date and today
-         var url = "https://query.yahooapis.com/v1/public/yql?q=select%20Symbol%2C%20Date%2C%20Close" +
-                   "%20from%20yahoo.finance.historicaldata%20where%20symbol%20IN%20(" + codeString +
-                   ")%20and%20startDate%20%3D%20%22" + $scope.firstTradeDate +
-                  "%22%20and%20endDate%20%3D%20%22" + $scope.tday +
-                  "%22&format=json&diagnostics=true&env=store%3A%2F%2Fdatatables.org%2Falltableswithkeys&callback=";
-
-         $http({method: 'GET', url: url, cache: $templateCache}).then(function(response) {
-            if (response.data && response.data.query && response.data.query.results && response.data.query.results.quote) {
-               $scope.historicalStatus = response.status;
-               $scope.historicalDataQuote = response.data.query.results.quote;
-
-               // Get the total value in shares for each day
-               $scope.dayShareValue = {};
-               $scope.cashValue = {};
-
-               // We want the total value of stocks for each day
-               // Therefore for each share we need the amount of shares owned at that date * price at that date
-               angular.forEach($scope.shareDates, function (dates, code) {
-                  // Initially curDate is the start date
-                  var curDate = new Date(dates[0]);
-
-                  // While curDate is less than or equal to the endDate
-                  // increment the total price for that date
-                  var fridayPrice = 0;
-                  while (curDate < new Date(dates[1]).getTime()) {
-                     if (!$scope.dayShareValue[curDate.getTime()]) {
-                        $scope.dayShareValue[curDate.getTime()] = 0;
-                     }
-                     var quantity = $scope.getNumSharesOwned(code, curDate);
-                     var price = 0;
-                     if (curDate.getDay() % 6 != 0) {
-                        price = $scope.getSharePriceAtDate(code, curDate);
-                        if (curDate.getDay() == 5) {
-                           fridayPrice = price;
-                        }
-                     } else if (curDate.getDay() == 6) { //Saturday
-                        price = fridayPrice;
-                     } else { //Sunday
-                        price = fridayPrice;
-                     }
-
-                     // Add the share value worth to the dict
-                     $scope.dayShareValue[curDate.getTime()] += quantity * price;
-                     // Add the cash held to the cash dict.
-                     var cash = $scope.getCashHistory(code, curDate);
-                     if (cash > -1) {
-                        $scope.cashValue[curDate.getTime()] = cash;
-                     } else {
-                        // If there are no transactions for that date
-                        // cash held is yesterdays cash
-                        var tempDate = new Date(curDate)
-                        tempDate.setDate(curDate.getDate() - 1);
-                        $scope.cashValue[curDate.getTime()] = $scope.cashValue[tempDate.getTime()];
-
-                     }
-                     curDate.setDate(curDate.getDate() + 1);
-                  }
-               });
-
-               // Sort the dates in ascending order
-               var keys = [];
-
-               for(var key in $scope.dayShareValue) {
-                  if($scope.dayShareValue.hasOwnProperty(key)) {
-                     keys.push(key);
-                     $scope.dayShareValue[key] += $scope.cashValue[key];
-                  }
-               }
-               keys.sort(function(a, b){return a-b});
-
-               // Set up the chart prices in the correct format
-               // for high charts
-               var chartPrices = [];
-               for (var i = 0; i < keys.length; i++) {
-                  var date = keys[i];
-                  var price = $scope.dayShareValue[date];
-                  var currentList = chartPrices;
-                  var newList = currentList.concat([[parseInt(date), parseFloat(price.toFixed(2))]]);
-                  chartPrices = newList;
-               }
-
-               // Draw the chart
-               $scope.drawPortfolioChart(chartPrices);
-            } else {
-               // With the user having no transaction history or only having
-               // transaction history for one day - just return their total
-               // portfolio value for each day
-               var chartPrices = $scope.getPortfolioValue();
-               $scope.drawPortfolioChart(chartPrices);
-            }
-         });
-      } else {
-         // With the user having no transaction history or only having
-         // transaction history for one day - just return their total
-         // portfolio value for each day
-         var chartPrices = $scope.getPortfolioValue();
-         $scope.drawPortfolioChart(chartPrices);
-      }
    }
 
 
@@ -1211,11 +1050,20 @@ riskControllers.controller('PortfolioController', ['$scope', '$http', '$timeout'
    if (data.success) {
       $scope.loggedIn = true;
       $scope.user = data.response;
-      $scope.codes = $scope.user.codes;
       $scope.holdings = $scope.user.holdings;
-      $scope.transHistory = $scope.user.history;
       $scope.birthday = $scope.user.birthday;
       $scope.getPortfolioChart();
+
+      // Reload the portfolio only when the server pushes a fill of one of
+      // the player's orders, instead of polling for their status
+      var unsubscribe = UpdateFactory.subscribe([], function(updates) {
+         if (updates.reset || updates.fills.length) {
+            $scope.getPortfolio().then(function() {
+               $scope.getPortfolioChart();
+            });
+         }
+      });
+      $scope.$on('$destroy', unsubscribe);
    } else {
       $scope.loggedIn = false;
    }
@@ -1403,32 +1251,25 @@ riskControllers.controller('OrderController', ['$scope', '$log', '$modalInstance
       var validated = $scope.validate();
       validated.then(function(resolve) {
 
-         // Process the order for the corresponding user account
-         UserFactory.get({'email':true}, function(response){
-            $scope.order.email = response.email;
+         // Hack to keep price on order_confirmation the same (TODO fix)
+         $scope.tempPrice = $scope.order.price;
 
-            // Hack to keep price on order_confirmation the same (TODO fix)
-            $scope.tempPrice = $scope.order.price;
-
-            // Don't execute order immediately. Every 5 minutes orders will be executed by cron
-            $scope.order.executed = false;
-
-            // Send the order and give a message if successful
-            OrderFactory.save({'order':angular.toJson($scope.order)}, function(response) {
-               $scope.status = resolve;
-               $modalInstance.close($scope.status);
-            }, function(){
-               $scope.status = "Order Failed! Please try again";
-               $modalInstance.close($scope.status);
-            });
-
-            // Hack to keep price on order_confirmation the same (TODO fix)
-            $scope.order.price = $scope.tempPrice;
+         // Don't execute order immediately. Every 5 minutes orders will be executed by cron
+         $scope.order.executed = false;
 
+         // Send the order (for the logged in player) and give a message if successful
+         OrderFactory.save({'orders': [angular.fromJson(angular.toJson($scope.order))]}, function(response) {
+            $scope.status = resolve;
+            $modalInstance.close($scope.status);
          }, function(response) {
-            $scope.status = "Order Failed! Please try again";
-            $modalStack.dismissAll($scope.status);
+            var results = response.data && response.data.results;
+            $scope.status = (results && results[0].error ? "Order Failed! " + results[0].error :
+               "Order Failed! Please try again");
+            $modalInstance.close($scope.status);
          });
+
+         // Hack to keep price on order_confirmation the same (TODO fix)
+         $scope.order.price = $scope.tempPrice;
       }, function(reject){
          $scope.status = reject;
          ngToast.create({
@@ -1446,7 +1287,9 @@ riskControllers.controller('OrderController', ['$scope', '$log', '$modalInstance
 riskControllers.controller('HistoryController', ['$scope', 'data', 'UserFactory', 'ngToast', function($scope, data, UserFactory, ngToast) {
    if (data.success) {
       $scope.loggedIn = true;
+      // The history is served a page at a time, oldest first
       $scope.transactions = data.response.history;
+      $scope.cursor = data.response.history_cursor;
    } else {
       $scope.loggedIn = false;
    }
@@ -1462,9 +1305,18 @@ riskControllers.controller('HistoryController', ['$scope', 'data', 'UserFactory'
       }
    }
 
+   // Appends the next page of the history
+   $scope.loadMore = function() {
+      UserFactory.get({'history': true, 'page_size': 50, 'cursor': $scope.cursor}, function(response) {
+         $scope.transactions = $scope.transactions.concat(response.history);
+         $scope.cursor = response.history_cursor;
+      });
+   }
+
    $scope.refresh = function() {
-      UserFactory.get({'history': true}, function(response) {
+      UserFactory.get({'history': true, 'page_size': 50}, function(response) {
          $scope.transactions = response.history;
+         $scope.cursor = response.history_cursor;
          ngToast.create({
             content: "Page refreshed!",
             className: "info",
@@ -1492,16 +1344,15 @@ riskControllers.controller('LeaderboardController', ['$scope', 'userData', 'ngTo
       UserFactory.get({'leaderboard': true}, function(response) {
          $scope.players = response.leaderboard;
          $scope.list = [];
-         // Put all the information in the list and then sort it based on total value (index 6)
+         // Put all the information in the list, the rank (index 7) comes from the server
          for (var email in $scope.players) {
-            $scope.list.push([ email, $scope.players[email][0], $scope.players[email][1], $scope.players[email][2], $scope.players[email][3], $scope.players[email][4], $scope.players[email][5]]);
+            $scope.list.push([ email, $scope.players[email][0], $scope.players[email][1], $scope.players[email][2], $scope.players[email][3], $scope.players[email][4], $scope.players[email][5], $scope.players[email][6]]);
          };
-         $scope.list.sort(function(a, b) {return b[6] - a[6]});
-         // Add ranks to the sorted list
-         var i = 0;
-         angular.forEach($scope.list,function(elm,index){
-            elm.push(index + 1); // Their rank is their index + 1 (since indices start at 0)
-         });
+         $scope.list.sort(function(a, b) {return a[7] - b[7]});
+         // Show the player's own rank at the bottom if it is not on this page
+         if (response.leaderboard_rank && !(userData.response.email in $scope.players)) {
+            $scope.list.push([userData.response.email].concat(response.leaderboard_rank));
+         }
       }, function(response) {
 
       });
@@ -0,0 +1,57 @@
+"""Benchmarks
+
+   This package measures the hot paths of the application (order execution,
+   holdings and the leaderboard) against a synthetic market held in the App
+   Engine SDK's local datastore, memcache and task queue stubs.
+
+   Run from the application directory with:
+
+   $ python -m bench.run --sdk <path-to-Python-SDK>/platform/google_appengine
+
+   bench.load drives the whole WSGI app with a mix of requests from simulated
+   players instead, reporting the latency and throughput of each route:
+
+   $ python -m bench.load --sdk <path-to-Python-SDK>/platform/google_appengine
+"""
+
+import os
+import sys
+
+# The application directory (the parent of this package)
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def setup(sdk=None):
+   """Puts the SDK on the path and activates local service stubs.
+
+   Must be called before any application module is imported.
+
+   Args:
+      sdk: The path of the google_appengine SDK directory, if it is not
+         already importable.
+
+   Returns:
+      The active Testbed, to be deactivated when done.
+   """
+   if sdk:
+      sys.path.insert(0, sdk)
+   import dev_appserver
+   dev_appserver.fix_sys_path()
+   os.chdir(APP_DIR)
+   if APP_DIR not in sys.path:
+      sys.path.insert(0, APP_DIR)
+
+   from google.appengine.datastore import datastore_stub_util
+   from google.appengine.ext import testbed
+
+   bed = testbed.Testbed()
+   bed.activate()
+   bed.setup_env(app_id='risk-bench', overwrite=True)
+   # Queries see every write immediately, as they would once the datastore
+   # has caught up between cron ticks
+   policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+   bed.init_datastore_v3_stub(consistency_policy=policy, require_indexes=False)
+   bed.init_memcache_stub()
+   bed.init_taskqueue_stub(root_path=APP_DIR)
+   bed.init_urlfetch_stub()
+   bed.init_app_identity_stub()
+   return bed
@@ -0,0 +1,361 @@
+"""Load Test
+
+   Drives the application's WSGI app in process with a realistic mix of
+   requests from simulated players: signups and logins, order placements and
+   cancellations, /user polls with various parameters and /depth posts, while
+   a cron thread runs an execution tick (and the tasks it enqueues) at a fixed
+   interval. Reports the throughput and p50/p95/p99 latency of each route, so
+   that the capacity of an instance can be planned before a release.
+
+   Datastore, memcache and the task queue are the SDK's local stubs, and
+   quotes come from a synthetic market through the file quote provider.
+   Note that the execution handler does nothing on Sydney weekends, as in
+   production.
+
+   $ python -m bench.load --sdk <sdk> --players 100 --concurrency 8 --duration 60
+"""
+
+import argparse
+import Cookie
+import collections
+import datetime
+import json
+import os
+import Queue
+import random
+import tempfile
+import threading
+import time
+
+import numpy
+
+import bench
+
+# The relative frequency of each player action
+MIX = [
+   ('status', 50),
+   ('depth', 15),
+   ('order', 15),
+   ('cancel', 5),
+   ('login', 5),
+   ('history', 5),
+   ('portfolio', 5),
+]
+
+# The information /user polls ask for, as the pages of the client do
+STATUS_PARAMETERS = [
+   ['cash', 'share', 'pending', 'holdings'],
+   ['cash', 'sellable_shares'],
+   ['email'],
+   ['nickname', 'birthday'],
+   ['leaderboard'],
+]
+
+def parse_args():
+   """Parses the command line arguments."""
+   parser = argparse.ArgumentParser(description='Load test the application in process.')
+   parser.add_argument('--sdk', help='Path of the google_appengine SDK directory')
+   parser.add_argument('--players', type=int, default=50, help='Simulated players')
+   parser.add_argument('--concurrency', type=int, default=4, help='Concurrent requests')
+   parser.add_argument('--duration', type=float, default=30, help='Seconds to run for')
+   parser.add_argument('--tick', type=float, default=10,
+      help='Seconds between execution ticks (0 for none)')
+   parser.add_argument('--seed', type=int, default=0)
+   parser.add_argument('--out', help='File to save results to')
+   return parser.parse_args()
+
+class RouteStats(object):
+   """Records the latency and status of every request, by route.
+
+   Attributes:
+      latencies: A dictionary mapping routes to the latency of each request
+         in seconds.
+      statuses: A dictionary mapping routes to a Counter of status codes.
+   """
+   def __init__(self):
+      self.latencies = collections.defaultdict(list)
+      self.statuses = collections.defaultdict(collections.Counter)
+      self.lock = threading.Lock()
+
+   def add(self, route, status, seconds):
+      """Records one request."""
+      with self.lock:
+         self.latencies[route].append(seconds)
+         self.statuses[route][status] += 1
+
+   def report(self, elapsed):
+      """Summarises the requests of each route.
+
+      Args:
+         elapsed: The seconds the test ran for.
+
+      Returns:
+         A dictionary mapping routes to their request count, requests per
+         second, p50/p95/p99/max latency in milliseconds and count of each
+         status.
+      """
+      report = {}
+      for route, latencies in self.latencies.iteritems():
+         latencies = numpy.array(latencies) * 1000
+         report[route] = {
+            'requests': len(latencies),
+            'per_second': len(latencies) / elapsed,
+            'p50_ms': float(numpy.percentile(latencies, 50)),
+            'p95_ms': float(numpy.percentile(latencies, 95)),
+            'p99_ms': float(numpy.percentile(latencies, 99)),
+            'max_ms': float(latencies.max()),
+            'statuses': dict((str(status), count)
+               for (status, count) in self.statuses[route].iteritems()),
+         }
+      return report
+
+class Client(object):
+   """A simulated player's browser, keeping its session cookies.
+
+   Attributes:
+      app: The WSGI app.
+      stats: The RouteStats requests are recorded in.
+      email: The player's email.
+      password: The player's password.
+      cookies: A dictionary of the session cookies set by the app (as sent
+         back to it).
+      signed_up: Whether the player has signed up yet.
+   """
+   def __init__(self, app, stats, email, password):
+      self.app = app
+      self.stats = stats
+      self.email = email
+      self.password = password
+      self.cookies = {}
+      self.signed_up = False
+
+   def request(self, route, path, method='GET', body=None, headers=None):
+      """Sends a request to the app.
+
+      Args:
+         route: The name the request is recorded under.
+         path: The path and query string.
+         method: The HTTP method.
+         body: The request body, if any.
+         headers: Extra request headers.
+
+      Returns:
+         The webob Response.
+      """
+      # Imported once the SDK is on the path
+      import webapp2
+      request = webapp2.Request.blank(path, method=method, headers=headers or {})
+      if body is not None:
+         request.body = body
+      if self.cookies:
+         request.headers['Cookie'] = '; '.join('%s=%s' % item for item in self.cookies.iteritems())
+      start = time.time()
+      response = request.get_response(self.app)
+      self.stats.add(route, response.status_int, time.time() - start)
+      for header in response.headers.getall('Set-Cookie'):
+         cookie = Cookie.SimpleCookie()
+         cookie.load(header)
+         for name, morsel in cookie.iteritems():
+            self.cookies[name] = morsel.coded_value
+      return response
+
+   def account(self, action):
+      """Signs up or logs in (action is 'signup' or 'login')."""
+      details = {'email': self.email, 'password': self.password,
+         'password_again': self.password, 'name': self.email.split('@')[0]}
+      return self.request(action, '/account', 'POST',
+         json.dumps({'request': json.dumps(details), action: True}))
+
+   def status(self, parameters):
+      """Polls /user for some information."""
+      return self.request('status', '/user?' + '&'.join('%s=1' % name for name in parameters))
+
+class LoadTest(object):
+   """Runs the simulated players and the cron against the app.
+
+   Each simulated player is used by one thread at a time, and signs up the
+   first time it is picked.
+
+   Attributes:
+      app: The WSGI app.
+      market: The SyntheticMarket quotes are drawn from.
+      provider: The FileQuoteProvider the app reads quotes from.
+      taskqueue: The task queue stub, drained after each tick.
+      stats: The RouteStats of every request.
+      clients: The simulated players.
+      random: The random number generator.
+   """
+   # The task queues drained after each tick (see queue.yaml)
+   QUEUES = ['default', 'execution']
+
+   def __init__(self, app, market, provider, taskqueue, players, seed):
+      self.app = app
+      self.market = market
+      self.provider = provider
+      self.taskqueue = taskqueue
+      self.stats = RouteStats()
+      self.random = random.Random(seed)
+      self.clients = [Client(app, self.stats, 'load%d@bench' % i, 'password%d' % i)
+         for i in range(players)]
+      self.lock = threading.Lock()
+
+   def choose(self, options):
+      """Picks from a list of (option, weight) tuples (thread safe)."""
+      with self.lock:
+         pick = self.random.uniform(0, sum(weight for (option, weight) in options))
+         for option, weight in options:
+            pick -= weight
+            if pick <= 0:
+               return option
+         return options[-1][0]
+
+   def order(self):
+      """Makes a random order near the current price of a random stock."""
+      with self.lock:
+         symbol = self.random.choice(self.market.symbols)
+         price = self.market.prices[symbol]
+         subtype = self.random.choice(['market', 'limit', 'stop'])
+         if subtype != 'market':
+            price = price * (1 + self.random.gauss(0, 0.02))
+         return {'type': self.random.choice(['buy', 'buy', 'sell']), 'subtype': subtype,
+            'stock': symbol, 'price': max(round(price, 2), 0.01),
+            'quantity': self.random.randint(1, 100), 'fee': 20.0}
+
+   def act(self, client):
+      """Performs one random action as a player."""
+      if not client.signed_up:
+         client.account('signup')
+         client.signed_up = True
+         return
+      action = self.choose(MIX)
+      if action == 'status':
+         client.status(self.choose([(p, 1) for p in STATUS_PARAMETERS]))
+      elif action == 'depth':
+         with self.lock:
+            symbol = self.random.choice(self.market.symbols)
+         price = self.market.prices[symbol]
+         client.request('depth', '/depth', 'POST', json.dumps({'stock': symbol,
+            'max_bid': price, 'min_ask': round(price * 1.001 + 0.01, 2),
+            'avg_volume': float(self.market.volumes[symbol])}))
+      elif action == 'order':
+         orders = [self.order() for i in range(self.choose([(1, 8), (2, 1), (5, 1)]))]
+         client.request('order', '/order', 'POST', json.dumps({'orders': orders}))
+      elif action == 'cancel':
+         response = client.status(['pending'])
+         pending = json.loads(response.body).get('pending', {}) if response.status_int == 200 else {}
+         if pending:
+            with self.lock:
+               key = self.random.choice(pending.values())['key']
+            client.request('cancel', '/order?key=' + key, 'DELETE')
+      elif action == 'login':
+         client.account('login')
+      elif action == 'history':
+         client.request('history', '/user?history=1&page_size=50')
+      elif action == 'portfolio':
+         client.request('portfolio', '/portfolio')
+
+   def tick(self, client):
+      """Runs one execution tick as the cron would: new quotes, the cron
+         request and then every task it enqueues, until the queues are empty.
+      """
+      self.provider.save(self.market.tick())
+      client.request('tick', '/order?execution=true', headers={'X-AppEngine-Cron': 'true'})
+      while True:
+         ran = 0
+         for queue_name in self.QUEUES:
+            for task in self.taskqueue.get_filtered_tasks(queue_names=[queue_name]):
+               self.taskqueue.DeleteTask(queue_name, task.name)
+               headers = dict(task.headers)
+               headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+               headers['X-AppEngine-QueueName'] = queue_name
+               client.request('task ' + task.url, task.url, task.method, task.payload, headers)
+               ran += 1
+         if not ran:
+            break
+
+   def run(self, concurrency, duration, tick):
+      """Runs the players (and the cron) for a duration.
+
+      Returns:
+         The seconds the test ran for.
+      """
+      admin = Client(self.app, self.stats, 'cron@bench', '')
+      idle = Queue.Queue()
+      with self.lock:
+         self.random.shuffle(self.clients)
+      for client in self.clients:
+         idle.put(client)
+
+      started = time.time()
+      deadline = started + duration
+      def player():
+         while time.time() < deadline:
+            try:
+               client = idle.get(timeout=1)
+            except Queue.Empty:
+               # More threads than players
+               continue
+            try:
+               self.act(client)
+            finally:
+               idle.put(client)
+      def cron():
+         while time.time() + tick < deadline:
+            time.sleep(tick)
+            self.tick(admin)
+
+      threads = [threading.Thread(target=player) for i in range(concurrency)]
+      if tick > 0:
+         threads.append(threading.Thread(target=cron))
+      for thread in threads:
+         thread.start()
+      for thread in threads:
+         thread.join()
+      return time.time() - started
+
+def main():
+   args = parse_args()
+   bed = bench.setup(args.sdk)
+
+   from google.appengine.ext import testbed
+   from py.quotes import FileQuoteProvider, set_provider
+   from bench.market import SyntheticMarket
+   from bench.run import git_commit
+
+   # Quotes are replayed through the file provider, as the cron would run offline
+   quote_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+   quote_file.close()
+   provider = FileQuoteProvider(quote_file.name)
+   set_provider(provider)
+   market = SyntheticMarket(args.seed)
+   provider.save(market.tick())
+
+   import user_system
+   test = LoadTest(user_system.app, market, provider,
+      bed.get_stub(testbed.TASKQUEUE_SERVICE_NAME), args.players, args.seed)
+   elapsed = test.run(args.concurrency, args.duration, args.tick)
+   routes = test.stats.report(elapsed)
+
+   results = {
+      'commit': git_commit(),
+      'time': datetime.datetime.utcnow().isoformat(),
+      'parameters': {'players': args.players, 'concurrency': args.concurrency,
+         'duration': args.duration, 'tick': args.tick, 'seed': args.seed},
+      'seconds': elapsed,
+      'per_second': sum(route['requests'] for route in routes.values()) / elapsed,
+      'routes': routes,
+   }
+   print('%-24s %8s %8s %9s %9s %9s' % ('route', 'requests', 'per sec', 'p50 ms', 'p95 ms', 'p99 ms'))
+   for name, route in sorted(routes.iteritems()):
+      print('%-24s %8d %8.1f %9.1f %9.1f %9.1f' % (name, route['requests'], route['per_second'],
+         route['p50_ms'], route['p95_ms'], route['p99_ms']))
+   print('Total %.1f requests per second' % results['per_second'])
+   if args.out:
+      with open(args.out, 'w') as out_file:
+         json.dump(results, out_file, indent=2, sort_keys=True)
+
+   os.remove(quote_file.name)
+   bed.deactivate()
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,124 @@
+"""Synthetic Market
+
+   This module generates a synthetic market for benchmarking: prices for the
+   ASX200 stocks that move in random ticks, and players with executed and
+   pending orders around those prices.
+"""
+
+import random
+
+from google.appengine.ext import ndb
+from py.transaction import *
+from py.player import *
+from py.position import *
+from py.quotes import *
+
+class SyntheticMarket(object):
+   """A random walk of quotes for every stock in the market.
+
+   Attributes:
+      symbols: The list of stock codes.
+      prices: A dictionary mapping stock codes to their last price.
+      volumes: A dictionary mapping stock codes to their average volume.
+      random: The random number generator (seeded for repeatable runs).
+   """
+   # Standard deviation of each tick's relative price move
+   VOLATILITY = 0.002
+
+   def __init__(self, seed=0):
+      self.random = random.Random(seed)
+      self.symbols = list(get_symbols())
+      self.prices = dict((symbol, round(self.random.lognormvariate(2, 1), 2))
+         for symbol in self.symbols)
+      self.volumes = dict((symbol, int(self.random.lognormvariate(13, 1.5)))
+         for symbol in self.symbols)
+
+   def tick(self):
+      """Moves every price and gets the new quotes.
+
+      Returns:
+         A dictionary mapping stock codes to their Bid, Ask,
+         LastTradePriceOnly and AverageDailyVolume, in the format of a
+         QuoteProvider.
+      """
+      quotes = {}
+      for symbol in self.symbols:
+         price = self.prices[symbol] * (1 + self.random.gauss(0, self.VOLATILITY))
+         price = max(round(price, 2), 0.01)
+         self.prices[symbol] = price
+         spread = max(round(price * 0.001, 2), 0.01)
+         quotes[symbol] = {
+            'Bid': '%.2f' % price,
+            'Ask': '%.2f' % (price + spread),
+            'LastTradePriceOnly': '%.2f' % price,
+            'AverageDailyVolume': str(self.volumes[symbol]),
+         }
+      return quotes
+
+   def order(self, owner, executed):
+      """Generates a random order near the current price of a random stock.
+
+      Limit and stop prices are spread a few percent either side of the price
+      so that a realistic share of pending orders triggers on each tick.
+
+      Args:
+         owner: The key of the Player placing the order.
+         executed: Whether the order has been executed.
+
+      Returns:
+         An unstored Transaction.
+      """
+      symbol = self.random.choice(self.symbols)
+      subtype = self.random.choice(['market', 'limit', 'limit', 'stop'])
+      price = self.prices[symbol]
+      if (subtype != 'market' and not executed):
+         price = price * (1 + self.random.gauss(0, 0.02))
+      return Transaction(type=self.random.choice(['buy', 'sell']), subtype=subtype,
+         stock=symbol, price=max(round(price, 2), 0.01),
+         quantity=self.random.randint(1, 1000), executed=executed, fee=10.0,
+         cashHistory=0.0, owner=owner)
+
+   def seed(self, players, pending, history, batch=500):
+      """Stores players with their executed and pending transactions and
+         their positions.
+
+      Executed sells are only generated against stock already bought, so
+      every player's history is consistent.
+
+      Args:
+         players: The number of players.
+         pending: The total number of pending orders.
+         history: The total number of executed orders.
+         batch: The number of entities written per put_multi.
+
+      Returns:
+         The list of Player keys.
+      """
+      accounts = [Player(email='player%d@bench' % i, cash=50000.0,
+         nickname='Player %d' % i, ledger=True) for i in range(players)]
+      keys = ndb.put_multi(accounts)
+
+      orders = [self.order(self.random.choice(keys), True) for i in range(history)]
+      held = {}
+      for order in orders:
+         holding = (order.owner, order.stock)
+         if order.type == 'sell':
+            if held.get(holding, 0) < order.quantity:
+               order.type = 'buy'
+            else:
+               held[holding] -= order.quantity
+         if order.type == 'buy':
+            held[holding] = held.get(holding, 0) + order.quantity
+      orders.extend(self.order(self.random.choice(keys), False) for i in range(pending))
+      for i in range(0, len(orders), batch):
+         ndb.put_multi(orders[i:i + batch])
+
+      by_owner = dict((key, []) for key in keys)
+      for order in orders:
+         by_owner[order.owner].append(order)
+      positions = []
+      for player in accounts:
+         positions.extend(Position.replay(player.key, by_owner[player.key]).values())
+      for i in range(0, len(positions), batch):
+         ndb.put_multi(positions[i:i + batch])
+      return keys
@@ -0,0 +1,137 @@
+"""Benchmark Runner
+
+   Seeds a synthetic market and reports the latency, throughput and RPC
+   counts of order execution, depth refresh, holdings lookups and the
+   leaderboard, saving the results as JSON so that they can be compared
+   between commits.
+
+   $ python -m bench.run --sdk <sdk> --players 500 --pending 5000 --history 20000
+   $ python -m bench.run --sdk <sdk> --compare bench_output.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import tempfile
+
+import bench
+
+def parse_args():
+   """Parses the command line arguments."""
+   parser = argparse.ArgumentParser(description='Benchmark the order execution hot paths.')
+   parser.add_argument('--sdk', help='Path of the google_appengine SDK directory')
+   parser.add_argument('--players', type=int, default=200)
+   parser.add_argument('--pending', type=int, default=2000)
+   parser.add_argument('--history', type=int, default=10000)
+   parser.add_argument('--ticks', type=int, default=20, help='Quote ticks to execute')
+   parser.add_argument('--samples', type=int, default=50, help='Calls to the read paths')
+   parser.add_argument('--seed', type=int, default=0)
+   parser.add_argument('--out', default='bench_output.json', help='File to save results to')
+   parser.add_argument('--compare', help='Results file from an earlier run to compare with')
+   return parser.parse_args()
+
+def git_commit():
+   """Gets the current commit, or None outside a git checkout."""
+   try:
+      return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+         cwd=bench.APP_DIR).strip()
+   except (OSError, subprocess.CalledProcessError):
+      return None
+
+def compare(results, path):
+   """Prints the change in each latency and throughput against earlier results.
+
+   Args:
+      results: The results of this run.
+      path: The path of an earlier results file.
+   """
+   with open(path) as previous_file:
+      previous = json.load(previous_file)
+   print('Compared with %s (%s):' % (path, previous.get('commit')))
+   for name, report in sorted(results['entry_points'].iteritems()):
+      old = previous['entry_points'].get(name, {})
+      for metric in sorted(report.keys()):
+         if (metric.endswith('_ms') or metric.endswith('_per_second')) and old.get(metric):
+            change = (report[metric] - old[metric]) / old[metric] * 100
+            print('  %-12s %-22s %10.2f -> %10.2f (%+.1f%%)' % (name, metric,
+               old[metric], report[metric], change))
+
+def main():
+   args = parse_args()
+   bed = bench.setup(args.sdk)
+
+   from google.appengine.ext import ndb
+   from py.book import MARKET
+   from py.depth import Depth
+   from py.execution import execute_stocks
+   from py.leaderboard import LeaderboardSnapshot
+   from py.quotes import FileQuoteProvider, QUOTES, set_provider
+   from bench.market import SyntheticMarket
+   from bench.stats import Recorder, RpcCounter
+
+   # Quotes are replayed through the file provider, as the cron would run offline
+   quote_file = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+   quote_file.close()
+   provider = FileQuoteProvider(quote_file.name)
+   set_provider(provider)
+
+   market = SyntheticMarket(args.seed)
+   provider.save(market.tick())
+   keys = market.seed(args.players, args.pending, args.history)
+
+   counter = RpcCounter()
+   counter.install()
+   recorders = dict((name, Recorder(name, counter))
+      for name in ['execute', 'evaluate', 'depth_refresh', 'get_shares', 'leaderboard',
+         'leaderboard_page'])
+
+   for i in range(args.ticks):
+      provider.save(market.tick())
+      share_dict = provider.get_quotes(market.symbols)
+      QUOTES.set(share_dict)
+      ndb.get_context().clear_cache()
+      count, fills = recorders['execute'].call(execute_stocks, market.symbols, share_dict)
+      recorders['execute'].add(orders=count, fills=fills)
+
+      recorders['evaluate'].call(MARKET.triggered, share_dict)
+      recorders['evaluate'].add(orders_evaluated=len(MARKET.stocks))
+
+      depths = recorders['depth_refresh'].call(Depth.refresh, share_dict)
+      recorders['depth_refresh'].add(depths=len(depths))
+
+   sample = random.Random(args.seed)
+   for i in range(args.samples):
+      ndb.get_context().clear_cache()
+      player = sample.choice(keys).get()
+      recorders['get_shares'].call(player.get_shares)
+
+   for i in range(max(args.samples // 10, 1)):
+      ndb.get_context().clear_cache()
+      snapshot = recorders['leaderboard'].call(LeaderboardSnapshot.build)
+   for i in range(args.samples):
+      ndb.get_context().clear_cache()
+      recorders['leaderboard_page'].call(lambda: (snapshot.page(0, 100),
+         snapshot.rank_of('player%d@bench' % sample.randrange(args.players))))
+
+   results = {
+      'commit': git_commit(),
+      'time': datetime.datetime.utcnow().isoformat(),
+      'parameters': {'players': args.players, 'pending': args.pending,
+         'history': args.history, 'ticks': args.ticks, 'seed': args.seed},
+      'entry_points': dict((name, recorder.report())
+         for (name, recorder) in recorders.iteritems()),
+   }
+   print(json.dumps(results, indent=2, sort_keys=True))
+   if args.compare:
+      compare(results, args.compare)
+   with open(args.out, 'w') as out_file:
+      json.dump(results, out_file, indent=2, sort_keys=True)
+
+   os.remove(quote_file.name)
+   bed.deactivate()
+
+if __name__ == '__main__':
+   main()
@@ -0,0 +1,97 @@
+"""Benchmark Statistics
+
+   This module contains the counters and timers used to report on each
+   benchmarked entry point.
+"""
+
+import collections
+import time
+
+import numpy
+
+class RpcCounter(object):
+   """Counts the API calls made to each service (datastore_v3, memcache,
+      urlfetch, taskqueue) through the API proxy.
+
+   Attributes:
+      counts: A Counter mapping service names to calls made.
+   """
+   def __init__(self):
+      self.counts = collections.Counter()
+
+   def install(self):
+      """Hooks the counter into the API proxy."""
+      from google.appengine.api import apiproxy_stub_map
+      apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('bench_rpc_counter', self.hook)
+
+   def hook(self, service, call, request, response):
+      """Counts one call (the signature of an API proxy pre-call hook)."""
+      self.counts[service] += 1
+
+   def snapshot(self):
+      """Gets a copy of the current counts."""
+      return collections.Counter(self.counts)
+
+class Recorder(object):
+   """Records the latency and RPC counts of repeated calls to one entry point.
+
+   Attributes:
+      name: The name of the entry point.
+      counter: The RpcCounter shared by every recorder.
+      latencies: The latency of each call, in seconds.
+      rpcs: A Counter of the API calls made by all calls, per service.
+      totals: A Counter of extra totals (e.g. orders, fills) reported by calls.
+   """
+   def __init__(self, name, counter):
+      self.name = name
+      self.counter = counter
+      self.latencies = []
+      self.rpcs = collections.Counter()
+      self.totals = collections.Counter()
+
+   def call(self, function, *args, **kwargs):
+      """Times one call to the entry point.
+
+      Args:
+         function: The function to call.
+         *args: Positional arguments for the function.
+         **kwargs: Keyword arguments for the function.
+
+      Returns:
+         The result of the function.
+      """
+      before = self.counter.snapshot()
+      start = time.time()
+      result = function(*args, **kwargs)
+      self.latencies.append(time.time() - start)
+      self.rpcs.update(self.counter.counts - before)
+      return result
+
+   def add(self, **totals):
+      """Adds to the extra totals, e.g. add(orders=10, fills=2)."""
+      self.totals.update(totals)
+
+   def report(self):
+      """Summarises the recorded calls.
+
+      Returns:
+         A dictionary of the call count, p50/p99/mean latency in milliseconds,
+         RPCs per call and throughput of each extra total per second.
+      """
+      calls = len(self.latencies)
+      if not calls:
+         return {'calls': 0}
+      latencies = numpy.array(self.latencies) * 1000
+      elapsed = sum(self.latencies)
+      report = {
+         'calls': calls,
+         'p50_ms': float(numpy.percentile(latencies, 50)),
+         'p99_ms': float(numpy.percentile(latencies, 99)),
+         'mean_ms': float(latencies.mean()),
+         'rpcs_per_call': dict((service, float(count) / calls)
+            for (service, count) in self.rpcs.iteritems()),
+      }
+      for (name, total) in self.totals.iteritems():
+         report[name] = total
+         report[name + '_per_second'] = total / elapsed if elapsed else None
+      return report
@@ -0,0 +1,400 @@
+"""Order Book Class
+
+   This module contains an in-memory index of the pending orders for each
+   stock, used by the execution cron to find the orders whose conditions have
+   been met without re-reading every pending Transaction. Each book keeps its
+   orders sorted by price, and the stocks with any triggered order are found
+   in one pass over arrays of the quotes and the best price of each book, so
+   that a tick costs time in the number of stocks and triggered orders rather
+   than the number of open orders.
+"""
+
+import bisect
+import datetime
+import threading
+import numpy
+
+from py.transaction import *
+
+def to_cents(price):
+   """Converts a dollar price to an integer number of cents.
+
+   Args:
+      price: The price in dollars (float or string).
+
+   Returns:
+      The price rounded to the nearest cent, as an integer.
+   """
+   return int(round(float(price) * 100))
+
+def parse_price(value):
+   """Parses a dollar price from the quote feed.
+
+   Values that cannot be parsed (e.g. 'N/A' or None) become NaN, so that every
+   comparison against them is false.
+
+   Args:
+      value: The price in dollars (float or string).
+
+   Returns:
+      The price as a float, or NaN.
+   """
+   try:
+      return float(value)
+   except (TypeError, ValueError):
+      return numpy.nan
+
+def to_cents_array(values):
+   """Converts a list of dollar prices to a float array of whole cents.
+
+   Values that cannot be parsed become NaN (see parse_price).
+
+   Args:
+      values: A list of prices in dollars.
+
+   Returns:
+      A numpy float array of the prices in cents.
+   """
+   cents = numpy.empty(len(values))
+   for i, value in enumerate(values):
+      price = parse_price(value)
+      cents[i] = price if numpy.isnan(price) else round(price * 100)
+   return cents
+
+def quote_prices(quote):
+   """Gets the bid, ask and last trade price of a quote.
+
+   Args:
+      quote: A quote dictionary (with 'Bid', 'Ask' and 'LastTradePriceOnly').
+
+   Returns:
+      A tuple of the bid, ask and last price in dollars, or None if any of
+      them cannot be parsed.
+   """
+   prices = tuple(parse_price(quote.get(field))
+      for field in ('Bid', 'Ask', 'LastTradePriceOnly'))
+   if any(numpy.isnan(price) for price in prices):
+      return None
+   return prices
+
+class OrderBook(object):
+   """Holds the pending orders for a single stock.
+
+   Limit and stop orders are held per (type, subtype) as a pair of parallel
+   lists of prices (in integer cents) and transaction keys, sorted by price.
+   The orders crossed by a new bid/ask/last price are then a slice of the
+   list found with a bisect, rather than a scan of every pending order.
+
+   Attributes:
+      stock: The stock code of the orders in the book.
+      market: A list of keys of pending market orders (these always trigger).
+      levels: A dictionary mapping (type, subtype) to a tuple of the sorted
+         price list and the matching key list.
+      entries: A dictionary mapping each key in the book to its
+         (type, subtype, price) so that it can be found for removal.
+   """
+   def __init__(self, stock):
+      self.stock = stock
+      self.market = []
+      self.levels = {
+         ('buy', 'limit'): ([], []),
+         ('sell', 'limit'): ([], []),
+         ('buy', 'stop'): ([], []),
+         ('sell', 'stop'): ([], []),
+      }
+      self.entries = {}
+
+   def __len__(self):
+      return len(self.entries)
+
+   def __contains__(self, key):
+      return key in self.entries
+
+   def add(self, key, type, subtype, price):
+      """Adds a pending order to the book. Adding a key twice has no effect.
+
+      Args:
+         key: The key of the Transaction.
+         type: The order type ('buy' or 'sell').
+         subtype: The order subtype ('market', 'limit' or 'stop').
+         price: The order price in dollars.
+      """
+      if key in self.entries:
+         return
+      cents = to_cents(price)
+      self.entries[key] = (type, subtype, cents)
+      if (subtype == 'market'):
+         self.market.append(key)
+      else:
+         prices, keys = self.levels[(type, subtype)]
+         i = bisect.bisect_right(prices, cents)
+         prices.insert(i, cents)
+         keys.insert(i, key)
+
+   def remove(self, key):
+      """Removes an order from the book if it is present.
+
+      Args:
+         key: The key of the Transaction.
+      """
+      entry = self.entries.pop(key, None)
+      if entry is None:
+         return
+      type, subtype, cents = entry
+      if (subtype == 'market'):
+         self.market.remove(key)
+      else:
+         prices, keys = self.levels[(type, subtype)]
+         # Only the orders at the same price need to be searched
+         lo = bisect.bisect_left(prices, cents)
+         hi = bisect.bisect_right(prices, cents)
+         i = keys.index(key, lo, hi)
+         del prices[i]
+         del keys[i]
+
+   def bounds(self):
+      """Gets the prices that decide whether any order in the book triggers.
+
+      Returns:
+         A tuple of the number of market orders, the highest limit buy, the
+         lowest limit sell, the lowest stop buy and the highest stop sell, in
+         cents (NaN where there are no such orders).
+      """
+      def price(type, subtype, i):
+         prices = self.levels[(type, subtype)][0]
+         return prices[i] if prices else numpy.nan
+      return (len(self.market), price('buy', 'limit', -1), price('sell', 'limit', 0),
+         price('buy', 'stop', 0), price('sell', 'stop', -1))
+
+   def crossed(self, bid, ask, last_price):
+      """Gets the orders whose execution conditions are satisfied.
+
+      A market order always triggers. A limit buy triggers when its price is
+      at or above the ask and a limit sell when its price is at or below the
+      bid. A stop buy triggers when the last price is at or above its price
+      and a stop sell when the last price is at or below its price.
+
+      Args:
+         bid: The current bid in cents.
+         ask: The current ask in cents.
+         last_price: The last trade price in cents.
+
+      Returns:
+         A list of the keys of the triggered orders.
+      """
+      triggered = list(self.market)
+      prices, keys = self.levels[('buy', 'limit')]
+      triggered.extend(keys[bisect.bisect_left(prices, ask):])
+      prices, keys = self.levels[('sell', 'limit')]
+      triggered.extend(keys[:bisect.bisect_right(prices, bid)])
+      prices, keys = self.levels[('buy', 'stop')]
+      triggered.extend(keys[:bisect.bisect_right(prices, last_price)])
+      prices, keys = self.levels[('sell', 'stop')]
+      triggered.extend(keys[bisect.bisect_left(prices, last_price):])
+      return triggered
+
+class Market(object):
+   """The order books for every stock with pending orders.
+
+   The books live in instance memory. The cron loads every stock's book, and
+   an execution task only those of its shard, the first time they are needed
+   on an instance. After that each sync only reads the orders placed since
+   the previous one. Cancelled orders are dropped from the book when they are
+   next triggered (or immediately if cancelled on this instance), and a book
+   is loaded again from scratch every REBUILD_INTERVAL to shed any strays.
+
+   Attributes:
+      books: A dictionary mapping stock codes to OrderBook instances.
+      stocks: A dictionary mapping Transaction keys to their stock code.
+      synced: The time of the last sync, or None before the first one.
+      rebuilt: The time every book was last loaded, or None.
+      loaded: A dictionary mapping stock codes to the time their book was
+         last loaded on its own.
+   """
+   # Orders placed just before a sync may not yet be visible to the
+   # (eventually consistent) query, so each sync overlaps the previous one.
+   SYNC_OVERLAP = datetime.timedelta(minutes=2)
+
+   REBUILD_INTERVAL = datetime.timedelta(hours=1)
+
+   # The most stocks loaded by one query (the most values of an IN filter)
+   LOAD_STOCKS = 30
+
+   def __init__(self):
+      self.books = {}
+      self.stocks = {}
+      self.synced = None
+      self.rebuilt = None
+      self.loaded = {}
+      self.lock = threading.Lock()
+
+   def book(self, stock):
+      """Gets the order book for a stock, creating it if necessary.
+
+      Args:
+         stock: The stock code.
+
+      Returns:
+         The OrderBook for the stock.
+      """
+      if stock not in self.books:
+         self.books[stock] = OrderBook(stock)
+      return self.books[stock]
+
+   def add(self, transaction):
+      """Adds a pending Transaction to the book for its stock.
+
+      Args:
+         transaction: A pending Transaction model instance.
+      """
+      with self.lock:
+         if transaction.key in self.stocks:
+            return
+         self.stocks[transaction.key] = transaction.stock
+         self.book(transaction.stock).add(transaction.key, transaction.type,
+            transaction.subtype, transaction.price)
+
+   def remove(self, key):
+      """Removes an order from its book if it is present.
+
+      Args:
+         key: The key of the Transaction.
+      """
+      with self.lock:
+         stock = self.stocks.pop(key, None)
+         if stock is not None:
+            self.books[stock].remove(key)
+            if not self.books[stock]:
+               del self.books[stock]
+
+   def is_current(self, stock, now):
+      """Checks whether the book of a stock (or with None, every book) has
+         been loaded recently enough to be kept up to date by syncs alone.
+      """
+      loaded = self.loaded.get(stock) if stock is not None else None
+      return ((self.rebuilt is not None and now - self.rebuilt <= self.REBUILD_INTERVAL)
+         or (loaded is not None and now - loaded <= self.REBUILD_INTERVAL))
+
+   @classmethod
+   def load(cls, query):
+      """Builds the books of the pending orders a query finds.
+
+      Args:
+         query: A query for pending Transactions.
+
+      Returns:
+         A tuple of a dictionary mapping stock codes to OrderBooks and a
+         dictionary mapping Transaction keys to their stock code.
+      """
+      books = {}
+      stocks = {}
+      for transaction in query:
+         if transaction.key in stocks:
+            continue
+         stocks[transaction.key] = transaction.stock
+         if transaction.stock not in books:
+            books[transaction.stock] = OrderBook(transaction.stock)
+         books[transaction.stock].add(transaction.key, transaction.type,
+            transaction.subtype, transaction.price)
+      return books, stocks
+
+   def sync(self, stocks=None):
+      """Brings the books up to date with the pending orders in the datastore.
+
+      Args:
+         stocks: The stock codes whose books are needed, or None for every
+            stock.
+      """
+      # Transaction timestamps are set by ndb in UTC
+      now = datetime.datetime.utcnow()
+      query = Transaction.query(Transaction.executed == False)
+      with self.lock:
+         synced = self.synced
+         rebuild = stocks is None and not self.is_current(None, now)
+         stale = sorted(stock for stock in set(stocks or []) if not self.is_current(stock, now))
+
+      # New books are built aside and replace the old ones at once, so that
+      # other threads never see them half built. Orders added while they are
+      # built are read again by the next sync's overlap.
+      if rebuild:
+         books, keys = self.load(query)
+         with self.lock:
+            self.books = books
+            self.stocks = keys
+            self.rebuilt = now
+            self.loaded = {}
+      else:
+         for first in range(0, len(stale), self.LOAD_STOCKS):
+            chunk = stale[first:first + self.LOAD_STOCKS]
+            books, keys = self.load(query.filter(Transaction.stock.IN(chunk)))
+            with self.lock:
+               for stock in chunk:
+                  old = self.books.pop(stock, None)
+                  if old is not None:
+                     for key in old.entries:
+                        self.stocks.pop(key, None)
+                  if stock in books:
+                     self.books[stock] = books[stock]
+                  self.loaded[stock] = now
+               self.stocks.update(keys)
+
+      if synced is not None:
+         for transaction in query.filter(Transaction.timestamp >= synced - self.SYNC_OVERLAP):
+            # Other books are loaded in full when they are first needed
+            with self.lock:
+               current = self.is_current(transaction.stock, now)
+            if current:
+               self.add(transaction)
+      with self.lock:
+         if (self.synced is None or self.synced < now):
+            self.synced = now
+
+   def triggered(self, share_dict, stocks=None):
+      """Gets the pending orders whose execution conditions are met.
+
+      The stocks with any triggered order are found in one pass over arrays
+      of the quotes and the best price of each book, and only their books are
+      searched for the orders. Orders for a stock without a usable quote never
+      trigger.
+
+      Args:
+         share_dict: A dictionary mapping stock codes to their quote (with
+            'Bid', 'Ask' and 'LastTradePriceOnly').
+         stocks: An optional collection of stock codes to restrict to.
+
+      Returns:
+         A dictionary mapping stock codes to lists of triggered Transaction
+         keys.
+      """
+      with self.lock:
+         symbols = sorted(stock for stock in self.books
+            if stocks is None or stock in stocks)
+         bounds = numpy.array([self.books[symbol].bounds() for symbol in symbols],
+            dtype=numpy.float64).reshape(len(symbols), 5)
+      quotes = [share_dict.get(str(symbol)) or {} for symbol in symbols]
+      bid = to_cents_array([quote.get('Bid') for quote in quotes])
+      ask = to_cents_array([quote.get('Ask') for quote in quotes])
+      last_price = to_cents_array([quote.get('LastTradePriceOnly') for quote in quotes])
+      market, limit_buy, limit_sell, stop_buy, stop_sell = bounds.T
+
+      with numpy.errstate(invalid='ignore'):
+         crossed = market > 0
+         crossed |= limit_buy >= ask
+         crossed |= limit_sell <= bid
+         crossed |= stop_buy <= last_price
+         crossed |= stop_sell >= last_price
+      # Execution needs the whole quote, whichever field the trigger used
+      crossed &= ~(numpy.isnan(bid) | numpy.isnan(ask) | numpy.isnan(last_price))
+
+      triggered = {}
+      with self.lock:
+         for i in numpy.flatnonzero(crossed):
+            book = self.books.get(symbols[i])
+            if book is not None:
+               keys = book.crossed(int(bid[i]), int(ask[i]), int(last_price[i]))
+               if keys:
+                  triggered[symbols[i]] = keys
+      return triggered
+
+# The books for this instance
+MARKET = Market()
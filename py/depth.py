@@ -2,34 +2,263 @@
 
    This module represents the model of the market depth associated with a
    particular stock.
+
+   Each side of the depth is held as parallel arrays of price levels (in
+   integer cents) and volumes, best price first, and stored packed as binary.
+   The depth of every stock is refreshed in one batch after each quote
+   snapshot, so that requests for it are normally a plain read.
+
+   Depth is keyed by stock code and cached per instance and in memcache. When
+   a stock's depth is stale, concurrent requests for it are coalesced so that
+   only one of them regenerates it and the rest reuse the result.
 """
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+from py.unit import *
 
-import random
+import bisect
+import datetime
+import threading
+import time
 import numpy
-import json
+
+def to_cents(price):
+   """Converts a dollar price to an integer number of cents."""
+   return int(round(float(price) * 100))
+
+class Levels(object):
+   """The price levels on one side of the market depth.
+
+   Attributes:
+      prices: An integer array of prices in cents, best price first
+         (descending for bids, ascending for asks).
+      volumes: An integer array of the volume at each price.
+   """
+   # Levels are packed as interleaved little-endian 32 bit (price, volume)
+   DTYPE = numpy.dtype('<i4')
+
+   def __init__(self, prices=(), volumes=()):
+      self.prices = numpy.array(prices, dtype=numpy.int64)
+      self.volumes = numpy.array(volumes, dtype=numpy.int64)
+
+   def __len__(self):
+      return len(self.prices)
+
+   def __getitem__(self, index):
+      """Selects levels by a slice or mask, returning new Levels."""
+      return Levels(self.prices[index], self.volumes[index])
+
+   def concat(self, other):
+      """Gets these levels followed by those of another Levels."""
+      return Levels(numpy.concatenate((self.prices, other.prices)),
+         numpy.concatenate((self.volumes, other.volumes)))
+
+   def flat(self):
+      """Gets the levels as a flat list [price, volume, price, volume, ...]
+         (the wire format of the depth endpoint).
+      """
+      flat = numpy.empty(2 * len(self), dtype=numpy.int64)
+      flat[0::2] = self.prices
+      flat[1::2] = self.volumes
+      return flat.tolist()
+
+   def pack(self):
+      """Packs the levels as binary for storage."""
+      return numpy.array(self.flat(), dtype=self.DTYPE).tostring()
+
+   @classmethod
+   def unpack(cls, data):
+      """Unpacks levels packed by pack."""
+      flat = numpy.fromstring(data, dtype=cls.DTYPE).astype(numpy.int64)
+      return cls(flat[0::2], flat[1::2])
+
+class LevelsProperty(ndb.BlobProperty):
+   """Stores a Levels instance as packed binary."""
+
+   def _validate(self, value):
+      if not isinstance(value, Levels):
+         raise TypeError('Expected Levels, got %r' % (value,))
+
+   def _to_base_type(self, value):
+      return value.pack()
+
+   def _from_base_type(self, value):
+      return Levels.unpack(value)
+
+class Ladder(object):
+   """One side of the market depth as a book of price levels sorted by
+      integer cents, which orders are filled against.
+
+   Prices are kept in ascending order whichever the side, so that the levels
+   a limit price allows are found by bisection: the lowest asks and the
+   highest bids are the best.
+
+   Attributes:
+      side: The depth type ('bid' or 'ask').
+      prices: An ascending list of prices in cents.
+      volumes: A list of the volume at each price.
+   """
+   def __init__(self, side, levels=None):
+      self.side = side
+      self.prices = []
+      self.volumes = []
+      if levels is not None:
+         order = numpy.argsort(levels.prices, kind='mergesort')
+         self.prices = levels.prices[order].tolist()
+         self.volumes = levels.volumes[order].tolist()
+
+   def __len__(self):
+      return len(self.prices)
+
+   def reachable(self, limit=None):
+      """Gets the range of levels that an order with a limit may fill against.
+
+      Args:
+         limit: The worst acceptable price in cents, or None for any price.
+
+      Returns:
+         A (start, stop) tuple of indices into prices.
+      """
+      if limit is None:
+         return 0, len(self.prices)
+      if (self.side == 'ask'):
+         return 0, bisect.bisect_right(self.prices, limit)
+      return bisect.bisect_left(self.prices, limit), len(self.prices)
+
+   def take(self, quantity, limit=None):
+      """Fills up to a quantity against the best levels, removing the volume
+         that is filled.
+
+      Args:
+         quantity: The quantity wanted.
+         limit: The worst acceptable price in cents, or None for any price.
+
+      Returns:
+         A tuple of the quantity filled, its total cost in cents and a list
+         of the (price, volume) taken from each level.
+      """
+      start, stop = self.reachable(limit)
+      indices = range(start, stop)
+      if (self.side == 'bid'):
+         indices = reversed(indices)
+      filled = 0
+      cost = 0
+      taken = []
+      for i in indices:
+         if filled == quantity:
+            break
+         volume = min(self.volumes[i], quantity - filled)
+         filled += volume
+         cost += volume * self.prices[i]
+         taken.append((self.prices[i], volume))
+      for price, volume in taken:
+         self.remove(price, volume)
+      return filled, cost, taken
+
+   def remove(self, price, volume):
+      """Removes up to a volume from the level at a price, if there is one,
+         dropping the level once it is empty.
+
+      Args:
+         price: The price of the level in cents.
+         volume: The volume to remove.
+      """
+      i = bisect.bisect_left(self.prices, price)
+      if (i < len(self.prices) and self.prices[i] == price):
+         self.volumes[i] -= min(self.volumes[i], volume)
+         if not self.volumes[i]:
+            del self.prices[i]
+            del self.volumes[i]
+
+   def levels(self):
+      """Gets the remaining levels as Levels, best price first."""
+      levels = Levels(self.prices, self.volumes)
+      if (self.side == 'bid'):
+         levels = levels[::-1]
+      return levels
 
 class Depth(ndb.Model):
    """Stores information pertaining to the market depth for a particular stock.
 
+   Depth entities are keyed by their stock code.
+
    Attributes:
       stock: The three character ASX stock code.
-      bids: A dictionary of prices and volumes for the bid depth.
-      asks: A dictionary of prices and volumes for the ask depth.
+      bid_levels: The Levels of the bid depth.
+      ask_levels: The Levels of the ask depth.
       max_bid: The maximum bid price in the depth.
       min_ask: The minimum ask price in the depth.
+      refreshed: The time the depth was last generated or updated. It is
+         set when the levels change rather than when the depth is written,
+         because depth is cached before the request's changes are written.
    """
    stock = ndb.StringProperty(required=True)
-   bids = ndb.JsonProperty()
-   asks = ndb.JsonProperty()
+   bid_levels = LevelsProperty()
+   ask_levels = LevelsProperty()
    max_bid = ndb.FloatProperty(required=True)
    min_ask = ndb.FloatProperty(required=True)
+   refreshed = ndb.DateTimeProperty()
+
+   # The number of prices to generate order depths for
+   NUM_PRICES = 10
+
+   # Depth refreshed by the cron more recently than this is served as it is
+   FRESH_FOR = datetime.timedelta(minutes=2)
+
+   # The most depths refreshed in one cross-group transaction
+   BATCH_GROUPS = 25
+
+   # Depth is cached by DepthCache rather than ndb's own memcache layer
+   _use_memcache = False
+
+   @classmethod
+   def key_for(cls, stock):
+      """Gets the key of the depth of a stock."""
+      return ndb.Key(cls, stock)
+
+   @classmethod
+   def get_by_stock(cls, stock):
+      """Gets the stored depth of a stock, or None.
+
+      Depth stored before it was keyed by stock code is moved to its new key
+      the first time it is read.
+
+      Args:
+         stock: The stock code.
+
+      Returns:
+         The Depth model instance, or None if there is none.
+      """
+      depth = cls.key_for(stock).get()
+      if depth is None:
+         legacy = cls.query(cls.stock == stock).get()
+         if legacy:
+            depth = cls(id=stock, stock=stock, max_bid=legacy.max_bid,
+               min_ask=legacy.min_ask, bid_levels=legacy.bid_levels,
+               ask_levels=legacy.ask_levels)
+            mark_dirty(depth)
+            mark_deleted(legacy.key)
+      return depth
+
+   def copy(self):
+      """Gets a copy of the depth, e.g. to be cached while the depth itself
+         is changed or written.
+      """
+      return Depth(key=self.key, **self.to_dict())
+
+   def is_fresh(self, now=None):
+      """Checks whether the depth was refreshed recently enough to be served
+         without an update.
+      """
+      now = now or datetime.datetime.utcnow()
+      return bool(self.bid_levels and self.ask_levels and self.refreshed
+         and now - self.refreshed < self.FRESH_FOR)
 
    @classmethod
    def new (cls, data):
       """Creates a new instance of the class and adds it to the datastore.
-      
+
       Assumes data passed is valid.
 
       Args:
@@ -38,27 +267,56 @@ class Depth(ndb.Model):
       Returns:
          The new Depth model instance.
       """
-      # The number of prices to generate order depths for
-      NUM_PRICES = 10
+      depth = cls.build(data)
+      mark_dirty(depth)
+      return depth
+
+   @classmethod
+   def build(cls, data):
+      """Creates (but does not store) a new depth generated at the given bid
+         and ask.
+
+      Args:
+         data: A dictionary containing the model instance data.
 
-      bids = json.dumps(cls.generate_depth('bid', data['max_bid'], data['avg_volume'], NUM_PRICES))
-      asks = json.dumps(cls.generate_depth('ask', data['min_ask'], data['avg_volume'], NUM_PRICES))
-      depth = cls(stock=data['stock'], bids=bids, asks=asks, max_bid=data['max_bid'], min_ask=data['min_ask'])
-      depth.put()
+      Returns:
+         The new Depth model instance.
+      """
+      depth = cls(id=data['stock'], stock=data['stock'], max_bid=data['max_bid'],
+         min_ask=data['min_ask'])
+      depth.generate(data['avg_volume'])
       return depth
 
    @classmethod
    def generate_depth(cls, type, limit, avg_volume, num_prices):
-      """Generates a dictionary of prices and volumes representing stock depth.
+      """Generates the price levels and volumes representing stock depth.
 
       Args:
          type: The depth type ('bid' or 'ask').
-         limit: The minimum/maximum price to generate.
+         limit: The minimum/maximum price to generate, in cents.
          avg_volume: The average volume around which to randomly generate values.
          num_prices: The number of prices at which to generate volumes.
 
       Returns:
-         A dictionary mapping prices (keys) to volumes (values).
+         The generated Levels, best price first.
+      """
+      return cls.generate_depth_batch([type], [limit], [avg_volume], num_prices)[0]
+
+   @classmethod
+   def generate_depth_batch(cls, types, limits, avg_volumes, num_prices):
+      """Generates the depth for many stocks and sides at once.
+
+      Every row moves away from its limit one price step at a time, all rows
+      together, until each has num_prices levels.
+
+      Args:
+         types: The depth type of each row ('bid' or 'ask').
+         limits: The minimum/maximum price of each row, in cents.
+         avg_volumes: The average volume of each row's stock.
+         num_prices: The number of prices at which to generate volumes.
+
+      Returns:
+         A list of the generated Levels of each row, best price first.
       """
       # The initial probability whereby an order price is skipped
       INIT_SKIP_PROB = 0.20
@@ -66,168 +324,290 @@ class Depth(ndb.Model):
       # The amount to increment the probability of skipping an order price
       SKIP_PROB_INC = 0.02
 
-      # The amount the order price changes
-      PRICE_CHANGE = .01
+      # The amount the order price changes, in cents
+      PRICE_CHANGE = 1
 
-      # Dict of prices
-      depth = {}
-
-      # Start off at the current price
-      current_price = float(limit)
+      limits = numpy.array(limits, dtype=numpy.int64)
+      n = len(limits)
+      step = numpy.where(numpy.array(types) == 'bid', -PRICE_CHANGE, PRICE_CHANGE)
 
       # Based off observations, 0.001% seems to be mean volume for any one order for stocks over
       # $30, but for stocks immediately under $30 it seems to be 0.01%
       # NOTE: Check further and restrict to ASX200
-      mean = 0.0001 * float(avg_volume)
-      if (limit < 30):
-         mean = 0.001 * float(avg_volume)
-
-      # The initial probability
-      p = INIT_SKIP_PROB
-
-      # Algorithm: We'll generate it for 10 prices. We want to move down in .01
-      # increments with perhaps a 20% chance of skipping an increment. This chance
-      # increases as we get further away from the bid
-      i = 0
-      while (i < num_prices):
+      avg_volumes = numpy.array(avg_volumes, dtype=numpy.float64)
+      mean = numpy.where(limits < 3000, 0.001 * avg_volumes, 0.0001 * avg_volumes)
+
+      # The probability of skipping a price in each row
+      p = INIT_SKIP_PROB * numpy.ones(n)
+
+      rows = numpy.arange(n)
+      count = numpy.zeros(n, dtype=numpy.int64)
+      prices = numpy.zeros((n, num_prices), dtype=numpy.int64)
+      volumes = numpy.zeros((n, num_prices), dtype=numpy.int64)
+
+      # Algorithm: We want to move away from the limit in .01 increments with
+      # perhaps a 20% chance of skipping an increment. This chance increases
+      # as we get further away from the limit
+      current_price = limits.copy()
+      while True:
+         active = (count < num_prices) & (current_price > 0)
+         if not active.any():
+            break
          # Only add the order to the depth with a probability of 1 - p
-         # unless the order is at the bid limit (in which case that necessarily)
+         # unless the order is at the limit (in which case that necessarily)
          # means an order should be there
-         rand = random.random()
-
-         if (rand > p or current_price == float(limit)):
+         added = active & ((numpy.random.random_sample(n) > p) | (current_price == limits))
 
-            # Generate the volume for this price based off average daily volume.
-            # Orders are very variable so SD is extremely large
-            volume = numpy.random.normal(mean, mean*4)
-            if (volume < 0): volume = volume * -1
+         # Generate the volume for this price based off average daily volume.
+         # Orders are very variable so SD is extremely large
+         volume = numpy.abs(numpy.random.normal(mean, mean * 4))
 
-            # Continually increase the probability of skipping an order
-            # once we are past the first num_prices/2.
-            if (i > (num_prices / 2)):
-               p += SKIP_PROB_INC
+         # Continually increase the probability of skipping an order
+         # once we are past the first num_prices/2.
+         p = numpy.where(added & (count > num_prices // 2), p + SKIP_PROB_INC, p)
 
-            # Add the volume, num orders to the depth dict
-            depth[round(current_price, 2)] = [round(volume, 0)]
+         # Add the price level and volume
+         prices[rows[added], count[added]] = current_price[added]
+         volumes[rows[added], count[added]] = numpy.round(volume[added])
+         count += added
 
-            # Increment the counter
-            i += 1
+         current_price += step
 
-         # Decrement the price by PRICE_CHANGE
-         if (type == 'bid'):
-            current_price -= PRICE_CHANGE
-         elif (type == 'ask'):
-            current_price += PRICE_CHANGE
-
-      return depth
+      return [Levels(prices[i, :count[i]], volumes[i, :count[i]]) for i in range(n)]
 
    @classmethod
    def get(cls, data):
-      """Gets the depth for a given stock, updates it, or generates it if none 
+      """Gets the depth for a given stock, updates it, or generates it if none
          exists.
 
+      The depth is read again and written in a transaction. A depth that has
+      been refreshed recently (e.g. by the cron) is returned as it is, so
+      that neither the refresh nor volume filled against it since (see
+      save_fills) is overwritten.
+
       Args:
          data: A dictionary containing the stock and relevant information.
 
       Returns:
          The Depth model instance for the given stock.
       """
-      depthQuery = Depth.query(Depth.stock == data['stock'])
-      if (depthQuery.count() == 0):
-         depth = Depth.new(data)
-      else:
-         depth = depthQuery.get()
-         depth.update(data['max_bid'], data['min_ask'], data['avg_volume'])
+      stock = data['stock']
+      # Depth stored before it was keyed by stock code is moved to its new key
+      legacy = None
+      if cls.key_for(stock).get() is None:
+         legacy = cls.query(cls.stock == stock).get()
+
+      @ndb.transactional
+      def txn():
+         depth = cls.key_for(stock).get()
+         if (depth is None and legacy is None):
+            depth = cls.build(data)
+         elif (depth is None):
+            depth = cls(id=stock, stock=stock, max_bid=legacy.max_bid,
+               min_ask=legacy.min_ask, bid_levels=legacy.bid_levels,
+               ask_levels=legacy.ask_levels)
+            depth.update(data['max_bid'], data['min_ask'], data['avg_volume'])
+         elif depth.is_fresh():
+            return depth
+         else:
+            depth.update(data['max_bid'], data['min_ask'], data['avg_volume'])
          depth.put()
+         return depth
+
+      depth = txn()
+      if legacy is not None:
+         mark_deleted(legacy.key)
       return depth
 
-   def update(self, new_bid, new_ask, avg_volume):
+   @classmethod
+   def refresh(cls, share_dict):
+      """Updates the depth of every stock with a usable quote, generating the
+         new levels for all of them in one batch.
+
+      Args:
+         share_dict: A dictionary mapping stock codes to their quote (with
+            'Bid', 'Ask' and 'AverageDailyVolume').
+
+      Returns:
+         The list of updated Depth model instances.
+      """
+      stocks, bids, asks, volumes = [], [], [], []
+      for stock, quote in sorted(share_dict.iteritems()):
+         try:
+            bid = float(quote['Bid'])
+            ask = float(quote['Ask'])
+            volume = float(quote['AverageDailyVolume'])
+         except (KeyError, TypeError, ValueError):
+            continue
+         if (bid > 0 and ask > 0 and volume > 0):
+            stocks.append(stock)
+            bids.append(bid)
+            asks.append(ask)
+            volumes.append(volume)
+
+      n = len(stocks)
+      generated = cls.generate_depth_batch(['bid'] * n + ['ask'] * n,
+         [to_cents(bid) for bid in bids] + [to_cents(ask) for ask in asks],
+         volumes + volumes, cls.NUM_PRICES)
+
+      # Each depth is read and written in a transaction, so that volume an
+      # execution shard fills meanwhile is neither restored nor lost (see
+      # save_fills)
+      @ndb.transactional(xg=True)
+      def txn(batch):
+         updated = []
+         created = []
+         for i, depth in zip(batch, ndb.get_multi([cls.key_for(stocks[i]) for i in batch])):
+            if depth is None:
+               depth = cls(id=stocks[i], stock=stocks[i], max_bid=bids[i], min_ask=asks[i])
+               depth.generate(volumes[i], (generated[i], generated[n + i]))
+               created.append(stocks[i])
+            else:
+               depth.update(bids[i], asks[i], volumes[i], (generated[i], generated[n + i]))
+            updated.append(depth)
+         ndb.put_multi(updated)
+         return updated, created
+
+      depths = []
+      created = []
+      for first in range(0, n, cls.BATCH_GROUPS):
+         updated, new = txn(range(first, min(first + cls.BATCH_GROUPS, n)))
+         depths.extend(updated)
+         created.extend(new)
+
+      # Depth stored before it was keyed by stock code is replaced
+      if created:
+         legacy = [key for key in cls.query(cls.stock.IN(created)).iter(keys_only=True)
+            if key.id() not in created]
+         mark_deleted(*legacy)
+
+      DEPTHS.set_multi(depths)
+      return depths
+
+   def generate(self, avg_volume, generated=None):
+      """Generates both sides of the depth from scratch at max_bid/min_ask.
+
+      Args:
+         avg_volume: The average volume of the stock.
+         generated: Optional pre-generated (bid, ask) Levels to use.
+      """
+      if generated is None:
+         generated = (Depth.generate_depth('bid', to_cents(self.max_bid), avg_volume, self.NUM_PRICES),
+            Depth.generate_depth('ask', to_cents(self.min_ask), avg_volume, self.NUM_PRICES))
+      self.bid_levels, self.ask_levels = generated
+      self.refreshed = datetime.datetime.utcnow()
+
+   def generate_from(self, type, limit, avg_volume, num_prices, generated=None):
+      """Generates levels starting at a limit.
+
+      Args:
+         type: The depth type ('bid' or 'ask').
+         limit: The price of the first level, in cents.
+         avg_volume: The average volume for the share.
+         num_prices: The number of levels wanted.
+         generated: Optional pre-generated Levels, which are moved to start
+            at the limit instead of generating new ones.
+
+      Returns:
+         The generated Levels.
+      """
+      if generated is None:
+         return Depth.generate_depth(type, limit, avg_volume, num_prices)
+      if not len(generated):
+         return generated
+      return Levels(generated.prices - generated.prices[0] + limit,
+         generated.volumes)[:num_prices]
+
+   def update(self, new_bid, new_ask, avg_volume, generated=None):
       """Updates the depth to fit in with the current bid and ask prices.
 
       Args:
          new_bid: The new bid price.
          new_ask: The new ask price.
          avg_volume: The average volume of the stock.
+         generated: Optional (bid, ask) Levels pre-generated at the new bid and
+            ask, used for any new levels instead of generating them here.
       """
-      if (new_bid < self.max_bid):
-         new_bid_list = self.update_int_depth('bid', new_bid, avg_volume)
-      elif (new_bid > self.max_bid):
-         new_bid_list = self.update_ext_depth('bid', new_bid, avg_volume)
+      if generated is None:
+         generated = (None, None)
+      if not (self.bid_levels and self.ask_levels):
+         # Depth stored in an older format is generated again
+         self.max_bid = new_bid
+         self.min_ask = new_ask
+         self.generate(avg_volume, generated if generated[0] is not None else None)
+         return
+
+      bid = to_cents(new_bid)
+      ask = to_cents(new_ask)
+      max_bid = to_cents(self.max_bid)
+      min_ask = to_cents(self.min_ask)
+
+      if (bid < max_bid):
+         new_bid_list = self.update_int_depth('bid', bid, avg_volume, generated[0])
+      elif (bid > max_bid):
+         new_bid_list = self.update_ext_depth('bid', bid, avg_volume, generated[0])
       else:
          # If the new_bid is the same as the max_bid in the previous depth
          # we don't change the depth
-         new_bid_list = json.loads(self.bids)
+         new_bid_list = self.bid_levels
          new_bid = self.max_bid
 
       # Ensure the new_bid is the top of the new_bid_list
-      new_bid_list = self.ensure_max(new_bid_list, new_bid)
+      new_bid_list = self.ensure_max(new_bid_list, bid)
 
-      if (new_ask > self.min_ask):
-         new_ask_list = self.update_int_depth('ask', new_ask, avg_volume)
-      elif (new_ask < self.min_ask):
-         new_ask_list = self.update_ext_depth('ask', new_ask, avg_volume)
+      if (ask > min_ask):
+         new_ask_list = self.update_int_depth('ask', ask, avg_volume, generated[1])
+      elif (ask < min_ask):
+         new_ask_list = self.update_ext_depth('ask', ask, avg_volume, generated[1])
       else:
          # If the new_ask is the same as the min_ask in the previous depth
          # we don't change the depth
-         new_ask_list = json.loads(self.asks)
+         new_ask_list = self.ask_levels
          new_ask = self.min_ask
 
       # Ensure the new_ask is the top of the new_ask_list
-      new_ask_list = self.ensure_min(new_ask_list, new_ask)
+      new_ask_list = self.ensure_min(new_ask_list, ask)
 
       # Update the bids and the new maximum bid/min ask
-      self.bids = json.dumps(new_bid_list)
-      self.asks = json.dumps(new_ask_list)
+      self.bid_levels = new_bid_list
+      self.ask_levels = new_ask_list
       self.max_bid = new_bid
       self.min_ask = new_ask
+      self.refreshed = datetime.datetime.utcnow()
 
-   def update_int_depth(self, type, limit, avg_volume):
+   def update_int_depth(self, type, limit, avg_volume, generated=None):
       """Updates depth where there has been an internal overlap.
 
       i.e. The new bid is less than the old bid, or new ask is greater than the
       old ask.
 
+      The levels still inside the new limit are kept and the remainder are
+      generated beyond the last of them.
+
       Args:
          type: The price type ('bid' or 'ask').
-         limit: The new limit for the price (new bid or new ask).
+         limit: The new limit for the price (new bid or new ask), in cents.
          avg_volume: The average volume for the share.
+         generated: Optional Levels pre-generated at the limit.
 
       Returns:
-         The updated Depth model instance.
+         The updated Levels.
       """
-       # The amount the order price changes
-      PRICE_CHANGE = .01
-
-      new_depth = {}
       if (type == 'bid'):
-         old_depth = json.loads(self.bids)
+         old_depth = self.bid_levels
+         new_depth = old_depth[old_depth.prices <= limit]
+         step = -1
       elif (type == 'ask'):
-         old_depth = json.loads(self.asks)
-
-      new_limit = limit
-      for price in old_depth.iterkeys():
-         # Keep all the elements in the old list that are in the
-         # constraints of the new limit
-         if ((type == 'bid' and float(price) <= limit) or
-            (type == 'ask' and float(price) >= limit)):
-            new_depth[price] = old_depth[price]
-
-         # Establish the minimum (for bid) or maximum (for ask)
-         # element in the new list and generate the remainder of elements
-         # from that
-         if (type == 'bid' and float(price) <= new_limit):
-            new_limit = float(price) - PRICE_CHANGE
-         elif (type == 'ask' and float(price) >= new_limit):
-            new_limit = float(price) + PRICE_CHANGE
-
-
-      # Generate the remaining elements
-      new_depth.update(Depth.generate_depth(type,
-         new_limit, avg_volume, 10 - len(new_depth)))
+         old_depth = self.ask_levels
+         new_depth = old_depth[old_depth.prices >= limit]
+         step = 1
 
-      return new_depth
+      # Generate the remaining elements from just past the last level kept
+      new_limit = new_depth.prices[-1] + step if len(new_depth) else limit
+      return new_depth.concat(self.generate_from(type,
+         new_limit, avg_volume, self.NUM_PRICES - len(new_depth), generated))
 
-   def update_ext_depth(self, type, limit, avg_volume):
+   def update_ext_depth(self, type, limit, avg_volume, generated=None):
       """Updates depth where there has been an external overlap.
 
       i.e. The new bid is greater than the old bid, or new ask is less than the
@@ -235,61 +615,283 @@ class Depth(ndb.Model):
 
       Args:
          type: The price type ('bid' or 'ask').
-         limit: The new limit for the price (new bid or new ask).
+         limit: The new limit for the price (new bid or new ask), in cents.
          avg_volume: The average volume for the share.
+         generated: Optional Levels pre-generated at the limit.
 
       Returns:
-         The updated Depth model instance.
+         The updated Levels.
       """
       if (type == 'bid'):
-         old_depth = json.loads(self.bids)
+         old_depth = self.bid_levels
       elif (type == 'ask'):
-         old_depth = json.loads(self.asks)
+         old_depth = self.ask_levels
+
+      # Generate an initial list of 10, merge the previous list into it (the
+      # previous volume wins where both have a price) and keep the best 10
+      merged = old_depth.concat(self.generate_from(type, limit, avg_volume,
+         self.NUM_PRICES, generated))
+      prices, first = numpy.unique(merged.prices, return_index=True)
+      if (type == 'bid'):
+         first = first[::-1]
+      return merged[first[:self.NUM_PRICES]]
+
+   def fill(self, type, quantity, limit=None):
+      """Fills an order against the depth, walking the levels from the best
+         price and removing the volume that is filled.
+
+      Args:
+         type: The order type ('buy' fills against the asks, 'sell' against
+            the bids).
+         quantity: The quantity wanted.
+         limit: The worst acceptable price in dollars, or None for any price.
+
+      Returns:
+         A tuple of the quantity filled and its volume weighted average price
+         in dollars (None if nothing was filled).
+      """
+      ladder, filled, price, taken = self.take(type, quantity, limit)
+      if (ladder.side == 'ask'):
+         self.ask_levels = ladder.levels()
+      else:
+         self.bid_levels = ladder.levels()
+      self._taken = self.taken() + [(ladder.side, level, volume) for (level, volume) in taken]
+      return filled, price
+
+   def price(self, type, quantity, limit=None):
+      """Prices an order against the depth without filling it.
+
+      Args:
+         type: The order type ('buy' or 'sell').
+         quantity: The quantity wanted.
+         limit: The worst acceptable price in dollars, or None for any price.
+
+      Returns:
+         A tuple of the quantity that would be filled and its volume weighted
+         average price in dollars (None if nothing would be filled).
+      """
+      ladder, filled, price, taken = self.take(type, quantity, limit)
+      return filled, price
+
+   def take(self, type, quantity, limit=None):
+      """Takes an order from a Ladder of the side it fills against, leaving
+         the depth itself unchanged.
+
+      Returns:
+         A tuple of the Ladder left, the quantity filled, its volume weighted
+         average price in dollars (None if nothing was filled) and the levels
+         taken as (price in cents, volume) tuples.
+      """
+      side = 'ask' if type == 'buy' else 'bid'
+      ladder = Ladder(side, self.ask_levels if side == 'ask' else self.bid_levels)
+      filled, cost, taken = ladder.take(quantity, None if limit is None else to_cents(limit))
+      if not filled:
+         return ladder, 0, None, taken
+      return ladder, filled, cost / 100.0 / filled, taken
+
+   def taken(self):
+      """Gets the volume filled against this instance since it was read, as
+         a list of (side, price in cents, volume) tuples.
+      """
+      return getattr(self, '_taken', [])
+
+   def consume(self, taken):
+      """Removes volume filled against another instance of this depth.
+
+      Args:
+         taken: A list of (side, price in cents, volume) tuples (see taken).
+      """
+      for side, price, volume in taken:
+         ladder = Ladder(side, self.ask_levels if side == 'ask' else self.bid_levels)
+         ladder.remove(price, volume)
+         if (side == 'ask'):
+            self.ask_levels = ladder.levels()
+         else:
+            self.bid_levels = ladder.levels()
 
-      # Generate an initial list of 10, combine it with the previous list
-      # and then select the top 10
-      new_depth = Depth.generate_depth(type, limit, avg_volume, 10)
-      new_depth.update(old_depth)
-      i = 0
-      for key in sorted(new_depth.iterkeys()):
-         if (i >= 10):
-            del new_depth[key]
-         i += 1
+   @classmethod
+   def save_fills(cls, depths):
+      """Writes depths that orders have been filled against.
 
-      return new_depth
+      Each depth is written in a transaction that reads it again. If the
+      stored depth has been refreshed since it was read, the refresh is kept
+      and the volume filled is taken from it instead, so that neither the
+      refresh nor the fills are lost.
 
-   def ensure_max(self, depth_dict, max_val):
-      """Makes sure max is the maxmimum element in depth_dict.
+      Args:
+         depths: A list of Depth model instances, each with the refreshed
+            time it was read at in 'read_at' (None for a new depth).
 
-      If max is not in the dict, it replaces the maximum value in the dict.
+      Returns:
+         The list of the depths as written.
+      """
+      @ndb.transactional
+      def txn(depth):
+         stored = depth.key.get()
+         if (stored is None or stored.refreshed == depth.read_at):
+            depth.put()
+            return depth
+         stored.consume(depth.taken())
+         stored.put()
+         return stored
+      return [txn(depth) for depth in depths]
+
+   def ensure_max(self, levels, max_val):
+      """Makes sure max is the best (first) price of bid levels.
+
+      If max is above the best price, it replaces the best price.
 
       Args:
-         depth_dict: A dictionary of (price, volume) pairs representing the depth.
-         max_val: The maximum price value that should be in the dictionary.
+         levels: The bid Levels.
+         max_val: The maximum price in cents that should be in the levels.
 
       Returns:
-         The updated depth dictionary.
+         The updated Levels.
       """
-      cur_max = max(depth_dict.iterkeys())
-      if (float(max_val) > float(cur_max)):
-         depth_dict[max_val] = depth_dict[cur_max]
-         depth_dict.pop(cur_max, None)
-      return depth_dict
+      if (len(levels) and max_val > levels.prices[0]):
+         levels = levels[:]
+         levels.prices[0] = max_val
+      return levels
 
-   def ensure_min(self, depth_dict, min_val):
-      """Makes sure min is the minimum element in depth_dict.
+   def ensure_min(self, levels, min_val):
+      """Makes sure min is the best (first) price of ask levels.
 
-      If min is not in the dict, it replaces the minimum value in the dict.
+      If min is below the best price, it replaces the best price.
 
       Args:
-         depth_dict: A dictionary of (price, volume) pairs representing the depth.
-         min_val: The minimum price value that should be in the dictionary.
+         levels: The ask Levels.
+         min_val: The minimum price in cents that should be in the levels.
 
       Returns:
-         The updated depth dictionary.
+         The updated Levels.
+      """
+      if (len(levels) and min_val < levels.prices[0]):
+         levels = levels[:]
+         levels.prices[0] = min_val
+      return levels
+
+class DepthCache(object):
+   """Caches Depth entities per stock in memcache, with a short-lived
+      in-process layer in front of it.
+
+   A stale depth is regenerated by one request at a time: a lock per stock
+   coalesces the threads of this instance, and a memcache lock coalesces
+   instances. Requests that find the depth being regenerated elsewhere wait
+   briefly for the result, and otherwise serve the stale depth without
+   writing it. The regenerated depth is written in a transaction (see
+   Depth.get) and cached with compare-and-set, so a slower regeneration never
+   overwrites a newer one.
+
+   The cache holds copies of the depths it is given (see Depth.copy), which
+   are shared between requests and must not be modified.
+
+   Attributes:
+      local_ttl: Seconds a depth stays in the local layer.
+      local: A dictionary mapping stock codes to (expiry, depth).
+      flights: A dictionary mapping stock codes to the lock held while
+         regenerating their depth in this instance.
+   """
+   PREFIX = 'depth:'
+   LOCK_PREFIX = 'depth:lock:'
+
+   # Seconds a depth stays in memcache (the cron refreshes it every minute)
+   TTL = 300
+
+   # Seconds an instance holds the lock on a stock while regenerating it
+   LOCK_SECONDS = 10
+
+   # How many times, and how many seconds apart, to check for a depth being
+   # regenerated by another instance
+   WAIT_TRIES = 5
+   WAIT_SECONDS = 0.1
+
+   def __init__(self, local_ttl=5):
+      self.local_ttl = local_ttl
+      self.local = {}
+      self.flights = {}
+      self.lock = threading.Lock()
+
+   def get_local(self, stock, now):
+      """Gets an unexpired depth from the local layer, or None."""
+      with self.lock:
+         entry = self.local.get(stock)
+      if entry is None or entry[0] < now:
+         return None
+      return entry[1]
+
+   def set_local(self, depth, now):
+      """Adds a depth (already copied) to the local layer."""
+      with self.lock:
+         self.local[depth.stock] = (now + self.local_ttl, depth)
+
+   def flight(self, stock):
+      """Gets the lock held while regenerating the depth of a stock."""
+      with self.lock:
+         return self.flights.setdefault(stock, threading.Lock())
+
+   def get(self, data):
+      """Gets the fresh depth for a stock, regenerating it if needed.
+
+      Args:
+         data: A dictionary containing the stock and relevant information
+            (as for Depth.get).
+
+      Returns:
+         The Depth model instance for the given stock.
+      """
+      stock = data['stock']
+      depth = self.get_local(stock, time.time())
+      if depth and depth.is_fresh():
+         return depth
+
+      with self.flight(stock):
+         # Another thread may have regenerated the depth while this one waited
+         depth = self.get_local(stock, time.time())
+         if depth and depth.is_fresh():
+            return depth
+
+         client = memcache.Client()
+         cached = client.gets(self.PREFIX + stock)
+         if cached and cached.is_fresh():
+            self.set_local(cached, time.time())
+            return cached
+
+         if not memcache.add(self.LOCK_PREFIX + stock, 1, time=self.LOCK_SECONDS):
+            # Another instance is regenerating the depth
+            for i in range(self.WAIT_TRIES):
+               time.sleep(self.WAIT_SECONDS)
+               depth = memcache.get(self.PREFIX + stock)
+               if depth and depth.is_fresh():
+                  self.set_local(depth, time.time())
+                  return depth
+            # A depth that does not exist yet is generated but not stored
+            return cached or Depth.key_for(stock).get() or Depth.build(data)
+
+         try:
+            depth = Depth.get(data)
+            # The depth returned is not the one shared with others
+            shared = depth.copy()
+            if cached is None:
+               client.add(self.PREFIX + stock, shared, time=self.TTL)
+            else:
+               client.cas(self.PREFIX + stock, shared, time=self.TTL)
+            self.set_local(shared, time.time())
+         finally:
+            memcache.delete(self.LOCK_PREFIX + stock)
+      return depth
+
+   def set_multi(self, depths):
+      """Writes copies of freshly updated depths to both cache layers.
+
+      Args:
+         depths: A list of Depth model instances.
       """
-      cur_min = min(depth_dict.iterkeys())
-      if (float(min_val) < float(cur_min)):
-         depth_dict[min_val] = depth_dict[cur_min]
-         depth_dict.pop(cur_min, None)
-      return depth_dict
+      depths = [depth.copy() for depth in depths]
+      memcache.set_multi(dict((depth.stock, depth) for depth in depths),
+         time=self.TTL, key_prefix=self.PREFIX)
+      now = time.time()
+      for depth in depths:
+         self.set_local(depth, now)
+
+# The depth cache for this instance
+DEPTHS = DepthCache()
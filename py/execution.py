@@ -0,0 +1,492 @@
+"""Order Execution
+
+   This module contains the execution of pending orders. Each minute the cron
+   fetches quotes once, stores them with an ExecutionRun and enqueues one task
+   per shard of stocks with pending orders; each task leases its stocks,
+   executes their triggered orders and records its timing on the run.
+"""
+
+import datetime
+import time
+
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from py.transaction import *
+from py.player import *
+from py.position import *
+from py.book import *
+from py.depth import *
+from py.portfolio import *
+from py.push import *
+from py.unit import *
+
+# The maximum number of stocks executed by one task. Leases for a shard are
+# taken in one cross-group transaction, which allows at most 25 groups.
+SHARD_SIZE = 20
+
+# Seconds a stock stays leased to a run if its task never releases it. The
+# execution queue retries a shard's task for up to a minute (task_age_limit
+# in queue.yaml), after which the next tick's run takes over its stocks.
+# A shard still running when its lease lapses is harmless: every fill is
+# checked again against the stored order when it is settled (see
+# settle_fills).
+LEASE_SECONDS = 60 + 30
+
+# The most groups besides the player written by one settlement transaction
+# (a cross-group transaction allows at most 25)
+SETTLE_GROUPS = 24
+
+class ExecutionRun(ndb.Model):
+   """Records one execution run of the cron.
+
+   Attributes:
+      started: The time the run was started.
+      finished: The time the last shard completed, or None.
+      shards: The number of shards (tasks) in the run.
+      quotes: The quote snapshot every shard of the run executes against.
+   """
+   started = ndb.DateTimeProperty(auto_now_add=True)
+   finished = ndb.DateTimeProperty()
+   shards = ndb.IntegerProperty(default=0, indexed=False)
+   quotes = ndb.JsonProperty(compressed=True)
+
+   QUEUE = 'execution'
+
+   @classmethod
+   def start(cls, share_dict, stocks):
+      """Creates a run and enqueues a task for each shard of stocks.
+
+      Args:
+         share_dict: The quotes to execute against.
+         stocks: The stock codes with pending orders.
+
+      Returns:
+         The new ExecutionRun.
+      """
+      stocks = sorted(stocks)
+      shards = [stocks[i:i + SHARD_SIZE] for i in range(0, len(stocks), SHARD_SIZE)]
+      run = cls(shards=len(shards), quotes=share_dict)
+      run.put()
+      memcache.set(run.quotes_key(), share_dict, time=LEASE_SECONDS * 2)
+      tasks = [taskqueue.Task(url='/tasks/execute', params={
+            'run': run.key.id(), 'shard': i, 'stocks': ','.join(shard)})
+         for (i, shard) in enumerate(shards)]
+      # The queue accepts at most 100 tasks per call
+      for i in range(0, len(tasks), 100):
+         taskqueue.Queue(cls.QUEUE).add(tasks[i:i + 100])
+      if not shards:
+         run.finish_shard(None)
+      return run
+
+   def quotes_key(self):
+      """Gets the memcache key of the run's quote snapshot."""
+      return 'execution:quotes:%s' % self.key.id()
+
+   def get_quotes(self):
+      """Gets the run's quote snapshot, from memcache if possible."""
+      return memcache.get(self.quotes_key()) or self.quotes
+
+   def finish_shard(self, shard):
+      """Records a completed shard and, when it is the last, completes the run.
+
+      Args:
+         shard: The completed ExecutionShard, or None for a run without shards.
+      """
+      if shard is not None:
+         shard.put()
+
+      @ndb.transactional
+      def complete():
+         run = self.key.get()
+         done = ExecutionShard.query(ancestor=run.key).count()
+         if (run.finished is None and done >= run.shards):
+            run.finished = datetime.datetime.utcnow()
+            run.put()
+            # Re-rank the players at the new prices
+            taskqueue.add(url='/tasks/leaderboard', transactional=True)
+      complete()
+
+   def summary(self):
+      """Gets the run's timing, including that of each shard.
+
+      Returns:
+         A dictionary of the run's timing.
+      """
+      shards = ExecutionShard.query(ancestor=self.key).fetch()
+      return {
+         'started': self.started.isoformat(),
+         'finished': self.finished.isoformat() if self.finished else None,
+         'seconds': (self.finished - self.started).total_seconds() if self.finished else None,
+         'shards': [shard.to_dict() for shard in shards],
+      }
+
+class ExecutionShard(ndb.Model):
+   """Records the completion of one shard of an ExecutionRun.
+
+   Attributes:
+      stocks: The stocks executed by the shard.
+      skipped: The stocks that were leased to another run.
+      orders: The number of triggered orders looked at.
+      fills: The number of orders executed.
+      seconds: The time the shard took.
+   """
+   stocks = ndb.StringProperty(repeated=True, indexed=False)
+   skipped = ndb.StringProperty(repeated=True, indexed=False)
+   orders = ndb.IntegerProperty(default=0, indexed=False)
+   fills = ndb.IntegerProperty(default=0, indexed=False)
+   seconds = ndb.FloatProperty(default=0.0, indexed=False)
+
+class ExecutionLease(ndb.Model):
+   """Marks a stock as being executed by a run, so that two runs do not
+      execute the same stock at once.
+
+   Attributes:
+      run: The id of the run holding the lease.
+      expires: When the lease lapses if it is never released.
+   """
+   run = ndb.IntegerProperty(indexed=False)
+   expires = ndb.DateTimeProperty(indexed=False)
+
+   @classmethod
+   def acquire(cls, stocks, run_id):
+      """Leases as many of the stocks to a run as are free.
+
+      A stock whose lease is already held by the same run (e.g. on a task
+      retry) counts as free.
+
+      Args:
+         stocks: A list of at most SHARD_SIZE stock codes.
+         run_id: The id of the ExecutionRun.
+
+      Returns:
+         The list of stocks leased.
+      """
+      @ndb.transactional(xg=True)
+      def txn():
+         now = datetime.datetime.utcnow()
+         leased = []
+         leases = []
+         for stock, lease in zip(stocks, ndb.get_multi([ndb.Key(cls, s) for s in stocks])):
+            if (lease is None or lease.run == run_id or lease.expires < now):
+               leased.append(stock)
+               leases.append(cls(id=stock, run=run_id,
+                  expires=now + datetime.timedelta(seconds=LEASE_SECONDS)))
+         ndb.put_multi(leases)
+         return leased
+      return txn()
+
+   @classmethod
+   def release(cls, stocks, run_id):
+      """Releases the leases a run holds on a list of stocks. Leases taken
+         since by another run (after this one's lapsed) are kept.
+
+      Args:
+         stocks: A list of at most SHARD_SIZE stock codes.
+         run_id: The id of the ExecutionRun.
+      """
+      @ndb.transactional(xg=True)
+      def txn():
+         leases = ndb.get_multi([ndb.Key(cls, stock) for stock in stocks])
+         ndb.delete_multi([lease.key for lease in leases
+            if lease is not None and lease.run == run_id])
+      txn()
+
+def execute_stocks(stocks, share_dict):
+   """Executes the triggered orders of a set of stocks.
+
+   Orders are executed in memory against the players as read, and each
+   player's fills are then settled in transactions against the player as
+   stored (see settle_fills), so that shards filling orders of the same
+   player at once never overwrite each other's cash.
+
+   Args:
+      stocks: A collection of stock codes.
+      share_dict: A dictionary mapping stock codes to their quote.
+
+   Returns:
+      A tuple of the number of triggered orders and the number executed.
+   """
+   # Bring the in-memory order books up to date and find the orders that
+   # the new prices have triggered in one pass
+   MARKET.sync(stocks)
+   triggered = MARKET.triggered(share_dict, stocks)
+   count = 0
+   # The fills of each player, in the order they were executed
+   fills = {}
+   splits = []
+   depths = []
+   # Backfilled owners are written with the task's other changes (or when
+   # the block ends, outside a request)
+   with unit_of_work():
+      for stock in sorted(triggered.keys()):
+         # For each stock code get the bid and ask. Orders only trigger on a
+         # whole quote, but the stock is skipped rather than failing the
+         # shard should one slip through.
+         prices = quote_prices(share_dict.get(str(stock)) or {})
+         if prices is None:
+            continue
+         bid, ask, last_price = prices
+
+         keys = triggered[stock]
+         orders = []
+         for key, order in zip(keys, load_multi(keys)):
+            if (order is None or order.executed):
+               # Cancelled or already executed elsewhere
+               MARKET.remove(key)
+            else:
+               orders.append(order)
+         count += len(orders)
+
+         # Load the owners of every triggered order at once and execute in
+         # memory. A player with fills in several of the stocks is the same
+         # instance throughout, so each fill sees the cash left by the last.
+         unowned = set(order.key for order in orders if order.owner is None)
+         players = Player.get_owners(orders)
+         depth = load_depth(stock, share_dict[str(stock)])
+         for order in orders:
+            player = players.get(order.owner)
+            if player is None:
+               continue
+            quantity = order.quantity
+            cash = player.cash
+            executed = execute_order(order, player, bid, ask, last_price, depth)
+            if executed is not None:
+               fills.setdefault(player.key, []).append(
+                  (order, executed, quantity, player.cash - cash))
+               if executed is not order:
+                  splits.append(executed)
+            elif order.key in unowned:
+               # Records the owner backfilled by get_owners
+               mark_dirty(order)
+         if depth is not None:
+            depths.append(depth)
+
+   # Written apart from the unit, so that a refresh of the depth meanwhile is
+   # kept (see Depth.save_fills)
+   depths = Depth.save_fills(depths)
+
+   # The filled part of a partly filled order is stored as a new executed
+   # transaction, while the order stays pending for the residual quantity.
+   # Keys are allocated up front so that a retried settlement reuses them.
+   if splits:
+      first, last = Transaction.allocate_ids(len(splits))
+      for executed, id in zip(splits, range(first, last + 1)):
+         executed.key = ndb.Key(Transaction, id)
+
+   transactions = []
+   for player_key, player_fills in fills.iteritems():
+      transactions.extend(settle_fills(player_key, player_fills))
+   for executed in transactions:
+      # A partly filled order stays in its book
+      MARKET.remove(executed.key)
+
+   invalidate_value_series(set(executed.owner for executed in transactions))
+   publish_fills(transactions)
+   DEPTHS.set_multi(depths)
+   return count, len(transactions)
+
+def settle_fills(player_key, fills):
+   """Writes the fills of one player's orders, applying their cash changes to
+      the player as stored rather than as read when the orders executed.
+
+   Each batch of fills is written in a cross-group transaction that reads
+   the player, their positions and the orders again, so that fills in other
+   shards and orders placed or cancelled meanwhile are never overwritten. A
+   fill whose order has been cancelled, executed or changed since it was
+   read is left out.
+
+   Args:
+      player_key: The key of the Player.
+      fills: A list of (order, executed, quantity, cash) tuples, in the order
+         they were executed: the pending Transaction, the executed
+         Transaction (the order itself or a keyed part split off it), the
+         order's quantity when it was read, and the change in the player's
+         cash.
+
+   Returns:
+      The list of executed Transactions written.
+   """
+   @ndb.transactional(xg=True)
+   def txn(batch):
+      player = player_key.get()
+      if player is None:
+         return []
+      stored = ndb.get_multi([order.key for (order, executed, quantity, cash) in batch])
+      stocks = sorted(set(order.stock for (order, executed, quantity, cash) in batch))
+      positions = dict((stock, position or Position(key=Position.key_for(player_key, stock),
+         stock=stock)) for (stock, position) in zip(stocks,
+         ndb.get_multi([Position.key_for(player_key, stock) for stock in stocks])))
+      settled = []
+      changed = []
+      for (order, executed, quantity, cash), current in zip(batch, stored):
+         if (current is None or current.executed or current.quantity != quantity):
+            continue
+         player.cash = player.cash + cash
+         executed.cashHistory = player.cash
+         positions[order.stock].execute(executed)
+         settled.append(executed)
+         changed.append(order)
+         if executed is not order:
+            changed.append(executed)
+      if settled:
+         ndb.put_multi([player] + positions.values() + changed)
+      return settled
+
+   settled = []
+   batch = []
+   groups = 0
+   for fill in fills:
+      # Each order is a group, as is the new transaction split off one
+      size = 1 if fill[1] is fill[0] else 2
+      if (batch and groups + size > SETTLE_GROUPS):
+         settled.extend(txn(batch))
+         batch = []
+         groups = 0
+      batch.append(fill)
+      groups += size
+   if batch:
+      settled.extend(txn(batch))
+   return settled
+
+def load_depth(stock, quote):
+   """Gets the market depth of a stock at its current bid and ask.
+
+   Args:
+      stock: The stock code.
+      quote: The stock's quote, with 'Bid', 'Ask' and 'AverageDailyVolume'.
+
+   Returns:
+      The (unstored) Depth model instance, with the refreshed time it was
+      read at in 'read_at' (see Depth.save_fills), or None if the quote has no
+      usable volume for orders to be filled against the depth.
+   """
+   try:
+      bid = float(quote['Bid'])
+      ask = float(quote['Ask'])
+      volume = float(quote['AverageDailyVolume'])
+   except (KeyError, TypeError, ValueError):
+      return None
+   if not (bid > 0 and ask > 0 and volume > 0):
+      return None
+   depth = Depth.get_by_stock(stock)
+   if depth is None:
+      depth = Depth(id=stock, stock=stock, max_bid=bid, min_ask=ask)
+      depth.read_at = None
+      depth.generate(volume)
+      return depth
+   depth.read_at = depth.refreshed
+   if (depth.max_bid != bid or depth.min_ask != ask
+      or not (depth.bid_levels and depth.ask_levels)):
+      depth.update(bid, ask, volume)
+   return depth
+
+def execute_shard(run_id, shard_number, stocks):
+   """Executes one shard of a run: leases its stocks, executes them and
+      records the shard's timing.
+
+   Args:
+      run_id: The id of the ExecutionRun.
+      shard_number: The index of the shard within the run.
+      stocks: The list of stock codes in the shard.
+   """
+   start = time.time()
+   run = ExecutionRun.get_by_id(run_id)
+   if run is None:
+      return
+   leased = ExecutionLease.acquire(stocks, run_id)
+   try:
+      count, fills = execute_stocks(set(leased), run.get_quotes())
+   finally:
+      ExecutionLease.release(leased, run_id)
+   run.finish_shard(ExecutionShard(parent=run.key, id=shard_number + 1,
+      stocks=leased, skipped=[s for s in stocks if s not in leased],
+      orders=count, fills=fills, seconds=time.time() - start))
+
+def execute_order(order, player, bid, ask, last_price, depth=None):
+   """Executes a pending order whose conditions have been met.
+
+   Market and limit orders are filled against the market depth when it is
+   given, walking its levels from the best price at a volume weighted
+   average price. If the depth cannot fill the whole order, the filled part
+   is split off as a new executed Transaction and the order stays pending
+   for the residual quantity. Without a depth, orders fill in full at the bid
+   or ask.
+
+   Only the order, player and depth instances are changed; the caller is
+   responsible for writing them (and for giving a split transaction a key).
+
+   Args:
+      order: The pending Transaction, already known to be triggered.
+      player: The Player who placed the order.
+      bid: The current bid of the stock.
+      ask: The current ask of the stock.
+      last_price: The last trade price of the stock.
+      depth: The Depth of the stock to fill against, or None.
+
+   Returns:
+      The executed Transaction (the order itself, or the part split off it),
+      or None if the order remains pending.
+   """
+   # Order will not be executed if it puts the player in debt, at what the
+   # whole quantity costs (its volume weighted price against the depth)
+   if (order.subtype == 'market' and order.type == 'buy'):
+      filled, price = order.quantity, ask
+      if depth is not None:
+         filled, price = depth.price(order.type, order.quantity)
+      if (filled and player.cash + filled * (order.price - price) < 0):
+         return None
+
+   executed = order
+   if (depth is not None and order.subtype in ('market', 'limit')):
+      limit = order.price if order.subtype == 'limit' else None
+      filled, price = depth.fill(order.type, order.quantity, limit)
+      if not filled:
+         return None
+      if (filled < order.quantity):
+         executed = Transaction(type=order.type, subtype=order.subtype,
+            stock=order.stock, price=order.price, quantity=filled,
+            executed=False, fee=0.0, owner=order.owner)
+      # The depth fills at its own prices rather than the top of the book
+      bid = ask = price
+
+   if (executed.subtype == 'market'):
+      # If the order is a market transaction, it executes at current bid/ask and
+      # A) refunds/charges the difference in money for a buy
+      # B) updates cash for a sell
+      if (executed.type == 'buy'):
+         # Refunds money if order.price >= ask, otherwise charges extra if
+         # order.price <= ask
+         difference = executed.price - ask
+         executed.price = ask
+         player.apply_cash(difference, executed)
+      elif (executed.type == 'sell'):
+         # Sells at the bid and updates the cash based off that price
+         executed.price = bid
+         player.apply_cash(executed.price, executed)
+   elif (executed.subtype == 'limit'):
+      # If the order is a limit transaction it will get executed only
+      # when certain conditions are met.
+      if (executed.type == 'buy'):
+         # The order will get executed at the lowest ask
+         # and you will be refunded the difference
+         difference = executed.price - ask
+         executed.price = ask
+         player.apply_cash(difference, executed)
+      elif (executed.type == 'sell'):
+         # The order will get executed at the largest bid
+         # and your cash will get updated accordingly
+         executed.price = bid
+         player.apply_cash(executed.price, executed)
+   elif (executed.subtype == 'stop'):
+      # A stop buy order is executed when the price goes above your price
+      # You only need to execute the order
+      # A stop sell order is executed when the price goes below your price
+      # You want to update the cash and execute the order
+      if (executed.type == 'sell'):
+         player.apply_cash(executed.price, executed)
+   executed.timestamp = datetime.datetime.now()
+   executed.executed = True
+   if executed is not order:
+      order.quantity -= executed.quantity
+   return executed
@@ -0,0 +1,450 @@
+"""Historical Price Store
+
+   This module keeps the daily price history of each stock (date, open, high,
+   low, close and volume) as compact column arrays. The history of a stock is
+   stored in the datastore one chunk per year, and each chunk is cached packed
+   in memcache, so that charts are drawn from the application instead of one
+   remote query per stock per page view.
+
+   The store is filled incrementally from a HistorySource: the part of a
+   requested range that has not been loaded yet is fetched once and merged in.
+"""
+
+import csv
+import datetime
+import json
+import os
+import urllib
+
+import numpy
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
+
+# Dates are held as the number of days since this date
+EPOCH = datetime.date(1970, 1, 1)
+
+def to_day(date):
+   """Converts a date to the number of days since the epoch."""
+   return (date - EPOCH).days
+
+def from_day(day):
+   """Converts a number of days since the epoch to a date."""
+   return EPOCH + datetime.timedelta(days=int(day))
+
+def parse_date(text):
+   """Parses a date in the format YYYY-MM-DD."""
+   return datetime.datetime.strptime(text[:10], '%Y-%m-%d').date()
+
+class PriceSeries(object):
+   """The daily prices of one stock as column arrays, in date order.
+
+   Attributes:
+      columns: An integer array with one row per entry of COLUMNS: the day
+         (since the epoch), the open, high, low and close prices in cents
+         and the volume.
+   """
+   COLUMNS = ['date', 'open', 'high', 'low', 'close', 'volume']
+
+   # Series are packed as little-endian 64 bit integers, column by column
+   DTYPE = numpy.dtype('<i8')
+
+   def __init__(self, columns=None):
+      if columns is None:
+         columns = numpy.zeros((len(self.COLUMNS), 0), dtype=numpy.int64)
+      self.columns = numpy.asarray(columns, dtype=numpy.int64).reshape(len(self.COLUMNS), -1)
+
+   @classmethod
+   def from_rows(cls, rows):
+      """Creates a series from rows in any order.
+
+      Args:
+         rows: A list of (date, open, high, low, close, volume) tuples, with
+            prices in dollars.
+
+      Returns:
+         A PriceSeries (with one row per date, the first given winning).
+      """
+      columns = numpy.array([[to_day(row[0])] + [int(round(float(price) * 100))
+         for price in row[1:5]] + [int(float(row[5]))] for row in rows],
+         dtype=numpy.int64).reshape(-1, len(cls.COLUMNS)).T
+      return cls().merge(cls(columns))
+
+   def __len__(self):
+      return self.columns.shape[1]
+
+   def column(self, name):
+      """Gets one column of the series as an array."""
+      return self.columns[self.COLUMNS.index(name)]
+
+   def between(self, start, end):
+      """Gets the part of the series from start to end inclusive.
+
+      Args:
+         start: The first date wanted.
+         end: The last date wanted.
+
+      Returns:
+         A PriceSeries.
+      """
+      days = self.column('date')
+      first = numpy.searchsorted(days, to_day(start), side='left')
+      last = numpy.searchsorted(days, to_day(end), side='right')
+      return PriceSeries(self.columns[:, first:last])
+
+   def concat(self, other):
+      """Gets this series followed by a later one."""
+      return PriceSeries(numpy.hstack((self.columns, other.columns)))
+
+   def merge(self, other):
+      """Gets the union of this series and another, taking the other's row
+         where both have a date.
+      """
+      both = numpy.hstack((other.columns, self.columns))
+      days, first = numpy.unique(both[0], return_index=True)
+      return PriceSeries(both[:, first])
+
+   def years(self):
+      """Splits the series by calendar year.
+
+      Returns:
+         A dictionary mapping years to PriceSeries.
+      """
+      years = numpy.array([from_day(day).year for day in self.column('date')], dtype=numpy.int64)
+      return dict((int(year), PriceSeries(self.columns[:, years == year]))
+         for year in numpy.unique(years))
+
+   def pack(self):
+      """Packs the series as binary for storage."""
+      return self.columns.astype(self.DTYPE).tostring()
+
+   @classmethod
+   def unpack(cls, data):
+      """Unpacks a series packed by pack."""
+      return cls(numpy.fromstring(data, dtype=cls.DTYPE).astype(numpy.int64))
+
+   def to_dict(self):
+      """Gets the series in the wire format of the history endpoint.
+
+      Returns:
+         A dictionary mapping each column name to a list: dates as
+         YYYY-MM-DD, prices in dollars and volumes.
+      """
+      series = {'date': [str(from_day(day)) for day in self.column('date')]}
+      for name in ['open', 'high', 'low', 'close']:
+         series[name] = (self.column(name) / 100.0).tolist()
+      series['volume'] = self.column('volume').tolist()
+      return series
+
+class PriceSeriesProperty(ndb.BlobProperty):
+   """Stores a PriceSeries instance as packed binary."""
+
+   def _validate(self, value):
+      if not isinstance(value, PriceSeries):
+         raise TypeError('Expected PriceSeries, got %r' % (value,))
+
+   def _to_base_type(self, value):
+      return value.pack()
+
+   def _from_base_type(self, value):
+      return PriceSeries.unpack(value)
+
+class PriceChunk(ndb.Model):
+   """Stores one year of the price history of a stock, keyed 'STOCK:YEAR'.
+
+   Attributes:
+      series: The PriceSeries of the year.
+   """
+   series = PriceSeriesProperty(compressed=True)
+
+   # Chunks are cached packed by PriceStore rather than by ndb
+   _use_memcache = False
+
+   @classmethod
+   def id_for(cls, stock, year):
+      """Gets the id of the chunk for a stock and year."""
+      return '%s:%d' % (stock, year)
+
+class PriceHistory(ndb.Model):
+   """Records which dates of a stock's history have been loaded, keyed by
+      stock code.
+
+   Attributes:
+      first: The first date loaded.
+      last: The last date loaded.
+      checked: When the source was last asked for dates after last.
+   """
+   first = ndb.DateProperty(indexed=False)
+   last = ndb.DateProperty(indexed=False)
+   checked = ndb.DateTimeProperty(indexed=False)
+
+class HistorySource(object):
+   """Provides the daily price history of stocks."""
+
+   def get_history(self, stock, start, end):
+      """Gets the price history of a stock.
+
+      Args:
+         stock: The stock code.
+         start: The first date wanted.
+         end: The last date wanted.
+
+      Returns:
+         A PriceSeries (empty if the source has none).
+      """
+      raise NotImplementedError
+
+   def get_histories(self, ranges):
+      """Gets the price history of several stocks and ranges at once.
+
+      Args:
+         ranges: A list of (stock, start, end) tuples.
+
+      Returns:
+         A list with the PriceSeries of each range, or None for a range that
+         could not be fetched.
+      """
+      return [self.get_history(stock, start, end) for (stock, start, end) in ranges]
+
+class YahooHistorySource(HistorySource):
+   """Fetches history from the Yahoo Finance historicaldata YQL table."""
+   BASE_URL = 'https://query.yahooapis.com/v1/public/yql'
+
+   # Seconds to wait for a response. Every range is fetched at once, so this
+   # is also about how long a request filling history waits.
+   DEADLINE = 20
+
+   def url(self, stock, start, end):
+      """Gets the YQL URL of the history of a stock."""
+      query = ('select * from yahoo.finance.historicaldata where symbol = "%s" '
+         'and startDate = "%s" and endDate = "%s"' % (stock, start, end))
+      return self.BASE_URL + '?' + urllib.urlencode({'q': query, 'format': 'json',
+         'diagnostics': 'false', 'env': 'store://datatables.org/alltableswithkeys'})
+
+   def get_history(self, stock, start, end):
+      series = self.get_histories([(stock, start, end)])[0]
+      return series if series is not None else PriceSeries()
+
+   def get_histories(self, ranges):
+      # The fetches run in parallel, so a cold chart of many stocks waits for
+      # the slowest response rather than for every response in turn
+      rpcs = []
+      for stock, start, end in ranges:
+         rpc = urlfetch.create_rpc(deadline=self.DEADLINE)
+         urlfetch.make_fetch_call(rpc, self.url(stock, start, end))
+         rpcs.append(rpc)
+      histories = []
+      for rpc in rpcs:
+         try:
+            histories.append(self.parse(rpc.get_result()))
+         except (urlfetch.Error, ValueError, KeyError, TypeError):
+            histories.append(None)
+      return histories
+
+   def parse(self, response):
+      """Gets the PriceSeries from a YQL response (empty if it is an error)."""
+      if response.status_code != 200:
+         return PriceSeries()
+      results = json.loads(response.content)['query']['results']
+      quotes = results['quote'] if results else []
+      # A single result is not wrapped in a list
+      if isinstance(quotes, dict):
+         quotes = [quotes]
+      return PriceSeries.from_rows([(parse_date(q['Date']), q['Open'], q['High'],
+         q['Low'], q['Close'], q['Volume']) for q in quotes])
+
+class FileHistorySource(HistorySource):
+   """Reads history from CSV files (Date,Open,High,Low,Close,Volume, as
+      downloaded from Yahoo) named <stock>.csv in a local directory.
+
+   Attributes:
+      directory: The directory of the CSV files.
+   """
+   def __init__(self, directory):
+      self.directory = directory
+
+   def get_history(self, stock, start, end):
+      path = os.path.join(self.directory, stock + '.csv')
+      if not os.path.exists(path):
+         return PriceSeries()
+      with open(path) as history_file:
+         rows = [(parse_date(row['Date']), row['Open'], row['High'], row['Low'],
+            row['Close'], row['Volume']) for row in csv.DictReader(history_file)]
+      return PriceSeries.from_rows(rows).between(start, end)
+
+_source = None
+
+def get_source():
+   """Gets the history source for this instance.
+
+   Set the HISTORY_SOURCE environment variable (in app.yaml) to
+   'file:<directory>' to load history from local CSV files instead of Yahoo.
+
+   Returns:
+      A HistorySource.
+   """
+   global _source
+   if _source is None:
+      setting = os.environ.get('HISTORY_SOURCE', '')
+      if setting.startswith('file:'):
+         _source = FileHistorySource(setting[len('file:'):])
+      else:
+         _source = YahooHistorySource()
+   return _source
+
+def set_source(source):
+   """Replaces the history source for this instance (e.g. for benchmarks)."""
+   global _source
+   _source = source
+
+class PriceStore(object):
+   """Reads price history from memcache and the datastore, loading any part
+      of the requested range that is missing from the history source.
+   """
+   PREFIX = 'history:'
+
+   # Seconds a chunk stays in memcache (chunks change at most once a day)
+   TTL = 24 * 60 * 60
+
+   def get(self, stocks, start, end):
+      """Gets the price history of stocks over a range of dates.
+
+      Args:
+         stocks: A list of stock codes.
+         start: The first date wanted.
+         end: The last date wanted.
+
+      Returns:
+         A dictionary mapping stock codes to PriceSeries.
+      """
+      return self.load(stocks, start, end)[0]
+
+   def load(self, stocks, start, end, max_fetch=None):
+      """Gets the price history of stocks over a range of dates, fetching the
+         missing history of at most some of the stocks.
+
+      Args:
+         stocks: A list of stock codes.
+         start: The first date wanted.
+         end: The last date wanted.
+         max_fetch: The most stocks to fetch history for, or None for every
+            stock. The others are fetched by a later call.
+
+      Returns:
+         A tuple of a dictionary mapping stock codes to PriceSeries, and a
+         list of the stocks whose history may be incomplete (not fetched, or
+         the fetch failed).
+      """
+      end = min(end, datetime.date.today())
+      unloaded = self.fill(stocks, start, end, max_fetch)
+      ids = [PriceChunk.id_for(stock, year) for stock in stocks
+         for year in range(start.year, end.year + 1)]
+      chunks = dict((chunk_id, PriceSeries.unpack(data)) for (chunk_id, data)
+         in memcache.get_multi(ids, key_prefix=self.PREFIX).iteritems())
+      missing = [chunk_id for chunk_id in ids if chunk_id not in chunks]
+      if missing:
+         stored = ndb.get_multi([ndb.Key(PriceChunk, chunk_id) for chunk_id in missing])
+         loaded = dict((chunk.key.id(), chunk.series) for chunk in stored if chunk)
+         memcache.set_multi(dict((chunk_id, series.pack()) for (chunk_id, series)
+            in loaded.iteritems()), time=self.TTL, key_prefix=self.PREFIX)
+         chunks.update(loaded)
+
+      history = {}
+      for stock in stocks:
+         series = PriceSeries()
+         for year in range(start.year, end.year + 1):
+            chunk = chunks.get(PriceChunk.id_for(stock, year))
+            if chunk is not None:
+               series = series.concat(chunk)
+         history[stock] = series.between(start, end)
+      return history, unloaded
+
+   def fill(self, stocks, start, end, max_fetch=None):
+      """Loads the parts of a range of dates not yet loaded for each stock.
+
+      Dates after the last one loaded are asked for at most once a day (and
+      again until the source has them). Every missing range is fetched from
+      the source at once, and a stock whose fetch fails is tried again on
+      the next request.
+
+      Args:
+         stocks: A list of stock codes.
+         start: The first date wanted.
+         end: The last date wanted.
+         max_fetch: The most stocks to fetch history for, or None for every
+            stock.
+
+      Returns:
+         A list of the stocks left with missing history.
+      """
+      today = datetime.date.today()
+      histories = ndb.get_multi([ndb.Key(PriceHistory, stock) for stock in stocks])
+      # The stocks with ranges to load, with their PriceHistory and ranges
+      missing = []
+      for stock, history in zip(stocks, histories):
+         if history is None:
+            history = PriceHistory(id=stock)
+            ranges = [(start, end)]
+         else:
+            ranges = []
+            if start < history.first:
+               ranges.append((start, history.first - datetime.timedelta(days=1)))
+            if (end > history.last and
+               (history.checked is None or history.checked.date() < today)):
+               ranges.append((history.last + datetime.timedelta(days=1), end))
+         if ranges:
+            missing.append((stock, history, ranges))
+      unloaded = []
+      if max_fetch is not None:
+         unloaded = [stock for (stock, history, ranges) in missing[max_fetch:]]
+         missing = missing[:max_fetch]
+
+      fetched = iter(get_source().get_histories([(stock, first, last)
+         for (stock, history, ranges) in missing for (first, last) in ranges]))
+      changed = []
+      for stock, history, ranges in missing:
+         loaded = []
+         failed = False
+         for (first, last) in ranges:
+            series = next(fetched)
+            if series is None:
+               failed = True
+               continue
+            self.add(stock, series)
+            if len(series):
+               loaded.append(from_day(series.column('date')[-1]))
+         if failed:
+            unloaded.append(stock)
+            continue
+         history.first = min(start, history.first or start)
+         history.last = max(loaded + [history.last or start - datetime.timedelta(days=1)])
+         history.checked = datetime.datetime.now()
+         changed.append(history)
+      ndb.put_multi(changed)
+      return unloaded
+
+   def add(self, stock, series):
+      """Merges new history into the stored chunks of a stock.
+
+      Args:
+         stock: The stock code.
+         series: A PriceSeries.
+      """
+      years = series.years()
+      if not years:
+         return
+      keys = [ndb.Key(PriceChunk, PriceChunk.id_for(stock, year)) for year in sorted(years)]
+      chunks = []
+      for year, key, chunk in zip(sorted(years), keys, ndb.get_multi(keys)):
+         if chunk is None:
+            chunk = PriceChunk(key=key, series=years[year])
+         else:
+            chunk.series = chunk.series.merge(years[year])
+         chunks.append(chunk)
+      ndb.put_multi(chunks)
+      memcache.set_multi(dict((chunk.key.id(), chunk.series.pack()) for chunk in chunks),
+         time=self.TTL, key_prefix=self.PREFIX)
+
+# The price store for this instance
+PRICES = PriceStore()
@@ -0,0 +1,253 @@
+"""Intraday Bars
+
+   This module aggregates the quote snapshot the cron fetches each minute into
+   one minute OHLC and spread bars for every stock. The bars of the last few
+   minutes are kept in a fixed-size ring buffer in memcache, and the batch of
+   minutes being recorded is stored as one compact entity on every tick, so
+   that intraday charts (and audits of when stop orders triggered) are served
+   from data already fetched. A ring evicted from memcache is read back from
+   the stored batch, and no bar is lost with it.
+"""
+
+import datetime
+import logging
+
+import numpy
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+# The market is in Sydney (AEDT, GMT +11:00)
+SYDNEY_OFFSET = datetime.timedelta(hours=11)
+
+# The bar fields, each held in cents
+FIELDS = ['open', 'high', 'low', 'close', 'spread']
+
+def to_price(value):
+   """Converts a quoted dollar price to integer cents, or 0 if it is not
+      usable.
+   """
+   try:
+      return max(int(round(float(value) * 100)), 0)
+   except (TypeError, ValueError):
+      return 0
+
+class IntradayBatch(ndb.Model):
+   """Stores the bars of every stock for one batch of minutes of a trading
+      day, keyed 'YYYY-MM-DD:batch'.
+
+   Attributes:
+      day: The trading day.
+      symbols: The stock codes, in the order of the bars.
+      minutes: The packed minutes of the day (since midnight) of the bars.
+      bars: The packed bars, an array of FIELDS by symbols by minutes.
+   """
+   day = ndb.DateProperty(required=True)
+   symbols = ndb.StringProperty(repeated=True, indexed=False)
+   minutes = ndb.BlobProperty()
+   bars = ndb.BlobProperty(compressed=True)
+
+   # Arrays are packed as little-endian 32 bit integers
+   DTYPE = numpy.dtype('<i4')
+
+   @classmethod
+   def id_for(cls, day, batch):
+      """Gets the key name of a batch of a trading day."""
+      return '%s:%d' % (day, batch)
+
+   @classmethod
+   def new(cls, day, batch, symbols, minutes, bars):
+      """Creates (but does not store) the entity for a batch of bars."""
+      return cls(id=cls.id_for(day, batch), day=day, symbols=symbols,
+         minutes=minutes.astype(cls.DTYPE).tostring(),
+         bars=bars.astype(cls.DTYPE).tostring())
+
+   def unpack(self):
+      """Unpacks the batch.
+
+      Returns:
+         A tuple of the minutes and the bars arrays.
+      """
+      minutes = numpy.fromstring(self.minutes, dtype=self.DTYPE).astype(numpy.int64)
+      bars = numpy.fromstring(self.bars, dtype=self.DTYPE).astype(numpy.int64)
+      return minutes, bars.reshape(len(FIELDS), len(self.symbols), len(minutes))
+
+class BarBuffer(object):
+   """The bars of the last SLOTS minutes of a trading day, as a ring buffer
+      indexed by minute of the day.
+
+   Attributes:
+      day: The trading day.
+      symbols: The stock codes, in the order of the bars.
+      minutes: The minute of the day held in each slot (-1 if empty).
+      bars: An integer array of FIELDS by symbols by slots.
+      flushed: The last batch persisted complete.
+   """
+   # Slots in the ring (at least two batches, so that the previous batch is
+   # still in it while the next one starts)
+   SLOTS = 32
+
+   # Minutes persisted together
+   BATCH = 15
+
+   def __init__(self, day, symbols):
+      self.day = day
+      self.symbols = list(symbols)
+      self.minutes = numpy.zeros(self.SLOTS, dtype=numpy.int64) - 1
+      self.bars = numpy.zeros((len(FIELDS), len(self.symbols), self.SLOTS), dtype=numpy.int64)
+      self.flushed = -1
+
+   @classmethod
+   def restore(cls, stored, batch):
+      """Creates a ring holding the bars of a stored batch.
+
+      Args:
+         stored: The IntradayBatch entity.
+         batch: The number of the batch.
+
+      Returns:
+         The BarBuffer.
+      """
+      buffer = cls(stored.day, stored.symbols)
+      minutes, bars = stored.unpack()
+      slots = minutes % cls.SLOTS
+      buffer.minutes[slots] = minutes
+      buffer.bars[:, :, slots] = bars
+      buffer.flushed = batch - 1
+      return buffer
+
+   def add(self, minute, prices, spreads):
+      """Adds a snapshot to the bar for its minute.
+
+      Args:
+         minute: The minute of the day.
+         prices: An integer array of each stock's price in cents (0 if it
+            has none).
+         spreads: An integer array of each stock's spread in cents.
+      """
+      slot = minute % self.SLOTS
+      quoted = prices > 0
+      if self.minutes[slot] != minute:
+         self.minutes[slot] = minute
+         self.bars[:, :, slot] = 0
+      bars = self.bars[:, :, slot]
+      # A stock's first price of the minute opens its bar
+      opening = quoted & (bars[0] == 0)
+      bars[0] = numpy.where(opening, prices, bars[0])
+      bars[1] = numpy.where(quoted, numpy.maximum(bars[1], prices), bars[1])
+      bars[2] = numpy.where(quoted & ((bars[2] == 0) | (prices < bars[2])), prices, bars[2])
+      bars[3] = numpy.where(quoted, prices, bars[3])
+      bars[4] = numpy.where(quoted, spreads, bars[4])
+
+   def batch(self, batch):
+      """Gets the bars of one batch of minutes held in the ring.
+
+      Returns:
+         A tuple of the minutes (in order) and the bars arrays.
+      """
+      slots = numpy.nonzero((self.minutes >= 0) & (self.minutes // self.BATCH == batch))[0]
+      slots = slots[numpy.argsort(self.minutes[slots])]
+      return self.minutes[slots], self.bars[:, :, slots]
+
+   def unflushed(self):
+      """Gets the bars in the ring not yet persisted, as for batch."""
+      slots = numpy.nonzero((self.minutes >= 0) & (self.minutes // self.BATCH > self.flushed))[0]
+      slots = slots[numpy.argsort(self.minutes[slots])]
+      return self.minutes[slots], self.bars[:, :, slots]
+
+   def flush(self, batch):
+      """Gets the entity of a batch in the ring as it stands, marking the
+         batches before it persisted.
+
+      Args:
+         batch: The batch being recorded.
+
+      Returns:
+         The IntradayBatch entity, to be stored.
+      """
+      minutes, bars = self.batch(batch)
+      self.flushed = max(self.flushed, batch - 1)
+      return IntradayBatch.new(self.day, batch, self.symbols, minutes, bars)
+
+class IntradayBars(object):
+   """Records the cron's quote snapshots as bars and reads them back."""
+   BUFFER_KEY = 'intraday:buffer'
+
+   def record(self, share_dict, now=None):
+      """Adds a quote snapshot to the current bars, and stores the batch of
+         minutes it is in.
+
+      Each tick stores its whole batch, so a batch is complete in the
+      datastore once its last minute is recorded. If the ring is missing
+      from memcache during a day, it is restored from the stored batch.
+
+      Args:
+         share_dict: A dictionary mapping stock codes to their quote.
+         now: The UTC time of the snapshot (by default the current time).
+      """
+      local = (now or datetime.datetime.utcnow()) + SYDNEY_OFFSET
+      day = local.date()
+      minute = local.hour * 60 + local.minute
+
+      batch = minute // BarBuffer.BATCH
+
+      buffer = memcache.get(self.BUFFER_KEY)
+      if buffer is None or buffer.day != day:
+         stored = IntradayBatch.get_by_id(IntradayBatch.id_for(day, batch))
+         if stored is not None:
+            logging.warning('Intraday bars missing from memcache, restored batch %s',
+               stored.key.id())
+            buffer = BarBuffer.restore(stored, batch)
+         else:
+            buffer = BarBuffer(day, sorted(share_dict.keys()))
+
+      quotes = [share_dict.get(symbol, {}) for symbol in buffer.symbols]
+      prices = numpy.array([to_price(quote.get('LastTradePriceOnly')) for quote in quotes])
+      bids = numpy.array([to_price(quote.get('Bid')) for quote in quotes])
+      asks = numpy.array([to_price(quote.get('Ask')) for quote in quotes])
+      spreads = numpy.where((bids > 0) & (asks > 0), asks - bids, 0)
+      buffer.add(minute, prices, spreads)
+
+      buffer.flush(batch).put()
+      memcache.set(self.BUFFER_KEY, buffer)
+
+   def get(self, symbol, day):
+      """Gets the bars of one stock for a trading day.
+
+      Args:
+         symbol: The stock code.
+         day: The trading day.
+
+      Returns:
+         A dictionary of lists, one entry per minute with a quote: 'time'
+         (HH:MM, Sydney time) and each of FIELDS in dollars.
+      """
+      # The ring comes first, so that its bars win over a stored batch the
+      # query may not see the latest version of yet
+      parts = []
+      buffer = memcache.get(self.BUFFER_KEY)
+      if buffer is not None and buffer.day == day and symbol in buffer.symbols:
+         minutes, bars = buffer.unflushed()
+         parts.append((minutes, bars[:, buffer.symbols.index(symbol)]))
+      for batch in IntradayBatch.query(IntradayBatch.day == day):
+         if symbol in batch.symbols:
+            minutes, bars = batch.unpack()
+            parts.append((minutes, bars[:, batch.symbols.index(symbol)]))
+
+      if parts:
+         minutes = numpy.concatenate([part[0] for part in parts])
+         bars = numpy.hstack([part[1] for part in parts])
+      else:
+         minutes = numpy.zeros(0, dtype=numpy.int64)
+         bars = numpy.zeros((len(FIELDS), 0), dtype=numpy.int64)
+      # One bar per minute in order, leaving out minutes without a quote
+      minutes, first = numpy.unique(minutes, return_index=True)
+      bars = bars[:, first]
+      quoted = bars[3] > 0
+      series = {'time': ['%02d:%02d' % (m // 60, m % 60) for m in minutes[quoted]]}
+      for i, field in enumerate(FIELDS):
+         series[field] = (bars[i][quoted] / 100.0).tolist()
+      return series
+
+# The intraday bars of the application
+BARS = IntradayBars()
@@ -0,0 +1,202 @@
+"""Leaderboard Model Classes
+
+   This module contains the ranked snapshot of every player's portfolio value
+   shown on the leaderboard. Snapshots are built in the background after each
+   execution run, so that serving the leaderboard is a read of one page.
+"""
+
+import numpy
+
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from py.transaction import *
+from py.player import *
+from py.position import *
+from py.quotes import *
+
+class LeaderboardSnapshot(ndb.Model):
+   """A ranking of every player at a point in time.
+
+   The ranked rows are split into LeaderboardPage children of PAGE_SIZE rows
+   each, so that a page or a single player's rank is read without loading the
+   whole snapshot.
+
+   Attributes:
+      created: The time the snapshot was built.
+      count: The number of players ranked.
+      complete: Whether every page has been written.
+   """
+   created = ndb.DateTimeProperty(auto_now_add=True)
+   count = ndb.IntegerProperty(default=0, indexed=False)
+   complete = ndb.BooleanProperty(default=False)
+
+   PAGE_SIZE = 100
+
+   # The number of snapshots kept (older ones are deleted)
+   KEEP = 2
+
+   CURRENT_KEY = 'leaderboard:current'
+
+   # Held while the first snapshot is being built, so that it is only
+   # requested once
+   BUILDING_KEY = 'leaderboard:building'
+   BUILDING_SECONDS = 60
+
+   @classmethod
+   def build(cls):
+      """Marks every player to market and stores the ranking as a new snapshot.
+
+      Holdings are read from every Position at once and valued as a sparse
+      players x stocks quantity matrix multiplied by the quote vector.
+
+      Returns:
+         The new LeaderboardSnapshot.
+      """
+      players = []
+      for player in Player.query():
+         if not player.ledger:
+            player.rebuild_positions()
+         players.append(player)
+      index = dict((player.key, i) for (i, player) in enumerate(players))
+
+      # Coordinates and values of the non-zero entries of the quantity matrix
+      rows, stocks, quantities, costs = [], [], [], []
+      for position in Position.query():
+         i = index.get(position.key.parent())
+         if i is not None and position.quantity > 0:
+            rows.append(i)
+            stocks.append(position.stock)
+            quantities.append(position.quantity)
+            costs.append(position.purchase_price())
+      symbols = sorted(set(stocks))
+      columns = dict((symbol, j) for (j, symbol) in enumerate(symbols))
+      quotes = QUOTES.get(symbols)
+      prices = numpy.array([float(quotes[s]['LastTradePriceOnly'])
+         if s in quotes else numpy.nan for s in symbols])
+
+      n = len(players)
+      rows = numpy.array(rows, dtype=numpy.int64)
+      quantities = numpy.array(quantities, dtype=numpy.float64)
+      values = prices[numpy.array([columns[s] for s in stocks], dtype=numpy.int64)]
+      # Without a quote a holding is valued at what was paid for it
+      values = numpy.where(numpy.isnan(values), numpy.array(costs), values)
+      # bincount fails on an empty array in older versions of numpy
+      shares = numpy.zeros(n)
+      if len(rows):
+         shares += numpy.bincount(rows, weights=quantities * values, minlength=n)
+
+      pending = numpy.zeros(n)
+      legacy = None
+      for order in Transaction.query(Transaction.executed == False):
+         if order.type != 'buy':
+            continue
+         owner = order.owner
+         if owner is None:
+            # Orders placed before owners were recorded
+            if legacy is None:
+               legacy = dict((key, player.key) for player in players
+                  for key in player.transactions)
+            owner = legacy.get(order.key)
+         if owner in index:
+            pending[index[owner]] += order.price * order.quantity
+
+      cash = numpy.array([player.cash for player in players])
+      total = cash + shares + pending
+      ranking = numpy.argsort(-total, kind='mergesort')
+
+      snapshot = cls(count=n)
+      snapshot.put()
+      pages = []
+      for start in range(0, n, cls.PAGE_SIZE):
+         page_rows = []
+         for i in ranking[start:start + cls.PAGE_SIZE]:
+            player = players[i]
+            page_rows.append([player.email, player.cash, getattr(player, 'nickname', None),
+               str(player.birthday.isoformat()), float(shares[i]), float(pending[i]),
+               float(total[i])])
+         pages.append(LeaderboardPage(parent=snapshot.key, id=start // cls.PAGE_SIZE + 1,
+            rows=page_rows, emails=[row[0] for row in page_rows]))
+      ndb.put_multi(pages)
+      snapshot.complete = True
+      snapshot.put()
+      memcache.set(cls.CURRENT_KEY, snapshot.key.id())
+
+      # Remove old snapshots
+      for old in cls.query().order(-cls.created).fetch(offset=cls.KEEP, keys_only=True):
+         ndb.delete_multi(LeaderboardPage.query(ancestor=old).fetch(keys_only=True) + [old])
+      return snapshot
+
+   @classmethod
+   def current(cls):
+      """Gets the most recent complete snapshot.
+
+      Snapshots are only built by the leaderboard task. If none exists yet,
+      the task is enqueued (once) rather than building one in the request.
+
+      Returns:
+         A LeaderboardSnapshot, or None if none has been built yet.
+      """
+      snapshot_id = memcache.get(cls.CURRENT_KEY)
+      snapshot = cls.get_by_id(snapshot_id) if snapshot_id else None
+      if snapshot is None:
+         snapshot = cls.query(cls.complete == True).order(-cls.created).get()
+         if snapshot is None:
+            if memcache.add(cls.BUILDING_KEY, 1, time=cls.BUILDING_SECONDS):
+               taskqueue.add(url='/tasks/leaderboard')
+            return None
+         memcache.set(cls.CURRENT_KEY, snapshot.key.id())
+      return snapshot
+
+   def page(self, offset, limit):
+      """Gets a range of ranked rows.
+
+      Args:
+         offset: The number of rows to skip (0 is the top ranked player).
+         limit: The maximum number of rows to return.
+
+      Returns:
+         A list of rows [email, cash, nickname, birthday, shares, pending,
+         total, rank].
+      """
+      offset = max(offset, 0)
+      end = min(offset + limit, self.count)
+      if end <= offset:
+         return []
+      first = offset // self.PAGE_SIZE
+      last = (end - 1) // self.PAGE_SIZE
+      keys = [ndb.Key(LeaderboardPage, number + 1, parent=self.key)
+         for number in range(first, last + 1)]
+      rows = []
+      for page in ndb.get_multi(keys):
+         rows.extend(page.rows if page else [])
+      start = offset - first * self.PAGE_SIZE
+      return [row + [offset + i + 1]
+         for (i, row) in enumerate(rows[start:start + end - offset])]
+
+   def rank_of(self, email):
+      """Looks up a single player's row.
+
+      Args:
+         email: The player's email.
+
+      Returns:
+         The player's row (as for page), or None if they are not ranked.
+      """
+      page = LeaderboardPage.query(LeaderboardPage.emails == email,
+         ancestor=self.key).get()
+      if page is None:
+         return None
+      i = page.emails.index(email)
+      return page.rows[i] + [(page.key.id() - 1) * self.PAGE_SIZE + i + 1]
+
+class LeaderboardPage(ndb.Model):
+   """One page of ranked rows in a LeaderboardSnapshot.
+
+   Attributes:
+      rows: The ranked rows [email, cash, nickname, birthday, shares, pending,
+         total].
+      emails: The email of each row, indexed so a player's page can be found.
+   """
+   rows = ndb.JsonProperty(compressed=True)
+   emails = ndb.StringProperty(repeated=True)
@@ -0,0 +1,272 @@
+"""Request Metrics
+
+   This module measures where requests spend their time. A WSGI middleware
+   times every request by route, and hooks on the App Engine API proxy count
+   and time each datastore, memcache and urlfetch call it makes (and memcache
+   hits and misses). Each request writes one structured log line, and the
+   totals are kept per instance as counters and latency histograms, shared
+   through memcache for the admin metrics page.
+
+   The hooks only add a clock read and a few dictionary updates per call, so
+   the metrics are always on.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import webapp2
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+# The upper bounds (in milliseconds) of the latency histogram buckets; the
+# last bucket counts everything slower
+BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+# The services whose calls are counted
+SERVICES = ['datastore_v3', 'memcache', 'urlfetch', 'taskqueue']
+
+def bucket(ms):
+   """Gets the index of the histogram bucket of a latency."""
+   for i, bound in enumerate(BUCKETS_MS):
+      if ms <= bound:
+         return i
+   return len(BUCKETS_MS)
+
+def new_series():
+   """Creates the empty totals of one route (see Metrics)."""
+   return {'requests': 0, 'errors': 0, 'ms': 0.0, 'histogram': [0] * (len(BUCKETS_MS) + 1),
+      'calls': {}, 'memcache_hits': 0, 'memcache_misses': 0}
+
+def merge_series(total, series):
+   """Adds the totals of one series to another."""
+   for name in ['requests', 'errors', 'ms', 'memcache_hits', 'memcache_misses']:
+      total[name] += series[name]
+   total['histogram'] = [a + b for (a, b) in zip(total['histogram'], series['histogram'])]
+   for call, (count, ms) in series['calls'].iteritems():
+      counted = total['calls'].setdefault(call, [0, 0.0])
+      counted[0] += count
+      counted[1] += ms
+
+class RequestStats(object):
+   """The calls made by one request.
+
+   Attributes:
+      route: The name of the handler method serving the request.
+      tags: Details the handler added to the route (e.g. the information
+         asked for), each counted as a series of its own.
+      calls: A dictionary mapping 'service.Call' to its count and total
+         milliseconds.
+      memcache_hits: The keys found by memcache gets.
+      memcache_misses: The keys not found by memcache gets.
+      started: The start time of each call in progress, by response id.
+   """
+   def __init__(self, route):
+      self.route = route
+      self.tags = []
+      self.calls = {}
+      self.memcache_hits = 0
+      self.memcache_misses = 0
+      self.started = {}
+
+class Metrics(object):
+   """The totals of every route served by this instance since it started.
+
+   Attributes:
+      series: A dictionary mapping route names (and 'route:tag') to their
+         totals: requests, errors (5xx), total milliseconds, a histogram of
+         the milliseconds of each request (see BUCKETS_MS), each API call's
+         count and milliseconds, and memcache hits and misses.
+      calls: A dictionary mapping 'service.Call' to a histogram of the
+         milliseconds of each call, over every request.
+      published: When the totals were last shared through memcache.
+   """
+   PREFIX = 'metrics:'
+   INDEX_KEY = 'metrics:instances'
+
+   # Seconds between sharing the totals
+   PUBLISH_SECONDS = 30
+
+   # Seconds the totals of an instance that stops sharing them are kept
+   TTL = 10 * 60
+
+   def __init__(self):
+      self.series = {}
+      self.calls = {}
+      self.published = time.time()
+      self.lock = threading.Lock()
+      self.local = threading.local()
+      self.instance = os.environ.get('INSTANCE_ID', str(id(self)))
+
+   def current(self):
+      """Gets the RequestStats of the request on this thread, or None."""
+      return getattr(self.local, 'stats', None)
+
+   def begin(self, route):
+      """Starts counting the calls of a request on this thread."""
+      self.local.stats = RequestStats(route)
+      return self.local.stats
+
+   def end(self, stats, status, ms):
+      """Adds a completed request to the totals and logs it.
+
+      Args:
+         stats: The request's RequestStats.
+         status: The HTTP status code of the response.
+         ms: The wall time of the request in milliseconds.
+      """
+      self.local.stats = None
+      logging.info('metrics %s', json.dumps({'route': stats.route, 'tags': stats.tags,
+         'status': status, 'ms': round(ms, 1), 'calls': stats.calls,
+         'memcache_hits': stats.memcache_hits, 'memcache_misses': stats.memcache_misses},
+         sort_keys=True))
+      with self.lock:
+         names = [stats.route] + ['%s:%s' % (stats.route, tag) for tag in stats.tags]
+         for name in names:
+            series = self.series.setdefault(name, new_series())
+            series['requests'] += 1
+            series['errors'] += 1 if status >= 500 else 0
+            series['ms'] += ms
+            series['histogram'][bucket(ms)] += 1
+            series['memcache_hits'] += stats.memcache_hits
+            series['memcache_misses'] += stats.memcache_misses
+            for call, (count, call_ms) in stats.calls.iteritems():
+               counted = series['calls'].setdefault(call, [0, 0.0])
+               counted[0] += count
+               counted[1] += call_ms
+         publish = time.time() - self.published >= self.PUBLISH_SECONDS
+         if publish:
+            self.published = time.time()
+            snapshot = self.snapshot()
+      if publish:
+         self.publish(snapshot)
+
+   def before_call(self, service, call, request, response):
+      """Notes the start of an API call (an API proxy pre-call hook)."""
+      stats = self.current()
+      if stats is not None:
+         stats.started[id(response)] = time.time()
+
+   def after_call(self, service, call, request, response, rpc, error):
+      """Counts a completed API call (an API proxy post-call hook)."""
+      stats = self.current()
+      if stats is None:
+         return
+      started = stats.started.pop(id(response), None)
+      ms = (time.time() - started) * 1000 if started is not None else 0.0
+      name = '%s.%s' % (service, call)
+      counted = stats.calls.setdefault(name, [0, 0.0])
+      counted[0] += 1
+      counted[1] += ms
+      if (service == 'memcache' and call == 'Get' and error is None):
+         hits = response.item_size()
+         stats.memcache_hits += hits
+         stats.memcache_misses += request.key_size() - hits
+      with self.lock:
+         histogram = self.calls.setdefault(name, [0] * (len(BUCKETS_MS) + 1))
+         histogram[bucket(ms)] += 1
+
+   def snapshot(self):
+      """Gets a copy of this instance's totals."""
+      return json.loads(json.dumps({'series': self.series, 'calls': self.calls}))
+
+   def publish(self, snapshot):
+      """Shares this instance's totals through memcache."""
+      memcache.set(self.PREFIX + self.instance, snapshot, time=self.TTL)
+      client = memcache.Client()
+      for attempt in range(3):
+         index = client.gets(self.INDEX_KEY)
+         if index is None:
+            if client.add(self.INDEX_KEY, {self.instance: time.time()}):
+               return
+            continue
+         index = dict((instance, seen) for (instance, seen) in index.iteritems()
+            if seen > time.time() - self.TTL)
+         index[self.instance] = time.time()
+         if client.cas(self.INDEX_KEY, index):
+            return
+
+   def collect(self):
+      """Gets the totals of every instance that has shared them recently,
+         with this instance's current totals.
+
+      Returns:
+         A dictionary of the merged 'series' and 'calls', the 'instances'
+         counted and the histogram 'buckets_ms'.
+      """
+      index = memcache.get(self.INDEX_KEY) or {}
+      snapshots = memcache.get_multi([instance for instance in index
+         if instance != self.instance], key_prefix=self.PREFIX).values()
+      with self.lock:
+         snapshots.append(self.snapshot())
+      merged = {'series': {}, 'calls': {}, 'instances': len(snapshots),
+         'buckets_ms': BUCKETS_MS}
+      for snapshot in snapshots:
+         for name, series in snapshot['series'].iteritems():
+            merge_series(merged['series'].setdefault(name, new_series()), series)
+         for name, histogram in snapshot['calls'].iteritems():
+            total = merged['calls'].setdefault(name, [0] * (len(BUCKETS_MS) + 1))
+            merged['calls'][name] = [a + b for (a, b) in zip(total, histogram)]
+      return merged
+
+# The metrics of this instance
+METRICS = Metrics()
+
+def install_hooks():
+   """Hooks the metrics into every API call of the counted services (once
+      per instance).
+   """
+   for service in SERVICES:
+      apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+         'metrics_' + service, METRICS.before_call, service)
+      apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+         'metrics_' + service, METRICS.after_call, service)
+
+def tag_request(*tags):
+   """Adds details to the route of the current request, each of which is
+      also counted as a series of its own (e.g. the information asked for).
+   """
+   stats = METRICS.current()
+   if stats is not None:
+      stats.tags.extend(tags)
+
+class MetricsMiddleware(object):
+   """Measures every request of a WSGI application.
+
+   Attributes:
+      app: The WSGI application.
+      router: The webapp2 Router of the application, used to name the route
+         of each request after its handler.
+   """
+   def __init__(self, app, router):
+      self.app = app
+      self.router = router
+
+   def route(self, environ):
+      """Gets the name of the handler method serving a request."""
+      request = webapp2.Request(environ)
+      try:
+         route, args, kwargs = self.router.match(request)
+      except Exception:
+         return 'unmatched'
+      handler = getattr(route.handler, '__name__', str(route.handler))
+      return '%s.%s' % (handler, request.method.lower())
+
+   def __call__(self, environ, start_response):
+      started = time.time()
+      stats = METRICS.begin(self.route(environ))
+      statuses = []
+      def record(status, headers, exc_info=None):
+         statuses.append(int(status[:3]))
+         return start_response(status, headers, exc_info)
+      try:
+         return self.app(environ, record)
+      except:
+         statuses.append(500)
+         raise
+      finally:
+         METRICS.end(stats, statuses[-1] if statuses else 500,
+            (time.time() - started) * 1000)
@@ -5,68 +5,230 @@
 
 import webapp2
 import json
+import base64
 from py.transaction import *
+from py.quotes import *
+from py.position import *
+from py.unit import *
 from google.appengine.ext import ndb
-from google.appengine.api import memcache
-from google.appengine.api import urlfetch
+from google.appengine.api import datastore_errors
 import webapp2_extras.appengine.auth.models as auth_models
 from webapp2_extras import auth, sessions, security
 from datetime import timedelta
 
+class PlayerSnapshot(object):
+   """The player's transactions and positions, loaded once and shared by every
+      accessor that derives a view from them.
+
+   A snapshot lives on the Player instance, which is loaded once per request,
+   so a request reads each of them at most once however many views it asks
+   for. Each is read on first use, so that views of the holdings only read
+   the Position records and never the transaction history. The snapshot is
+   discarded whenever the player places or cancels an order.
+
+   Attributes:
+      player: The Player the snapshot belongs to.
+      cached_transactions: The player's Transaction model instances, oldest
+         first, or None until they are first used.
+      cached_by_status: A dictionary mapping execution statuses to the
+         transactions with that status, for those read on their own.
+   """
+   def __init__(self, player):
+      self.player = player
+      self.cached_transactions = None
+      self.cached_by_status = {}
+      self.cached_positions = None
+
+   def transactions(self):
+      """Gets all of the player's transactions, oldest first, loading them on
+         first use.
+      """
+      if self.cached_transactions is None:
+         if self.player.transactions:
+            # Transactions still listed on the player are moved out first
+            self.cached_transactions = sorted(self.player.migrate_transactions(),
+               key=lambda t: t.timestamp)
+         else:
+            self.cached_transactions = Transaction.for_owner(self.player.key).fetch()
+      return self.cached_transactions
+
+   def by_status(self, executed):
+      """Gets the transactions with a given execution status, oldest first.
+
+      Only the transactions with the status are read, unless the whole
+      history has been already (e.g. pending orders are read without the
+      executed ones).
+      """
+      if (self.cached_transactions is not None or self.player.transactions):
+         return [t for t in self.transactions() if t.executed == executed]
+      if executed not in self.cached_by_status:
+         self.cached_by_status[executed] = Transaction.for_owner(self.player.key,
+            executed=executed).fetch()
+      return self.cached_by_status[executed]
+
+   def positions(self):
+      """Gets the player's Position records, loading them on first use."""
+      if self.cached_positions is None:
+         self.cached_positions = self.player.get_stored_positions()
+      return self.cached_positions
+
 class Player(auth_models.User):
    """Stores game related information for the player.
 
    Attributes:
       email: The player's email, used to uniquely identify.
       cash: The amount of cash currently held. Initially this is $50,000.
-      transactions: A list of Transaction objects representing the player's
-         historical transactions.
+      transactions: Legacy list of the keys of the player's transactions.
+         Transactions now record their owner instead, and keys left here are
+         moved out by migrate_transactions.
       birthday: The time the player was created in the system.
+      ledger: Whether the player's Position records have been built. Players
+         created before positions existed have them built on first read.
    """
    email = ndb.StringProperty(required=True)
    cash = ndb.FloatProperty(required=True)
    transactions = ndb.KeyProperty(kind='Transaction', repeated=True)
    birthday = ndb.DateTimeProperty(auto_now_add=True, required=True)
+   ledger = ndb.BooleanProperty(default=False)
 
-   @classmethod
-   def get_leaderboard(cls):
-      """Gets information on all players for display on the leaderboard.
+   # The most orders placed at once. Each transaction is an entity group of
+   # its own and a cross-group transaction spans at most 25 groups, one of
+   # them being the player with their positions.
+   MAX_ORDERS = 24
+
+   def add_transaction(self, transaction):
+      """Records a new transaction placed by this player.
+
+      Args:
+         transaction: A Transaction model instance.
+      """
+      self.place_transactions([transaction])
+
+   def place_orders(self, orders):
+      """Validates a batch of orders and places the valid ones.
+
+      Each order is checked against the cash and sellable shares left by the
+      orders before it, so a batch (e.g. rebalancing the portfolio) can sell
+      shares and spend the proceeds' worth of cash held now.
+
+      Args:
+         orders: A list of order dictionaries (see Transaction.from_order).
 
       Returns:
-         A dictionary mapping a players email to their game information.
+         A list with a tuple for each order: the placed Transaction (None if
+         the order was rejected) and the reason it was rejected (None if it
+         was placed).
+
+      Raises:
+         ValueError: If there are more than MAX_ORDERS orders.
       """
-      leaderboard = {}
-      players = Player.query()
-      if players:
-         for player in players:
-            # find the total share values of a player
-            playerShares = player.get_shares()
-            if (len(playerShares) > 0):
-               shares = player.get_total_shares_value(playerShares)
-            else:
-               shares = 0
-            if player.get_transactions(executed=False):
-               pending = player.get_pending_shares_value()
+      if len(orders) > self.MAX_ORDERS:
+         raise ValueError('At most %d orders can be placed at once' % self.MAX_ORDERS)
+      if not self.ledger:
+         self.rebuild_positions()
+      transactions = [Transaction.from_order(order) for order in orders]
+      valid = [t for t in transactions if t is not None]
+      errors = iter(self.place_transactions(valid, check=True) if valid else [])
+      results = []
+      for transaction in transactions:
+         error = 'Invalid order' if transaction is None else next(errors)
+         results.append((None if error else transaction, error))
+      return results
+
+   def place_transactions(self, transactions, check=False):
+      """Records new transactions placed by this player, writing them with
+         the player and their positions in one cross-group transaction.
+
+      The player and their positions are read again in the transaction and
+      the orders applied to them as stored, so that fills and cancellations
+      made meanwhile are kept.
+
+      Args:
+         transactions: A list of at most MAX_ORDERS Transaction model
+            instances.
+         check: Whether to reject an order the player cannot afford: a buy
+            costing more than the cash left, or a sell of more shares than
+            are held and not already reserved by the orders before it.
+
+      Returns:
+         A list with the reason each transaction was rejected, or None for
+         each one placed.
+      """
+      stocks = sorted(set(t.stock for t in transactions))
+      keys = [Position.key_for(self.key, stock) for stock in stocks]
+
+      @ndb.transactional(xg=True)
+      def txn():
+         player = self.key.get()
+         positions = dict((stock, position or Position(key=key, stock=stock))
+            for (stock, key, position) in zip(stocks, keys, ndb.get_multi(keys)))
+         errors = []
+         placed = []
+         for transaction in transactions:
+            position = positions[transaction.stock]
+            if (check and transaction.type == 'buy' and
+               player.cash < transaction.price * transaction.quantity + transaction.fee):
+               errors.append('Not enough cash')
+               continue
+            if (check and transaction.type == 'sell' and
+               position.quantity - position.reserved < transaction.quantity):
+               errors.append('Not enough shares')
+               continue
+            transaction.owner = self.key
+            # Takes out the transaction fee for any transaction
+            player.cash = player.cash - transaction.fee
+            # Updates the cash immediately for the buy order (any changes in the price
+            # are handled by a refund process later)
+            if (transaction.type == 'buy' and transaction.executed == False):
+               player.apply_cash(-transaction.price, transaction)
             else:
-               pending = 0
-            total = player.cash + shares + pending
-            leaderboard[player.email] = [player.cash, player.nickname, str(player.birthday.isoformat()), shares, pending, total]
-      return leaderboard
+               transaction.cashHistory = player.cash
+            position.place(transaction)
+            placed.append(transaction)
+            errors.append(None)
+         if placed:
+            changed = [positions[stock] for stock in set(t.stock for t in placed)]
+            ndb.put_multi([player] + changed + placed)
+         return player, errors
+
+      player, errors = txn()
+      # This instance carries on for the rest of the request as stored
+      self.cash = player.cash
+      self.discard_snapshot()
+      return errors
+
+   def snapshot(self):
+      """Gets the player's PlayerSnapshot, loading it on first use.
 
-   def add_transaction(self, transaction):
-      """Adds a transaction to the transactions list attribute for this player.
+      Returns:
+         The PlayerSnapshot shared by this instance's accessors.
+      """
+      snapshot = getattr(self, '_snapshot', None)
+      if snapshot is None:
+         snapshot = self._snapshot = PlayerSnapshot(self)
+      return snapshot
 
-      Args:
-         transaction: A Transaction model instance.
+   def discard_snapshot(self):
+      """Discards the PlayerSnapshot after the player's orders change."""
+      self._snapshot = None
+
+   def migrate_transactions(self):
+      """Moves the player's transaction keys out of the player entity,
+         recording the player as the owner of each transaction instead.
+
+      Owners are written before the keys are removed, so an interrupted
+      migration is simply run again.
+
+      Returns:
+         The list of the player's Transaction model instances.
       """
-      self.transactions.append(transaction.key)
-      # Takes out the transaction fee for any transaction
-      self.cash = self.cash - transaction.fee
-      # Updates the cash immediately for the buy order (any changes in the price
-      # are handled by a refund process later)
-      if (transaction.type == 'buy' and transaction.executed == False):
-         self.update_cash(-transaction.price, transaction)
+      transactions = [t for t in ndb.get_multi(self.transactions) if t is not None]
+      for transaction in transactions:
+         transaction.owner = self.key
+      ndb.put_multi(transactions)
+      self.transactions = []
       self.put()
+      return transactions
 
    def update_cash(self, unit_price, transaction):
       """Updates cash based off the quantity multiplied by the unit price
@@ -80,10 +242,47 @@ class Player(auth_models.User):
          transaction: The relevant transaction involved in the cash update.
       """
       if (transaction.type == 'buy' or transaction.type == 'sell'):
-         self.cash = self.cash + transaction.quantity * unit_price
-         transaction.cashHistory = self.cash
-         transaction.put()
-      self.put()
+         self.apply_cash(unit_price, transaction)
+         mark_dirty(transaction)
+      mark_dirty(self)
+
+   def apply_cash(self, unit_price, transaction):
+      """Updates cash as for update_cash, but without writing the player or
+         the transaction to the datastore.
+
+      Used when executing orders in bulk, where the caller writes all the
+      changed entities at once.
+
+      Args:
+         unit_price: The signed price of the unit (negative = reduces cash,
+            positive = adds cash).
+         transaction: The relevant transaction involved in the cash update.
+      """
+      self.cash = self.cash + transaction.quantity * unit_price
+      transaction.cashHistory = self.cash
+
+   @classmethod
+   def get_owners(cls, transactions):
+      """Gets the players who placed each of a list of transactions.
+
+      Owners are loaded with a single get_multi (players already changed in
+      this request are the same instances). Transactions made before the
+      owner was recorded fall back to a query, and have their owner set so
+      that the caller's next write records it.
+
+      Args:
+         transactions: A list of Transaction model instances.
+
+      Returns:
+         A dictionary mapping player keys to Player model instances.
+      """
+      for transaction in transactions:
+         if transaction.owner is None:
+            player = cls.query(cls.transactions == transaction.key).get()
+            if player:
+               transaction.owner = player.key
+      keys = list(set(t.owner for t in transactions if t.owner is not None))
+      return dict((key, player) for (key, player) in zip(keys, load_multi(keys)) if player)
 
    def update_password(self, old_pass, new_pass):
       """Provide hash function allowing user to update their password.
@@ -112,31 +311,75 @@ class Player(auth_models.User):
          extensible).
       """
       shares = {}
-      # Counts the number of stocks that have been cumulated for the cost in
-      # order to calculate the average at the end.
-      count = {}
-
-      # Go through the executed transactions and calculate the total
-      # number of shares held
-      for transaction_key in self.transactions:
-         transaction = transaction_key.get()
-         if transaction.stock not in shares.keys():
-            shares[transaction.stock] = {'quantity': 0, 'purchase_price': 0}
-            count[transaction.stock] = 0
-         if (transaction.type == 'buy' and transaction.executed == True):
-            shares[transaction.stock]['quantity'] += transaction.quantity
-            shares[transaction.stock]['purchase_price'] += transaction.quantity * transaction.price
-            count[transaction.stock] += transaction.quantity
-         elif (transaction.type == 'sell' and transaction.executed == True):
-            shares[transaction.stock]['quantity'] -= transaction.quantity
-
-      for stock in shares.keys():
-         if count[stock] > 0:
-            shares[stock]['purchase_price'] = shares[stock]['purchase_price'] / count[stock]
-      # Remove all stocks with 0 quantity held
-      shares = {stock: data for (stock, data) in shares.iteritems() if data['quantity'] > 0}
+      for position in self.get_positions():
+         if position.quantity > 0:
+            shares[position.stock] = {'quantity': position.quantity,
+               'purchase_price': position.purchase_price()}
       return shares
 
+   def get_positions(self):
+      """Gets the player's Position records from the snapshot.
+
+      Returns:
+         A list of Position model instances.
+      """
+      return self.snapshot().positions()
+
+   def get_stored_positions(self):
+      """Reads the player's Position records, building them from the
+         transaction history if this has not been done yet.
+
+      Returns:
+         A list of Position model instances.
+      """
+      if not self.ledger:
+         return self.rebuild_positions().values()
+      return Position.for_player(self.key)
+
+   def replay_positions(self):
+      """Calculates the player's positions by replaying every transaction.
+
+      Returns:
+         A dictionary mapping stock codes to (unstored) Position instances.
+      """
+      return Position.replay(self.key, self.snapshot().transactions())
+
+   def rebuild_positions(self):
+      """Replaces the player's Position records with ones replayed from the
+         transaction history.
+
+      Returns:
+         A dictionary mapping stock codes to the stored Position instances.
+      """
+      positions = self.replay_positions()
+      stale = [key for key in Position.query(ancestor=self.key).iter(keys_only=True)
+         if key.id() not in positions]
+      self.ledger = True
+      def txn():
+         ndb.delete_multi(stale)
+         ndb.put_multi([self] + positions.values())
+      ndb.transaction(txn)
+      self.snapshot().cached_positions = positions.values()
+      return positions
+
+   def verify_positions(self):
+      """Compares the player's stored Position records with a replay of the
+         transaction history.
+
+      Returns:
+         A dictionary mapping the stock codes that disagree to a tuple of the
+         stored and replayed Position (either may be None).
+      """
+      replayed = self.replay_positions()
+      stored = dict((p.stock, p) for p in Position.for_player(self.key))
+      differences = {}
+      for stock in set(replayed.keys()) | set(stored.keys()):
+         a = stored.get(stock) or Position(stock=stock)
+         b = replayed.get(stock) or Position(stock=stock)
+         if a.differs(b):
+            differences[stock] = (stored.get(stock), replayed.get(stock))
+      return differences
+
    def get_stock_code_and_dates(self):
       """Gets a dictionary of all stock codes and dates for display on a chart.
 
@@ -145,8 +388,7 @@ class Player(auth_models.User):
       """
       codes = {}
       stockQuantity = {}
-      for transaction_key in self.transactions:
-         transaction = transaction_key.get()
+      for transaction in self.snapshot().by_status(True):
          if (transaction.type == 'buy' and transaction.executed == True):
             # Checks if same stock was bought previously
             if (transaction.stock in codes):
@@ -177,37 +419,70 @@ class Player(auth_models.User):
       # prices used in average.
       purchase_prices = {}
 
-      if (self.transactions):
-         transactions = Transaction.query(ndb.AND
-         (Transaction.executed == executed, Transaction.key.IN(self.transactions)))
-         for transaction in transactions:
-            temp = {}
-            temp["stock"] = transaction.stock
-            temp["type"] = transaction.type
-            temp["subtype"] = transaction.subtype
-            temp["quantity"] = transaction.quantity
-            temp["price"] = transaction.price
-            # Adjust UTC time to AEDST GMT +11:00 for Sydney, where the market is.
-            transaction.timestamp += timedelta(hours=11)
-            temp["timestamp"] = str(transaction.timestamp.isoformat());
-            temp["cashHistory"] = transaction.cashHistory
-            temp["key"] = transaction.key.urlsafe()
-            if (executed):
-               if (temp["type"] == "buy"):
-                  if temp["stock"] not in purchase_prices.keys():
-                     purchase_prices[temp["stock"]] = {'average': temp["price"], 'number': 1}
-                  else:
-                     a = purchase_prices[temp["stock"]]['average']
-                     n = purchase_prices[temp["stock"]]['number']
-                     a_2 = (a * n + temp["price"]) / (n + 1)
-                     purchase_prices[temp["stock"]]['average'] = a_2
-                     purchase_prices[temp["stock"]]['number'] += 1
-               if (temp["type"] == "sell"):
-                  # Can't have sold without buying first.
-                  temp["net_gain"] = temp["quantity"] * (temp["price"] - purchase_prices[temp["stock"]]['average'])
-            shares[str(transaction.timestamp)] = temp
+      for transaction in self.snapshot().by_status(executed):
+         temp = describe_transaction(transaction, purchase_prices if executed else None)
+         shares[str(transaction.timestamp + timedelta(hours=11))] = temp
       return shares
 
+   def get_history_page(self, token=None, page_size=50, start=None, end=None):
+      """Gets one page of the player's executed transactions, oldest first.
+
+      The average purchase price of each stock, which the net gain of a sell
+      is measured against, is carried from page to page in the token rather
+      than recomputed from the start of the history.
+
+      Args:
+         token: The token returned with the previous page, or None for the
+            first page.
+         page_size: The maximum number of transactions on the page.
+         start: Only transactions from this UTC datetime onwards, or None.
+         end: Only transactions before this UTC datetime, or None.
+
+      Returns:
+         A tuple of the list of transaction information (as for
+         get_transactions) and the token for the next page, or None if this
+         is the last page.
+
+      Raises:
+         ValueError: if the token is not valid.
+      """
+      if self.transactions:
+         self.migrate_transactions()
+      query = Transaction.for_owner(self.key, executed=True)
+      if start:
+         query = query.filter(Transaction.timestamp >= start)
+      if end:
+         query = query.filter(Transaction.timestamp < end)
+
+      if token:
+         # The token comes from the client, so anything wrong with it is an
+         # invalid token rather than an error
+         try:
+            state = json.loads(base64.urlsafe_b64decode(str(token)))
+            cursor = ndb.Cursor(urlsafe=state['cursor'])
+            purchase_prices = dict((stock, {'average': float(average), 'number': int(number)})
+               for (stock, (average, number)) in state['averages'].iteritems())
+         except (TypeError, KeyError, ValueError, AttributeError, UnicodeError,
+            datastore_errors.BadValueError):
+            raise ValueError("Invalid token")
+      else:
+         cursor = None
+         purchase_prices = {}
+         if start:
+            # Averages start from the buys made before the range
+            earlier = Transaction.for_owner(self.key, executed=True).filter(
+               Transaction.timestamp < start)
+            for transaction in earlier:
+               describe_transaction(transaction, purchase_prices)
+
+      transactions, cursor, more = query.fetch_page(page_size, start_cursor=cursor)
+      page = [describe_transaction(t, purchase_prices) for t in transactions]
+      if not (more and cursor):
+         return page, None
+      state = {'cursor': cursor.urlsafe(), 'averages': dict((stock, [p['average'], p['number']])
+         for (stock, p) in purchase_prices.iteritems())}
+      return page, base64.urlsafe_b64encode(json.dumps(state))
+
    def get_sellable_shares(self):
       """Gets the current amount of shares owned by a player, adjusted to
          account for pending sales.
@@ -217,21 +492,10 @@ class Player(auth_models.User):
       Returns:
          A dictionary mapping stock codes to available quantities of the stock.
       """
-      shares = self.get_shares()
-      pending = self.get_transactions(executed=False)
       total = {}
-      # Get the number of shares currently owned
-      for (stock, info) in shares.iteritems():
-         total[stock] = info['quantity']
-
-      # Subtract the number of pending sell orders
-      for (time, holding) in pending.iteritems():
-         if (ndb.Key(urlsafe=holding['key']).get().type == 'sell'):
-            if holding['stock'] in total:
-               total[holding['stock']] -= holding['quantity']
-            else:
-               # Shouldn't normally happen
-               total[holding['stock']] = holding['quantity']
+      for position in self.get_positions():
+         if (position.quantity > 0 or position.reserved > 0):
+            total[position.stock] = position.quantity - position.reserved
       return total
 
    def get_total_shares_value(self, shares):
@@ -244,20 +508,7 @@ class Player(auth_models.User):
          A single cumulative value of all shares
       """
       total_shares_value = 0
-      share_data = memcache.get('share_data')
-      if share_data is None:
-         # Get data and put it into the same format as memcache would be
-         share_data = {}
-         yahoo_url = "https://query.yahooapis.com/v1/public/yql?q=select%20LastTradePriceOnly%20from%20yahoo.finance.quotes%20where%20symbol%20IN%20(" + ",%20".join('"' + key + '"' for key in shares.keys()) + ")%20&format=json&diagnostics=false&env=store%3A%2F%2Fdatatables.org%2Falltableswithkeys&callback="
-         response = urlfetch.fetch(yahoo_url)
-         data = json.loads(response.content)
-         i = 0
-         for share in shares:
-            if (len(shares) == 1):
-               share_data[str(share)] = data['query']['results']['quote']
-            elif (len(shares) > 1):
-               share_data[str(share)] = data['query']['results']['quote'][i]
-            i+=1
+      share_data = QUOTES.get([str(share) for share in shares])
 
       for share in shares:
          price = float(share_data[str(share)]['LastTradePriceOnly'])
@@ -276,35 +527,94 @@ class Player(auth_models.User):
          The cumulative value of all pending transactions.
       """
       value = 0;
-      pending_data = self.get_transactions(executed=False)
-      for (time, holding) in pending_data.iteritems():
-         if (holding['type'] == 'buy'):
-            value += holding['price'] * holding['quantity']
+      for transaction in self.snapshot().by_status(False):
+         if (transaction.type == 'buy'):
+            value += transaction.price * transaction.quantity
       return value
 
    def delete_transaction(self, key):
-      """Removes a transaction from the list of transactions.
+      """Cancels a pending transaction of this player, refunding a buy and
+         releasing the stock reserved by a sell, and deletes it.
+
+         The transaction, the player and their position are read again and
+         written in one cross-group transaction, so that fills made meanwhile
+         are kept and an order executed meanwhile is not cancelled.
 
          Args:
             key: The key corresponding to the Transaction model instance.
 
          Raises:
-            ValueError: if key is not valid.
+            ValueError: if key is not valid, or the order is not pending.
       """
-      try:
-         index = self.transactions.index(key)
-         transaction = self.transactions.pop(index).get()
-
-         # If deleting a pending transaction refund the money for a buy except for brokerage
-         if (transaction.executed == False):
-            if (transaction.type == 'buy'):
-               self.cash = self.cash + transaction.quantity * transaction.price
-         self.put()
-      except ValueError:
-         raise ValueError("Invalid key")
+      @ndb.transactional(xg=True)
+      def txn():
+         transaction = key.get()
+         player = self.key.get()
+         if (transaction is None or (transaction.owner != self.key
+            and key not in player.transactions)):
+            raise ValueError("Invalid key")
+         if (transaction.executed):
+            raise ValueError("Order already executed")
+         if key in player.transactions:
+            player.transactions.remove(key)
+
+         # Refund the money for a buy except for brokerage
+         if (transaction.type == 'buy'):
+            player.cash = player.cash + transaction.quantity * transaction.price
+         position_key = Position.key_for(self.key, transaction.stock)
+         position = position_key.get() or Position(key=position_key, stock=transaction.stock)
+         position.cancel(transaction)
+         ndb.put_multi([player, position])
+         key.delete()
+         return player
+
+      player = txn()
+      self.cash = player.cash
+      self.transactions = player.transactions
+      self.discard_snapshot()
 
 ## ADDITIONAL RELATED PLAYER METHODS AND THE HANDLER FOR USER AUTHENTICATION ##
 
+def describe_transaction(transaction, purchase_prices=None):
+   """Gets the information about a transaction returned to the client.
+
+   Args:
+      transaction: A Transaction model instance.
+      purchase_prices: For executed transactions taken oldest first, a
+         dictionary indexed by stock code which contains the average purchase
+         price and number of prices used in average. It is updated with a buy,
+         and used for the net gain of a sell.
+
+   Returns:
+      A dictionary of the transaction's information.
+   """
+   temp = {}
+   temp["stock"] = transaction.stock
+   temp["type"] = transaction.type
+   temp["subtype"] = transaction.subtype
+   temp["quantity"] = transaction.quantity
+   temp["price"] = transaction.price
+   # Adjust UTC time to AEDST GMT +11:00 for Sydney, where the market is.
+   # (Transactions may be shared, so are not changed.)
+   timestamp = transaction.timestamp + timedelta(hours=11)
+   temp["timestamp"] = str(timestamp.isoformat());
+   temp["cashHistory"] = transaction.cashHistory
+   temp["key"] = transaction.key.urlsafe()
+   if (purchase_prices is not None):
+      if (temp["type"] == "buy"):
+         if temp["stock"] not in purchase_prices.keys():
+            purchase_prices[temp["stock"]] = {'average': temp["price"], 'number': 1}
+         else:
+            a = purchase_prices[temp["stock"]]['average']
+            n = purchase_prices[temp["stock"]]['number']
+            a_2 = (a * n + temp["price"]) / (n + 1)
+            purchase_prices[temp["stock"]]['average'] = a_2
+            purchase_prices[temp["stock"]]['number'] += 1
+      if (temp["type"] == "sell" and temp["stock"] in purchase_prices):
+         # Can't have sold without buying first.
+         temp["net_gain"] = temp["quantity"] * (temp["price"] - purchase_prices[temp["stock"]]['average'])
+   return temp
+
 def login_required(handler):
    """Handler to enforce user login, add @login_required before method."""
    def check_login(self, *args, **kwargs):
@@ -0,0 +1,103 @@
+"""Portfolio Value Series
+
+   This module builds the daily value of a player's portfolio (cash and the
+   value of each holding) from their executed transactions and the price
+   history, as column arrays in one vectorised pass. The result is cached
+   until the player's next fill, or the next day.
+"""
+
+import datetime
+
+import numpy
+
+from google.appengine.api import memcache
+from py.history import *
+
+# Transactions are shown in Sydney time (AEDT, GMT +11:00), where the market is
+SYDNEY_OFFSET = datetime.timedelta(hours=11)
+
+def value_series_key(player_key):
+   """Gets the memcache key of a player's value series."""
+   return 'portfolio:%s' % player_key.id()
+
+def invalidate_value_series(player_keys):
+   """Discards the cached value series of players whose holdings or cash
+      have changed.
+
+   Args:
+      player_keys: A list of Player keys.
+   """
+   memcache.delete_multi([value_series_key(key) for key in player_keys])
+
+def value_series(player):
+   """Gets the daily value series of a player's portfolio, from the day of
+      their first executed transaction to today.
+
+   Args:
+      player: The Player model instance.
+
+   Returns:
+      A dictionary of lists, one entry per day: 'date' (YYYY-MM-DD), 'cash',
+      'total', and 'holdings' mapping each stock code ever held to its value.
+   """
+   today = (datetime.datetime.utcnow() + SYDNEY_OFFSET).date()
+   cached = memcache.get(value_series_key(player.key))
+   if cached and cached['today'] == str(today):
+      return cached['series']
+   series = build_value_series(player.snapshot().by_status(True), today)
+   memcache.set(value_series_key(player.key), {'today': str(today), 'series': series})
+   return series
+
+def build_value_series(transactions, today):
+   """Builds the daily value series of a portfolio.
+
+   The quantity of each stock held on each day is the cumulative sum of a
+   stock by date matrix of fills, and is multiplied by the matching matrix of
+   closing prices (carried over weekends and holidays). Cash on each day is
+   the cash recorded with the player's last transaction up to that day.
+
+   Args:
+      transactions: The player's executed Transaction model instances, oldest
+         first.
+      today: The last date of the series.
+
+   Returns:
+      The series, as for value_series.
+   """
+   transactions = [t for t in transactions if t.cashHistory is not None]
+   if not transactions:
+      return {'date': [], 'cash': [], 'total': [], 'holdings': {}}
+
+   dates = [(t.timestamp + SYDNEY_OFFSET).date() for t in transactions]
+   start = dates[0]
+   days = numpy.arange(to_day(start), to_day(today) + 1)
+   trade_days = numpy.array([to_day(date) for date in dates]) - days[0]
+
+   symbols = sorted(set(t.stock for t in transactions))
+   rows = dict((symbol, i) for (i, symbol) in enumerate(symbols))
+   fills = numpy.array([t.quantity if t.type == 'buy' else -t.quantity
+      for t in transactions], dtype=numpy.float64)
+   cells = numpy.array([rows[t.stock] for t in transactions]) * len(days) + trade_days
+   quantities = numpy.bincount(cells, weights=fills, minlength=len(symbols) * len(days))
+   quantities = quantities.reshape(len(symbols), len(days)).cumsum(axis=1)
+
+   closes = numpy.zeros((len(symbols), len(days)))
+   for symbol, history in PRICES.get(symbols, start, today).iteritems():
+      if not len(history):
+         continue
+      # The last close on or before each day
+      last = numpy.searchsorted(history.column('date'), days, side='right') - 1
+      prices = history.column('close')[numpy.maximum(last, 0)] / 100.0
+      closes[rows[symbol]] = numpy.where(last >= 0, prices, 0)
+   values = quantities * closes
+
+   last_trade = numpy.searchsorted(trade_days, numpy.arange(len(days)), side='right') - 1
+   cash = numpy.array([t.cashHistory for t in transactions])[last_trade]
+   total = cash + values.sum(axis=0)
+   return {
+      'date': [str(from_day(day)) for day in days],
+      'cash': numpy.round(cash, 2).tolist(),
+      'total': numpy.round(total, 2).tolist(),
+      'holdings': dict((symbol, numpy.round(values[rows[symbol]], 2).tolist())
+         for symbol in symbols),
+   }
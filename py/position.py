@@ -0,0 +1,142 @@
+"""Position Model Class
+
+   This module contains the model for a player's holding in a single stock,
+   kept up to date as orders are placed, executed and cancelled so that
+   holdings can be read without replaying every transaction.
+"""
+
+from google.appengine.ext import ndb
+from py.unit import *
+
+class Position(ndb.Model):
+   """Stores a player's holding in one stock.
+
+   Positions are children of the Player, keyed by stock code, so that all of a
+   player's positions are read with one ancestor query and are updated in the
+   same entity group as their cash.
+
+   Attributes:
+      stock: The three character ASX stock code.
+      quantity: The quantity of the stock currently held.
+      bought: The total quantity ever bought (used to average the cost).
+      cost: The total amount ever paid for the stock.
+      reserved: The quantity committed to pending sell orders.
+   """
+   stock = ndb.StringProperty(required=True)
+   quantity = ndb.IntegerProperty(default=0, indexed=False)
+   bought = ndb.IntegerProperty(default=0, indexed=False)
+   cost = ndb.FloatProperty(default=0.0, indexed=False)
+   reserved = ndb.IntegerProperty(default=0, indexed=False)
+
+   @classmethod
+   def key_for(cls, player_key, stock):
+      """Gets the key of the position for a player and stock."""
+      return ndb.Key(cls, stock, parent=player_key)
+
+   @classmethod
+   def load(cls, pairs):
+      """Gets the positions for a list of players and stocks in one batch,
+         creating (but not storing) any that do not exist yet. Positions
+         already changed in this request are the same instances.
+
+      Args:
+         pairs: A list of (player key, stock code) tuples.
+
+      Returns:
+         A dictionary mapping each (player key, stock code) to its Position.
+      """
+      pairs = list(set(pairs))
+      keys = [cls.key_for(player_key, stock) for (player_key, stock) in pairs]
+      positions = {}
+      for pair, key, position in zip(pairs, keys, load_multi(keys)):
+         positions[pair] = position or cls(key=key, stock=pair[1])
+      return positions
+
+   @classmethod
+   def for_player(cls, player_key):
+      """Gets all of a player's positions.
+
+      Args:
+         player_key: The key of the Player.
+
+      Returns:
+         A list of Position model instances.
+      """
+      return cls.query(ancestor=player_key).fetch()
+
+   @classmethod
+   def replay(cls, player_key, transactions):
+      """Calculates a player's positions from their transaction history.
+
+      Args:
+         player_key: The key of the Player.
+         transactions: A list of the player's Transaction model instances.
+
+      Returns:
+         A dictionary mapping stock codes to (unstored) Position instances.
+      """
+      positions = {}
+      for transaction in transactions:
+         if transaction.stock not in positions:
+            positions[transaction.stock] = cls(
+               key=cls.key_for(player_key, transaction.stock), stock=transaction.stock)
+         position = positions[transaction.stock]
+         if transaction.executed:
+            # An executed sell was reserved while it was pending
+            if (transaction.type == 'sell'):
+               position.reserved += transaction.quantity
+            position.execute(transaction)
+         else:
+            position.place(transaction)
+      return positions
+
+   def place(self, transaction):
+      """Updates the position for a newly placed order.
+
+      Args:
+         transaction: The new Transaction.
+      """
+      if (transaction.type == 'sell' and transaction.executed == False):
+         self.reserved += transaction.quantity
+
+   def execute(self, transaction):
+      """Updates the position for an order that has been executed.
+
+      Args:
+         transaction: The executed Transaction, at its execution price.
+      """
+      if (transaction.type == 'buy'):
+         self.quantity += transaction.quantity
+         self.bought += transaction.quantity
+         self.cost += transaction.quantity * transaction.price
+      elif (transaction.type == 'sell'):
+         self.quantity -= transaction.quantity
+         self.reserved = max(self.reserved - transaction.quantity, 0)
+
+   def cancel(self, transaction):
+      """Updates the position for a pending order that has been cancelled.
+
+      Args:
+         transaction: The cancelled Transaction.
+      """
+      if (transaction.type == 'sell' and transaction.executed == False):
+         self.reserved = max(self.reserved - transaction.quantity, 0)
+
+   def purchase_price(self):
+      """Gets the average price paid per share."""
+      if self.bought > 0:
+         return self.cost / self.bought
+      return 0
+
+   def differs(self, other):
+      """Checks whether two positions disagree on any quantity or cost.
+
+      Args:
+         other: Another Position.
+
+      Returns:
+         True if the positions differ, False otherwise.
+      """
+      return (self.quantity != other.quantity or self.bought != other.bought
+         or self.reserved != other.reserved or abs(self.cost - other.cost) > 0.005)
+
@@ -0,0 +1,259 @@
+"""Request Profiler
+
+   This module profiles requests from live instances on demand. A WSGI
+   middleware profiles a request with cProfile when it carries a valid
+   signed X-Profile header (see make_token) or is picked by the sampling
+   rate, and its stats are stored by route. Every request is a candidate,
+   including the execution and leaderboard tasks. Stored samples are merged
+   into a report of the hottest functions, or into collapsed stacks for
+   flame graph tools.
+
+   Set the PROFILE_SECRET environment variable (in app.yaml) to accept signed
+   headers, and PROFILE_SAMPLE_RATE to the fraction of requests to profile
+   (none by default).
+"""
+
+import cProfile
+import hashlib
+import hmac
+import logging
+import marshal
+import os
+import pstats
+import random
+import time
+
+from google.appengine.ext import ndb
+from webapp2_extras import security
+from py.metrics import *
+
+HEADER = 'X-Profile'
+
+# The most bytes of marshalled stats stored with a sample (an entity is at
+# most 1MB)
+MAX_STATS_BYTES = 512 * 1024
+
+class ProfileSample(ndb.Model):
+   """Stores the profile of one request.
+
+   Attributes:
+      route: The name of the handler method that served the request (as
+         named by the metrics).
+      tags: The details the handler added to the route (see tag_request).
+      run: The id of the request (its log id, or its start time).
+      created: When the request was profiled.
+      seconds: The wall time of the request.
+      stats: The marshalled cProfile stats (as written by pstats).
+   """
+   route = ndb.StringProperty(required=True)
+   tags = ndb.StringProperty(repeated=True)
+   run = ndb.StringProperty(indexed=False)
+   created = ndb.DateTimeProperty(auto_now_add=True)
+   seconds = ndb.FloatProperty(indexed=False)
+   stats = ndb.BlobProperty(compressed=True)
+
+   @classmethod
+   def recent(cls, route=None, tag=None, limit=50):
+      """Gets the most recent samples, optionally of one route and tag.
+
+      Returns:
+         A list of ProfileSample model instances, newest first.
+      """
+      query = cls.query()
+      if route:
+         query = query.filter(cls.route == route)
+      if tag:
+         query = query.filter(cls.tags == tag)
+      return query.order(-cls.created).fetch(limit)
+
+   def load(self):
+      """Gets the sample's stats as a pstats.Stats."""
+      return pstats.Stats(LoadedProfile(marshal.loads(self.stats)))
+
+class LoadedProfile(object):
+   """Stored cProfile stats, in the form pstats.Stats loads them from."""
+   def __init__(self, stats):
+      self.stats = stats
+
+   def create_stats(self):
+      pass
+
+def sign(expires, secret):
+   """Gets the signature of a profiling token."""
+   return hmac.new(secret, str(expires), hashlib.sha256).hexdigest()
+
+def make_token(seconds=3600):
+   """Makes the value of an X-Profile header that has requests profiled.
+
+   Args:
+      seconds: How long the token is accepted for.
+
+   Returns:
+      The token, or None if PROFILE_SECRET is not set.
+   """
+   secret = os.environ.get('PROFILE_SECRET')
+   if not secret:
+      return None
+   expires = int(time.time()) + seconds
+   return '%d:%s' % (expires, sign(expires, secret))
+
+def should_profile(environ):
+   """Checks whether a request is to be profiled.
+
+   Args:
+      environ: The WSGI environment of the request.
+
+   Returns:
+      True if the request has a valid, unexpired X-Profile token or is picked
+      by the sampling rate.
+   """
+   token = environ.get('HTTP_' + HEADER.upper().replace('-', '_'))
+   secret = os.environ.get('PROFILE_SECRET')
+   if (token and secret):
+      expires, signature = (token.split(':', 1) + [''])[:2]
+      if (expires.isdigit() and int(expires) > time.time() and
+         security.compare_hashes(str(signature), sign(int(expires), secret))):
+         return True
+   rate = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+   return rate > 0 and random.random() < rate
+
+def pack_stats(stats, max_bytes=MAX_STATS_BYTES):
+   """Marshals cProfile stats for a sample, keeping only the functions with
+      the most time (cumtime) if they would take more than max_bytes.
+
+   Args:
+      stats: The stats dictionary of a cProfile.Profile.
+      max_bytes: The most bytes to return.
+
+   Returns:
+      The marshalled stats.
+   """
+   data = marshal.dumps(stats)
+   while (len(data) > max_bytes and len(stats) > 1):
+      kept = set(sorted(stats, key=lambda function: stats[function][3],
+         reverse=True)[:len(stats) // 2])
+      # Calls from the functions left out are dropped with them
+      stats = dict((function, (cc, nc, tt, ct, dict((caller, call)
+         for (caller, call) in callers.iteritems() if caller in kept)))
+         for (function, (cc, nc, tt, ct, callers)) in stats.iteritems() if function in kept)
+      data = marshal.dumps(stats)
+   return data
+
+class ProfilerMiddleware(object):
+   """Profiles the requests of a WSGI application that are asked to be (see
+      should_profile).
+
+   It runs inside MetricsMiddleware, whose name for the route and tags the
+   samples are stored under. The sample is written straight away (rather
+   than with the request's other changes) so that requests that fail are
+   profiled too. A sample that cannot be written is logged, and does not
+   change the response.
+
+   Attributes:
+      app: The WSGI application.
+   """
+   def __init__(self, app):
+      self.app = app
+
+   def __call__(self, environ, start_response):
+      if not should_profile(environ):
+         return self.app(environ, start_response)
+      profiler = cProfile.Profile()
+      started = time.time()
+      try:
+         return profiler.runcall(self.app, environ, start_response)
+      finally:
+         seconds = time.time() - started
+         try:
+            profiler.create_stats()
+            stats = METRICS.current()
+            ProfileSample(route=stats.route if stats else 'unmatched',
+               tags=stats.tags if stats else [], seconds=seconds,
+               run=os.environ.get('REQUEST_LOG_ID', '%.6f' % started),
+               stats=pack_stats(profiler.stats)).put()
+         except Exception:
+            logging.exception('Saving the profile sample failed')
+
+def merge_samples(samples):
+   """Merges the stats of samples.
+
+   Returns:
+      A pstats.Stats, or None if there are no samples.
+   """
+   merged = None
+   for sample in samples:
+      if merged is None:
+         merged = sample.load()
+      else:
+         merged.add(sample.load())
+   return merged
+
+def function_name(function):
+   """Gets a readable name for a pstats function key."""
+   filename, line, name = function
+   if filename == '~':
+      # A built-in function
+      return name
+   return '%s (%s:%d)' % (name, os.path.basename(filename), line)
+
+def top_functions(stats, count=30, sort='tottime'):
+   """Gets the hottest functions of merged stats.
+
+   Args:
+      stats: A pstats.Stats.
+      count: The number of functions.
+      sort: 'tottime' (time in the function itself) or 'cumtime' (including
+         the functions it calls).
+
+   Returns:
+      A list of dictionaries of each function's name, primitive and total
+      calls, and tottime and cumtime in seconds, hottest first.
+   """
+   index = 3 if sort == 'cumtime' else 2
+   rows = sorted(stats.stats.iteritems(), key=lambda item: item[1][index], reverse=True)
+   return [{'function': function_name(function), 'primitive_calls': cc, 'calls': nc,
+      'tottime': round(tt, 6), 'cumtime': round(ct, 6)}
+      for (function, (cc, nc, tt, ct, callers)) in rows[:count]]
+
+def collapsed_stacks(stats, min_seconds=0.0001, max_depth=64):
+   """Gets merged stats as collapsed stacks for flame graph tools.
+
+   cProfile records calls between pairs of functions rather than whole
+   stacks, so stacks are rebuilt from the functions nothing called, with the
+   time of each function shared between its callers in proportion to the
+   time spent in it from each.
+
+   Args:
+      stats: A pstats.Stats.
+      min_seconds: Stacks with less time than this are left out.
+      max_depth: The deepest stack followed.
+
+   Returns:
+      A list of lines 'outer;...;inner microseconds'.
+   """
+   callees = {}
+   for function, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+      for caller in callers:
+         callees.setdefault(caller, []).append(function)
+
+   totals = {}
+   def walk(function, path, share):
+      cc, nc, tt, ct, callers = stats.stats[function]
+      path = path + [function_name(function).replace(';', ',')]
+      stack = ';'.join(path)
+      totals[stack] = totals.get(stack, 0.0) + tt * share
+      if len(path) >= max_depth:
+         return
+      for callee in callees.get(function, []):
+         callee_ct = stats.stats[callee][3]
+         edge_ct = stats.stats[callee][4][function][3]
+         if (callee_ct <= 0 or edge_ct * share < min_seconds or
+            function_name(callee).replace(';', ',') in path):
+            continue
+         walk(callee, path, share * edge_ct / callee_ct)
+
+   for function, (cc, nc, tt, ct, callers) in stats.stats.iteritems():
+      if not callers:
+         walk(function, [], 1.0)
+   return ['%s %d' % (stack, int(seconds * 1000000))
+      for (stack, seconds) in sorted(totals.iteritems()) if seconds >= min_seconds]
@@ -0,0 +1,313 @@
+"""Push Updates
+
+   This module carries quote changes and fills from the execution cron to the
+   clients that are waiting for them, so that pages are updated after each
+   tick instead of polling for quotes and order status.
+
+   App Engine cannot stream a response, so clients long-poll: each request
+   waits until an event it cares about is published (or a timeout passes)
+   and then returns every event since the last one the client saw. Events
+   are numbered in the order they are published. Across instances they are
+   kept in memcache; a broker held in process stands in for it when running
+   a single local instance. Events are only published while the execution
+   cron runs, so outside those hours a request returns at once and tells the
+   client when to poll again.
+"""
+
+import collections
+import datetime
+import os
+import threading
+import time
+
+from google.appengine.api import memcache
+from py.intraday import SYDNEY_OFFSET
+
+# The quote fields pushed to clients
+PUSHED_FIELDS = ['Bid', 'Ask', 'LastTradePriceOnly']
+
+class Broker(object):
+   """Numbers and keeps recent events for subscribers to read."""
+
+   # Seconds between checks for new events while waiting. Events come in
+   # bursts a minute apart (each execution tick), so the interval grows the
+   # longer a subscriber waits, up to MAX_POLL_SECONDS.
+   POLL_SECONDS = 1.0
+   POLL_BACKOFF = 1.5
+   MAX_POLL_SECONDS = 5.0
+
+   def publish(self, events):
+      """Publishes events.
+
+      Args:
+         events: A list of event dictionaries.
+      """
+      raise NotImplementedError
+
+   def latest(self):
+      """Gets the sequence number of the last event published."""
+      raise NotImplementedError
+
+   def read(self, since):
+      """Gets the events published after a sequence number.
+
+      Args:
+         since: The sequence number of the last event already seen.
+
+      Returns:
+         A tuple of the list of (sequence number, event) tuples in order
+         (None if some of them are no longer kept) and the latest sequence
+         number.
+      """
+      raise NotImplementedError
+
+   def wait(self, since, timeout, wanted):
+      """Waits until an event the subscriber wants is published.
+
+      Args:
+         since: The sequence number of the last event already seen.
+         timeout: The most seconds to wait.
+         wanted: A function of an event, true if the subscriber wants it.
+
+      Returns:
+         As for read, once a wanted event is published or the timeout has
+         passed.
+      """
+      deadline = time.time() + timeout
+      interval = self.POLL_SECONDS
+      while True:
+         events, latest = self.read(since)
+         if events is None or any(wanted(event) for (seq, event) in events):
+            return events, latest
+         remaining = deadline - time.time()
+         if remaining <= 0:
+            return events, latest
+         time.sleep(min(interval, remaining))
+         interval = min(interval * self.POLL_BACKOFF, self.MAX_POLL_SECONDS)
+
+class LocalBroker(Broker):
+   """Keeps events in process, waking waiting subscribers as soon as an event
+      is published. Only subscribers on the same instance see the events.
+
+   Attributes:
+      events: A deque of the most recent (sequence number, event) tuples.
+      last: The sequence number of the last event published.
+   """
+   def __init__(self, size=1000):
+      self.events = collections.deque(maxlen=size)
+      self.last = 0
+      self.condition = threading.Condition()
+
+   def publish(self, events):
+      with self.condition:
+         for event in events:
+            self.last += 1
+            self.events.append((self.last, event))
+         self.condition.notify_all()
+
+   def latest(self):
+      return self.last
+
+   def read(self, since):
+      with self.condition:
+         # A subscriber ahead of the broker saw events from before a restart
+         if since > self.last or since < self.last - len(self.events):
+            return None, self.last
+         return [(seq, event) for (seq, event) in self.events if seq > since], self.last
+
+   def wait(self, since, timeout, wanted):
+      deadline = time.time() + timeout
+      with self.condition:
+         while True:
+            events, latest = self.read(since)
+            if events is None or any(wanted(event) for (seq, event) in events):
+               return events, latest
+            remaining = deadline - time.time()
+            if remaining <= 0:
+               return events, latest
+            self.condition.wait(remaining)
+
+class MemcacheBroker(Broker):
+   """Keeps events in memcache, one key per sequence number, so that every
+      instance sees them. Subscribers check for new events with a growing
+      interval (see Broker.wait).
+
+   Publishers number their events from one counter, write them, and only
+   then advance the sequence number subscribers read, in order, so that a
+   subscriber never finds a numbered event missing while it is written.
+   """
+   PREFIX = 'push:event:'
+   SEQ_KEY = 'push:seq'
+   RESERVED_KEY = 'push:reserved'
+
+   # Seconds a publisher waits for the events numbered before its own to be
+   # published, before publishing past them
+   PUBLISH_WAIT = 2.0
+
+   # Seconds an event is kept
+   TTL = 300
+
+   # The most events returned at once; a subscriber further behind resyncs
+   MAX_EVENTS = 500
+
+   def publish(self, events):
+      if not events:
+         return
+      last = memcache.incr(self.RESERVED_KEY, delta=len(events),
+         initial_value=self.latest())
+      first = last - len(events) + 1
+      memcache.set_multi(dict((str(first + i), event) for (i, event) in enumerate(events)),
+         time=self.TTL, key_prefix=self.PREFIX)
+
+      client = memcache.Client()
+      deadline = time.time() + self.PUBLISH_WAIT
+      while True:
+         seq = client.gets(self.SEQ_KEY)
+         if seq is None:
+            if client.add(self.SEQ_KEY, last):
+               return
+         elif seq >= last:
+            return
+         elif (seq >= first - 1 or time.time() > deadline):
+            # The events before these are published (or their publisher has
+            # given up), so these become visible
+            if client.cas(self.SEQ_KEY, last):
+               return
+         time.sleep(0.05)
+
+   def latest(self):
+      return int(memcache.get(self.SEQ_KEY) or 0)
+
+   def read(self, since):
+      latest = self.latest()
+      if latest == since:
+         return [], latest
+      # A subscriber ahead of the counter saw events from before an eviction
+      if latest < since or latest - since > self.MAX_EVENTS:
+         return None, latest
+      seqs = range(since + 1, latest + 1)
+      found = memcache.get_multi([str(seq) for seq in seqs], key_prefix=self.PREFIX)
+      if len(found) < len(seqs):
+         return None, latest
+      return [(seq, found[str(seq)]) for seq in seqs], latest
+
+_broker = None
+
+def get_broker():
+   """Gets the broker for this instance.
+
+   Set the PUSH_BROKER environment variable (in app.yaml) to 'local' to keep
+   events in process when running a single instance.
+
+   Returns:
+      A Broker.
+   """
+   global _broker
+   if _broker is None:
+      if os.environ.get('PUSH_BROKER') == 'local':
+         _broker = LocalBroker()
+      else:
+         _broker = MemcacheBroker()
+   return _broker
+
+def set_broker(broker):
+   """Replaces the broker for this instance (e.g. for benchmarks)."""
+   global _broker
+   _broker = broker
+
+# The memcache key of the last quotes pushed, which deltas are taken against
+LAST_QUOTES_KEY = 'push:quotes'
+
+def publish_quotes(share_dict):
+   """Publishes the quotes that have changed since the last tick.
+
+   Args:
+      share_dict: A dictionary mapping stock codes to their quote.
+   """
+   current = dict((symbol, dict((field, quote.get(field)) for field in PUSHED_FIELDS))
+      for (symbol, quote) in share_dict.iteritems())
+   previous = memcache.get(LAST_QUOTES_KEY) or {}
+   changed = dict((symbol, quote) for (symbol, quote) in current.iteritems()
+      if previous.get(symbol) != quote)
+   memcache.set(LAST_QUOTES_KEY, current)
+   if changed:
+      get_broker().publish([{'type': 'quotes', 'quotes': changed}])
+
+def publish_fills(transactions):
+   """Publishes an event for each executed transaction, for its owner.
+
+   Args:
+      transactions: A list of executed Transaction model instances.
+   """
+   get_broker().publish([{'type': 'fill', 'player': t.owner.id(),
+      'key': t.key.urlsafe(), 'stock': t.stock, 'order_type': t.type,
+      'quantity': t.quantity, 'price': t.price} for t in transactions
+      if t.owner is not None])
+
+# The minutes of the (Sydney) day that the execution cron runs in, and so
+# that events are published in (see cron.yaml)
+MARKET_OPEN = 10 * 60
+MARKET_CLOSE = 16 * 60 + 1
+
+# The most seconds a subscriber is told to wait while the market is closed
+MAX_RETRY_SECONDS = 60 * 60
+
+def seconds_until_open(now=None):
+   """Gets how long until the execution cron next runs.
+
+   Args:
+      now: The UTC time (by default the current time).
+
+   Returns:
+      0 while the cron is running, otherwise the seconds until it starts.
+   """
+   local = (now or datetime.datetime.utcnow()) + SYDNEY_OFFSET
+   minute = local.hour * 60 + local.minute
+   if MARKET_OPEN <= minute < MARKET_CLOSE:
+      return 0
+   opening = local.replace(hour=MARKET_OPEN // 60, minute=MARKET_OPEN % 60,
+      second=0, microsecond=0)
+   if minute >= MARKET_CLOSE:
+      opening += datetime.timedelta(days=1)
+   return int((opening - local).total_seconds())
+
+def get_updates(since, symbols, player_id, timeout, now=None):
+   """Waits for the quote changes and fills a subscriber cares about.
+
+   While the market is closed nothing is published, so the events already
+   published are returned at once instead.
+
+   Args:
+      since: The sequence number of the last event the subscriber saw.
+      symbols: The set of stock codes whose quotes are wanted.
+      player_id: The id of the subscriber's Player (None for no fills).
+      timeout: The most seconds to wait.
+      now: The UTC time (by default the current time).
+
+   Returns:
+      A dictionary of the latest sequence number 'seq', the changed 'quotes'
+      (mapping stock codes to their fields), the player's 'fills' and the
+      seconds to wait before polling again, 'retry' (0 to poll straight
+      away). If the subscriber has fallen too far behind, 'reset' is true
+      instead of the changes and it should load the current state again.
+   """
+   def wanted(event):
+      if event['type'] == 'quotes':
+         return any(symbol in symbols for symbol in event['quotes'])
+      return event['player'] == player_id
+
+   retry = min(seconds_until_open(now), MAX_RETRY_SECONDS)
+   if retry:
+      events, latest = get_broker().read(since)
+   else:
+      events, latest = get_broker().wait(since, timeout, wanted)
+   if events is None:
+      return {'seq': latest, 'reset': True, 'retry': retry}
+   updates = {'seq': latest, 'quotes': {}, 'fills': [], 'retry': retry}
+   for (seq, event) in events:
+      if event['type'] == 'quotes':
+         updates['quotes'].update((symbol, quote) for (symbol, quote)
+            in event['quotes'].iteritems() if symbol in symbols)
+      elif event['player'] == player_id:
+         updates['fills'].append(event)
+   return updates
@@ -0,0 +1,288 @@
+"""Quote Provider Classes
+
+   This module contains the sources of the latest share quotes (Bid, Ask and
+   LastTradePriceOnly) used by the execution cron and for valuing holdings,
+   and the per-stock cache in front of them.
+   Quotes are always returned as a dictionary mapping stock codes to a
+   dictionary of fields, in the same format as the Yahoo Finance API.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+# The fields fetched for each stock by default (the average volume is used to
+# generate market depth)
+FIELDS = ['Ask', 'Bid', 'LastTradePriceOnly', 'AverageDailyVolume']
+
+# The list of ASX200 stocks the market trades
+CODES_FILE = 'app/static/codes200A.json'
+
+_symbols = None
+
+def get_symbols():
+   """Gets the codes of every stock in the market, reading the list only once
+      per instance.
+
+   Returns:
+      A list of stock codes.
+   """
+   global _symbols
+   if _symbols is None:
+      with open(CODES_FILE) as share_data_list:
+         _symbols = [str(share['code']) for share in json.load(share_data_list)]
+   return _symbols
+
+class QuoteProvider(object):
+   """Interface for a source of share quotes."""
+
+   def get_quotes(self, symbols, fields=FIELDS):
+      """Gets the latest quotes for a list of stocks.
+
+      Args:
+         symbols: A list of stock codes.
+         fields: The quote fields to fetch.
+
+      Returns:
+         A dictionary mapping stock codes to a dictionary of their fields.
+         Stocks the provider has no quote for are left out.
+      """
+      raise NotImplementedError
+
+class YahooQuoteProvider(QuoteProvider):
+   """Fetches quotes from the Yahoo Finance API.
+
+   The stocks are split into as few batches as the maximum URL length allows,
+   and every batch is fetched concurrently, so the time taken is that of the
+   slowest batch rather than the sum of them.
+   """
+   BASE_URL = ("https://query.yahooapis.com/v1/public/yql?q=select%20{fields}"
+      "%20from%20yahoo.finance.quotes%20where%20symbol%20IN%20({symbols})%20"
+      "&format=json&diagnostics=false&env=store%3A%2F%2Fdatatables.org%2Falltableswithkeys&callback=")
+
+   # Conservative limit on the length of a URL accepted by the API
+   MAX_URL_LENGTH = 2000
+
+   # Seconds to wait for each batch
+   DEADLINE = 15
+
+   def url(self, symbols, fields):
+      """Builds the API URL for a batch of stocks.
+
+      Args:
+         symbols: A list of stock codes.
+         fields: The quote fields to fetch.
+
+      Returns:
+         The URL as a string.
+      """
+      # The symbol is always selected so that results can be matched by name
+      return self.BASE_URL.format(fields="%2C%20".join(['symbol'] + list(fields)),
+         symbols=",%20".join('"' + symbol + '"' for symbol in symbols))
+
+   def batches(self, symbols, fields):
+      """Splits a list of stocks into batches whose URLs fit MAX_URL_LENGTH.
+
+      Args:
+         symbols: A list of stock codes.
+         fields: The quote fields to fetch.
+
+      Returns:
+         A list of lists of stock codes.
+      """
+      batches = [[]]
+      for symbol in symbols:
+         if (batches[-1] and
+            len(self.url(batches[-1] + [symbol], fields)) > self.MAX_URL_LENGTH):
+            batches.append([])
+         batches[-1].append(symbol)
+      return batches
+
+   def get_quotes(self, symbols, fields=FIELDS):
+      rpcs = []
+      for batch in self.batches(symbols, fields):
+         if not batch:
+            continue
+         rpc = urlfetch.create_rpc(deadline=self.DEADLINE)
+         urlfetch.make_fetch_call(rpc, self.url(batch, fields))
+         rpcs.append(rpc)
+
+      quotes = {}
+      for rpc in rpcs:
+         data = json.loads(rpc.get_result().content)
+         results = data['query']['results']
+         if not results:
+            continue
+         # A batch of one returns a single quote rather than a list
+         batch_quotes = results['quote']
+         if isinstance(batch_quotes, dict):
+            batch_quotes = [batch_quotes]
+         for quote in batch_quotes:
+            quotes[str(quote.pop('symbol'))] = quote
+      return quotes
+
+class FileQuoteProvider(QuoteProvider):
+   """Reads quotes from a local JSON file, so that the cron and benchmarks can
+      run offline.
+
+   The file holds a dictionary mapping stock codes to their fields, and is
+   read on every call so that it can be rewritten between ticks.
+
+   Attributes:
+      path: The path of the JSON file.
+   """
+   def __init__(self, path):
+      self.path = path
+
+   def get_quotes(self, symbols, fields=FIELDS):
+      with open(self.path) as quote_file:
+         data = json.load(quote_file)
+      quotes = {}
+      for symbol in symbols:
+         if symbol in data:
+            quotes[symbol] = dict((field, data[symbol].get(field)) for field in fields)
+      return quotes
+
+   def save(self, quotes):
+      """Writes quotes to the file, e.g. to record live quotes for replay.
+
+      Args:
+         quotes: A dictionary mapping stock codes to a dictionary of fields.
+      """
+      with open(self.path, 'w') as quote_file:
+         json.dump(quotes, quote_file)
+
+_provider = None
+
+def get_provider():
+   """Gets the quote provider for this instance.
+
+   The provider is chosen by the QUOTE_PROVIDER environment variable: a value
+   of 'file:<path>' reads quotes from a local file, and anything else uses the
+   Yahoo Finance API.
+
+   Returns:
+      A QuoteProvider instance.
+   """
+   global _provider
+   if _provider is None:
+      setting = os.environ.get('QUOTE_PROVIDER', '')
+      if setting.startswith('file:'):
+         _provider = FileQuoteProvider(setting[len('file:'):])
+      else:
+         _provider = YahooQuoteProvider()
+   return _provider
+
+def set_provider(provider):
+   """Replaces the quote provider for this instance.
+
+   Args:
+      provider: A QuoteProvider instance, or None to choose it again from the
+         environment.
+   """
+   global _provider
+   _provider = provider
+
+class QuoteCache(object):
+   """Caches quotes per stock in memcache, with a small in-process LRU in
+      front of it.
+
+   Lookups read the local layer first, then fetch whatever is missing from
+   memcache in one get_multi, then fetch whatever is still missing from the
+   quote provider and write it back to both layers.
+
+   Quotes are stored in memcache with their expiry, which the local layer
+   keeps when it is filled from memcache, so that no layer serves a quote
+   for longer than ttl after it was fetched.
+
+   Attributes:
+      ttl: Seconds a quote stays cached. The cron refreshes every quote each
+         minute, so this only needs to span a couple of ticks.
+      size: The maximum number of quotes held in the local layer.
+      local: An OrderedDict mapping stock codes to (expiry, quote), with the
+         most recently used last.
+   """
+   PREFIX = 'quote:'
+
+   def __init__(self, ttl=120, size=256):
+      self.ttl = ttl
+      self.size = size
+      self.local = collections.OrderedDict()
+      self.lock = threading.Lock()
+
+   def get_local(self, symbol, now):
+      """Gets an unexpired quote from the local layer, or None."""
+      with self.lock:
+         entry = self.local.pop(symbol, None)
+         if entry is None or entry[0] < now:
+            return None
+         self.local[symbol] = entry
+         return entry[1]
+
+   def set_local(self, entries):
+      """Adds quotes to the local layer, evicting the least recently used.
+
+      Args:
+         entries: A dictionary mapping stock codes to (expiry, quote).
+      """
+      with self.lock:
+         for symbol, entry in entries.iteritems():
+            self.local.pop(symbol, None)
+            self.local[symbol] = entry
+         while len(self.local) > self.size:
+            self.local.popitem(last=False)
+
+   def get(self, symbols):
+      """Gets the quotes for a list of stocks.
+
+      Args:
+         symbols: A list of stock codes.
+
+      Returns:
+         A dictionary mapping stock codes to a dictionary of their fields.
+         Stocks that no quote could be found for are left out.
+      """
+      now = time.time()
+      quotes = {}
+      missing = []
+      for symbol in symbols:
+         quote = self.get_local(symbol, now)
+         if quote is None:
+            missing.append(symbol)
+         else:
+            quotes[symbol] = quote
+      if not missing:
+         return quotes
+
+      # Entries stored without their expiry (by an older version) are
+      # fetched again
+      cached = dict((symbol, entry) for (symbol, entry)
+         in memcache.get_multi(missing, key_prefix=self.PREFIX).iteritems()
+         if isinstance(entry, tuple) and entry[0] >= now)
+      self.set_local(cached)
+      quotes.update((symbol, quote) for (symbol, (expiry, quote)) in cached.iteritems())
+      missing = [symbol for symbol in missing if symbol not in cached]
+      if missing:
+         fetched = get_provider().get_quotes(missing)
+         self.set(fetched)
+         quotes.update(fetched)
+      return quotes
+
+   def set(self, quotes):
+      """Writes quotes to both cache layers.
+
+      Args:
+         quotes: A dictionary mapping stock codes to a dictionary of fields.
+      """
+      expiry = time.time() + self.ttl
+      entries = dict((symbol, (expiry, quote)) for (symbol, quote) in quotes.iteritems())
+      memcache.set_multi(entries, time=self.ttl, key_prefix=self.PREFIX)
+      self.set_local(entries)
+
+# The quote cache for this instance
+QUOTES = QuoteCache()
@@ -5,6 +5,8 @@
 """
 
 from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from py.unit import *
 
 class Transaction(ndb.Model):
    """Stores information pertaining to an individual transaction/order.
@@ -20,6 +22,7 @@ class Transaction(ndb.Model):
       fee: The brokerage fee.
       cashHistory: The users cash when the order is made (used to track a
          historical record of the users cash).
+      owner: The key of the Player who placed the order.
    """
    type = ndb.StringProperty(required=True, choices=['buy', 'sell'])
    subtype = ndb.StringProperty(required=True, choices=['market', 'limit', 'stop'])
@@ -30,11 +33,13 @@ class Transaction(ndb.Model):
    executed = ndb.BooleanProperty(required=True)
    fee = ndb.FloatProperty(required=True)
    cashHistory = ndb.FloatProperty(required=False)
+   owner = ndb.KeyProperty(kind='Player', required=False)
 
    @classmethod
    def new(cls, data):
-      """Creates a new instance of the class and adds it to the datastore.
-      
+      """Creates a new instance of the class and adds it to the datastore
+         when the request ends.
+
       Assumes data passed is valid.
 
       Args:
@@ -45,10 +50,51 @@ class Transaction(ndb.Model):
       """
       transaction = cls(type=data['type'], subtype=data['subtype'],
          stock=data['stock'], price=data['price'], quantity=data['quantity'],
-         executed=data['executed'], fee=data['fee'], cashHistory=data['cashHistory']);
-      transaction.put()
+         executed=data['executed'], fee=data['fee'], cashHistory=data['cashHistory'],
+         owner=data.get('owner'));
+      mark_dirty(transaction)
       return transaction
 
+   @classmethod
+   def from_order(cls, data):
+      """Creates (but does not store) a pending transaction from an order
+         placed by a client.
+
+      Args:
+         data: A dictionary of the order's type, subtype, stock, price,
+            quantity and fee.
+
+      Returns:
+         The new Transaction instance, or None if the order is not valid.
+      """
+      try:
+         order = {'type': data['type'], 'subtype': data['subtype'],
+            'stock': str(data['stock']), 'price': float(data['price']),
+            'quantity': int(data['quantity']), 'fee': float(data['fee']),
+            'executed': False}
+         if (not order['stock'] or order['fee'] < 0 or not cls.is_valid(order)):
+            return None
+         return cls(**order)
+      except (KeyError, TypeError, ValueError, datastore_errors.BadValueError):
+         return None
+
+   @classmethod
+   def for_owner(cls, owner, executed=None):
+      """Gets a query for a player's transactions, oldest first.
+
+      Args:
+         owner: The key of the Player.
+         executed: The execution status to filter on, or None for every
+            transaction.
+
+      Returns:
+         An ndb Query.
+      """
+      query = cls.query(cls.owner == owner)
+      if executed is not None:
+         query = query.filter(cls.executed == executed)
+      return query.order(cls.timestamp)
+
    @classmethod
    def is_valid(cls, data):
       """Checks if data in the dictionary is valid according to the model schema.
@@ -63,14 +109,14 @@ class Transaction(ndb.Model):
          and (data['subtype'] == 'market' or data['subtype'] == 'limit' or data['subtype'] == 'stop')
          and data['price'] >= 0
          and data['quantity'] > 0
-         and data['executed'] == True or data['executed'] == False):
+         and (data['executed'] == True or data['executed'] == False)):
          return True
       else:
          return False
 
    @classmethod
    def delete(cls, key):
-      """ Deletes the transaction from the datastore.
+      """ Deletes the transaction from the datastore when the request ends.
 
       Args:
         key: The key corresponding to the transaction.
@@ -80,6 +126,6 @@ class Transaction(ndb.Model):
       """
       try:
          transaction = key.get()
-         transaction.key.delete()
+         mark_deleted(transaction.key)
       except AttributeError:
          raise AttributeError("Invalid key")
@@ -0,0 +1,187 @@
+"""Unit of Work
+
+   This module collects the entities a request (or task) changes and writes
+   each of them once when it ends, so that a player with several fills or a
+   depth updated more than once is stored with one put_multi rather than a
+   put per change. A request that fails writes nothing.
+
+   Model methods call mark_dirty and mark_deleted instead of writing.
+   Outside a request (e.g. in benchmarks) there is no unit of work, and they
+   write straight to the datastore.
+
+   The changes are written with a put_multi followed by a delete_multi, which
+   is not atomic: if the write fails partway, some of the changes may have
+   been written. Changes that must be atomic are made in a transaction
+   instead.
+"""
+
+import contextlib
+import logging
+import threading
+
+from google.appengine.ext import ndb
+
+class UnitOfWork(object):
+   """The entities changed by one request, waiting to be written.
+
+   Attributes:
+      dirty: A dictionary mapping keys to the changed entities.
+      new: A list of the changed entities without a key yet.
+      deleted: A set of the keys to delete.
+   """
+   def __init__(self):
+      self.dirty = {}
+      self.new = []
+      self.deleted = set()
+
+   def get_multi(self, keys):
+      """Gets entities by key, taking those changed in this unit from it so
+         that every change is made to the same instance.
+
+      Args:
+         keys: A list of keys.
+
+      Returns:
+         A list of the entities (None for those that do not exist).
+      """
+      missing = [key for key in keys if key not in self.dirty and key not in self.deleted]
+      loaded = dict(zip(missing, ndb.get_multi(missing)))
+      return [None if key in self.deleted else self.dirty.get(key, loaded.get(key))
+         for key in keys]
+
+   def save(self, entities):
+      """Marks entities as changed."""
+      for entity in entities:
+         if entity.key is None:
+            if not any(entity is other for other in self.new):
+               self.new.append(entity)
+         else:
+            self.deleted.discard(entity.key)
+            self.dirty[entity.key] = entity
+
+   def delete(self, keys):
+      """Marks entities as deleted."""
+      for key in keys:
+         self.dirty.pop(key, None)
+         self.deleted.add(key)
+
+   def flush(self):
+      """Writes every changed entity with one put_multi and deletes the
+         deleted ones, then starts over.
+
+      The put and the delete are separate calls, so a failure in either may
+      leave some of the changes written.
+      """
+      entities = self.new + self.dirty.values()
+      deleted = list(self.deleted)
+      self.rollback()
+      if entities:
+         ndb.put_multi(entities)
+      if deleted:
+         ndb.delete_multi(deleted)
+
+   def rollback(self):
+      """Forgets every change without writing it."""
+      self.dirty = {}
+      self.new = []
+      self.deleted = set()
+
+_local = threading.local()
+
+def current_unit():
+   """Gets the unit of work of the current request, or None outside one."""
+   return getattr(_local, 'unit', None)
+
+def mark_dirty(*entities):
+   """Records changes to entities, to be written when the request ends (or
+      straight away outside a request).
+   """
+   unit = current_unit()
+   if unit is None:
+      ndb.put_multi(list(entities))
+   else:
+      unit.save(entities)
+
+def mark_deleted(*keys):
+   """Deletes entities when the request ends (or straight away outside a
+      request).
+   """
+   unit = current_unit()
+   if unit is None:
+      ndb.delete_multi(list(keys))
+   else:
+      unit.delete(keys)
+
+def load_multi(keys):
+   """Gets entities by key, as changed so far in this request."""
+   unit = current_unit()
+   if unit is None:
+      return ndb.get_multi(keys)
+   return unit.get_multi(keys)
+
+@contextlib.contextmanager
+def unit_of_work():
+   """Runs a block in a unit of work, for work that runs outside a request.
+
+   When the outermost block completes, its changes are written, and if it
+   raises they are discarded. A block inside another one (or inside a
+   request) joins the outer unit, whose changes are written or discarded when
+   the outer block (or the request) ends.
+
+   Yields:
+      The UnitOfWork.
+   """
+   outer = current_unit()
+   if outer is not None:
+      yield outer
+      return
+   unit = _local.unit = UnitOfWork()
+   try:
+      yield unit
+   except:
+      unit.rollback()
+      raise
+   else:
+      unit.flush()
+   finally:
+      _local.unit = None
+
+class UnitOfWorkMiddleware(object):
+   """Runs each request of a WSGI application in a unit of work, writing the
+      changes if it succeeds and discarding them if it fails (raises or
+      responds with a 5xx status).
+
+   The response is held back until the changes are written, so that a
+   failed write is reported as an error.
+
+   Attributes:
+      app: The WSGI application.
+   """
+   def __init__(self, app):
+      self.app = app
+
+   def __call__(self, environ, start_response):
+      _local.unit = unit = UnitOfWork()
+      response = []
+      try:
+         def hold(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+            return lambda data: None
+         body = self.app(environ, hold)
+         if response and int(response[0][:3]) < 500:
+            try:
+               unit.flush()
+            except Exception:
+               logging.exception('Writing the changes of the request failed')
+               start_response('500 Internal Server Error', [('Content-Type', 'text/plain')])
+               return ['Internal Server Error']
+         else:
+            unit.rollback()
+      except:
+         unit.rollback()
+         raise
+      finally:
+         _local.unit = None
+      if response:
+         start_response(*response)
+      return body
@@ -0,0 +1,53 @@
+"""Tests
+
+   This package tests the model and execution code against the App Engine
+   SDK's local datastore, memcache and task queue stubs.
+
+   Run from the application directory with:
+
+   $ GAE_SDK=<path-to-Python-SDK>/platform/google_appengine python -m unittest discover -t . -s tests
+"""
+
+import os
+import sys
+import unittest
+
+# The application directory (the parent of this package)
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The SDK is put on the path before any test imports an application module
+if os.environ.get('GAE_SDK'):
+   sys.path.insert(0, os.environ['GAE_SDK'])
+import dev_appserver
+dev_appserver.fix_sys_path()
+if APP_DIR not in sys.path:
+   sys.path.insert(0, APP_DIR)
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+class StubTestCase(unittest.TestCase):
+   """Runs each test against fresh service stubs.
+
+   Queries see every write immediately, as in the benchmarks (see
+   bench.setup).
+
+   Attributes:
+      testbed: The active Testbed.
+   """
+   def setUp(self):
+      self.testbed = testbed.Testbed()
+      self.testbed.activate()
+      self.testbed.setup_env(app_id='risk-test', overwrite=True)
+      policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+      self.testbed.init_datastore_v3_stub(consistency_policy=policy, require_indexes=False)
+      self.testbed.init_memcache_stub()
+      self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+      self.testbed.init_urlfetch_stub()
+      self.testbed.init_app_identity_stub()
+      # Nothing is served from ndb's in-context cache that was not read
+      ndb.get_context().clear_cache()
+
+   def tearDown(self):
+      self.testbed.deactivate()
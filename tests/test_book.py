@@ -0,0 +1,87 @@
+"""Tests of the in-memory order books (py.book)."""
+
+import unittest
+
+from tests import StubTestCase
+from py.book import *
+from py.transaction import *
+
+def quote(bid, ask, last):
+   """Makes a quote as in the quote snapshot."""
+   return {'Bid': str(bid), 'Ask': str(ask), 'LastTradePriceOnly': str(last)}
+
+def pending(type, subtype, price, stock='ABC'):
+   """Stores a pending order."""
+   transaction = Transaction(type=type, subtype=subtype, stock=stock, price=price,
+      quantity=10, executed=False, fee=0.0)
+   transaction.put()
+   return transaction
+
+class OrderBookTest(unittest.TestCase):
+
+   def setUp(self):
+      self.book = OrderBook('ABC')
+      self.book.add('limit buy 10', 'buy', 'limit', 10.0)
+      self.book.add('limit buy 9', 'buy', 'limit', 9.0)
+      self.book.add('limit sell', 'sell', 'limit', 10.5)
+      self.book.add('stop buy', 'buy', 'stop', 10.2)
+      self.book.add('stop sell', 'sell', 'stop', 9.5)
+      self.book.add('market', 'buy', 'market', 0.0)
+
+   def test_crossed_finds_the_triggered_orders(self):
+      self.assertEqual(sorted(self.book.crossed(999, 1000, 990)), ['limit buy 10', 'market'])
+      self.assertEqual(sorted(self.book.crossed(1050, 1060, 1030)),
+         ['limit sell', 'market', 'stop buy'])
+      self.assertEqual(sorted(self.book.crossed(940, 945, 950)),
+         ['limit buy 10', 'market', 'stop sell'])
+
+   def test_bounds_are_the_best_prices(self):
+      self.assertEqual(self.book.bounds(), (1, 1000, 1050, 1020, 950))
+      self.book.remove('limit buy 10')
+      self.book.remove('market')
+      self.book.remove('missing')
+      self.assertEqual(self.book.bounds()[:2], (0, 900))
+      self.assertEqual(len(self.book), 4)
+
+class MarketTest(StubTestCase):
+
+   def setUp(self):
+      super(MarketTest, self).setUp()
+      self.market = Market()
+
+   def test_triggered_skips_books_without_a_whole_quote(self):
+      limit = pending('buy', 'limit', 10.0)
+      other = pending('buy', 'market', 1.0, stock='XYZ')
+      pending('sell', 'limit', 20.0, stock='DEF')
+      self.market.sync()
+      share_dict = {'ABC': quote(9.99, 10.0, 9.9), 'XYZ': quote(1, 1, 1),
+         'DEF': quote(10, 11, 'N/A')}
+      self.assertEqual(self.market.triggered(share_dict),
+         {'ABC': [limit.key], 'XYZ': [other.key]})
+      self.assertEqual(self.market.triggered(share_dict, set(['XYZ'])), {'XYZ': [other.key]})
+
+      self.market.remove(limit.key)
+      self.assertNotIn('ABC', self.market.books)
+      self.assertEqual(self.market.triggered(share_dict), {'XYZ': [other.key]})
+
+   def test_sync_loads_only_the_books_asked_for(self):
+      abc = pending('buy', 'market', 1.0)
+      pending('buy', 'market', 1.0, stock='XYZ')
+      self.market.sync(['ABC', 'DEF'])
+      self.assertEqual(sorted(self.market.books.keys()), ['ABC'])
+
+      # Later orders come in for the books already loaded
+      later = pending('buy', 'market', 1.0, stock='DEF')
+      pending('buy', 'market', 1.0, stock='XYZ')
+      self.market.sync(['ABC'])
+      self.assertEqual(sorted(self.market.books.keys()), ['ABC', 'DEF'])
+      self.assertEqual(self.market.stocks[later.key], 'DEF')
+      self.assertEqual(self.market.stocks[abc.key], 'ABC')
+
+      # The cron loads every book
+      self.market.sync()
+      self.assertEqual(sorted(self.market.books.keys()), ['ABC', 'DEF', 'XYZ'])
+      self.assertEqual(len(self.market.stocks), 4)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,202 @@
+"""Tests of the market depth (py.depth)."""
+
+import datetime
+import time
+import unittest
+
+import numpy
+from google.appengine.api import memcache
+
+from tests import StubTestCase
+from py.depth import *
+
+def make_depth(stock='ABC', refreshed=None):
+   """Makes a depth with three levels of 100 on each side of 9.99/10.01."""
+   return Depth(id=stock, stock=stock, max_bid=9.99, min_ask=10.01,
+      bid_levels=Levels([999, 998, 997], [100, 100, 100]),
+      ask_levels=Levels([1001, 1002, 1003], [100, 100, 100]),
+      refreshed=refreshed or datetime.datetime.utcnow())
+
+def quote(bid, ask, volume=1000000):
+   """Makes a quote as in the quote snapshot."""
+   return {'Bid': str(bid), 'Ask': str(ask), 'AverageDailyVolume': str(volume)}
+
+class LadderTest(unittest.TestCase):
+
+   def test_take_fills_from_the_lowest_ask(self):
+      ladder = Ladder('ask', Levels([1002, 1001, 1003], [100, 100, 100]))
+      filled, cost, taken = ladder.take(150)
+      self.assertEqual(filled, 150)
+      self.assertEqual(cost, 100 * 1001 + 50 * 1002)
+      self.assertEqual(taken, [(1001, 100), (1002, 50)])
+      self.assertEqual(ladder.levels().flat(), [1002, 50, 1003, 100])
+
+   def test_take_stops_at_the_limit(self):
+      ladder = Ladder('bid', Levels([999, 998, 997], [100, 100, 100]))
+      filled, cost, taken = ladder.take(500, limit=998)
+      self.assertEqual(filled, 200)
+      self.assertEqual(taken, [(999, 100), (998, 100)])
+      self.assertEqual(ladder.levels().flat(), [997, 100])
+
+   def test_remove_ignores_missing_levels(self):
+      ladder = Ladder('ask', Levels([1001, 1002], [100, 100]))
+      ladder.remove(1001, 500)
+      ladder.remove(1005, 10)
+      self.assertEqual(ladder.levels().flat(), [1002, 100])
+
+class DepthTest(StubTestCase):
+
+   def setUp(self):
+      super(DepthTest, self).setUp()
+      numpy.random.seed(0)
+      DEPTHS.local.clear()
+
+   def test_levels_are_stored_packed(self):
+      make_depth().put()
+      stored = Depth.key_for('ABC').get(use_cache=False)
+      self.assertEqual(stored.bid_levels.flat(), [999, 100, 998, 100, 997, 100])
+      self.assertEqual(stored.ask_levels.flat(), [1001, 100, 1002, 100, 1003, 100])
+
+   def test_fill_records_the_volume_taken(self):
+      depth = make_depth()
+      filled, price = depth.fill('buy', 150)
+      self.assertEqual(filled, 150)
+      self.assertAlmostEqual(price, (100 * 10.01 + 50 * 10.02) / 150)
+      self.assertEqual(depth.fill('sell', 50, limit=9.99), (50, 9.99))
+      self.assertEqual(depth.fill('sell', 50, limit=10.5), (0, None))
+      self.assertEqual(depth.taken(), [('ask', 1001, 100), ('ask', 1002, 50), ('bid', 999, 50)])
+      self.assertEqual(depth.ask_levels.flat(), [1002, 50, 1003, 100])
+
+   def test_copy_is_not_changed_by_fills(self):
+      depth = make_depth()
+      copy = depth.copy()
+      depth.fill('buy', 150)
+      self.assertEqual(copy.key, depth.key)
+      self.assertEqual(copy.ask_levels.flat(), [1001, 100, 1002, 100, 1003, 100])
+      self.assertEqual(copy.taken(), [])
+
+   def test_is_fresh(self):
+      now = datetime.datetime.utcnow()
+      self.assertTrue(make_depth(refreshed=now).is_fresh(now))
+      self.assertFalse(make_depth(refreshed=now - Depth.FRESH_FOR).is_fresh(now))
+      self.assertFalse(Depth(stock='ABC', max_bid=1.0, min_ask=1.0).is_fresh(now))
+
+   def test_update_stamps_the_refresh(self):
+      stale = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+      depth = make_depth(refreshed=stale)
+      depth.update(9.95, 10.05, 1000000)
+      self.assertGreater(depth.refreshed, stale)
+      self.assertEqual(depth.bid_levels.prices[0], 995)
+      self.assertEqual(depth.ask_levels.prices[0], 1005)
+
+   def test_save_fills_writes_the_depth_as_filled(self):
+      make_depth().put()
+      depth = Depth.key_for('ABC').get(use_cache=False)
+      depth.read_at = depth.refreshed
+      depth.fill('buy', 150)
+      written = Depth.save_fills([depth])
+      self.assertIs(written[0], depth)
+      stored = Depth.key_for('ABC').get(use_cache=False)
+      self.assertEqual(stored.ask_levels.flat(), [1002, 50, 1003, 100])
+
+   def test_save_fills_keeps_a_refresh_made_meanwhile(self):
+      read_at = datetime.datetime.utcnow() - datetime.timedelta(minutes=1)
+      make_depth(refreshed=read_at).put()
+      depth = Depth.key_for('ABC').get(use_cache=False)
+      depth.read_at = depth.refreshed
+      depth.fill('buy', 150)
+
+      # The cron refreshes the depth before the fills are written
+      refreshed = Depth.key_for('ABC').get(use_cache=False)
+      refreshed.ask_levels = Levels([1001, 1002, 1004], [300, 300, 300])
+      refreshed.refreshed = datetime.datetime.utcnow()
+      refreshed.put()
+
+      written = Depth.save_fills([depth])
+      stored = Depth.key_for('ABC').get(use_cache=False)
+      self.assertEqual(stored.refreshed, refreshed.refreshed)
+      self.assertEqual(stored.ask_levels.flat(), [1001, 200, 1002, 250, 1004, 300])
+      self.assertEqual(written[0].ask_levels.flat(), stored.ask_levels.flat())
+
+   def test_save_fills_writes_a_new_depth(self):
+      depth = make_depth()
+      depth.read_at = None
+      depth.fill('sell', 10)
+      Depth.save_fills([depth])
+      stored = Depth.key_for('ABC').get(use_cache=False)
+      self.assertEqual(stored.bid_levels.flat(), [999, 90, 998, 100, 997, 100])
+
+   def test_refresh_updates_every_quoted_stock(self):
+      # More stocks than fit in one cross-group transaction
+      stocks = ['S%02d' % i for i in range(Depth.BATCH_GROUPS + 3)]
+      share_dict = dict((stock, quote(9.99, 10.01)) for stock in stocks)
+      share_dict['BAD'] = {'Bid': 'N/A', 'Ask': '1.00', 'AverageDailyVolume': '100'}
+      depths = Depth.refresh(share_dict)
+      self.assertEqual(sorted(depth.stock for depth in depths), stocks)
+      self.assertIsNone(Depth.key_for('BAD').get(use_cache=False))
+
+      stored = Depth.key_for('S00').get(use_cache=False)
+      self.assertTrue(stored.is_fresh())
+      self.assertEqual(stored.bid_levels.prices[0], 999)
+      self.assertEqual(stored.ask_levels.prices[0], 1001)
+      cached = memcache.get(DepthCache.PREFIX + 'S00')
+      self.assertEqual(cached.ask_levels.flat(), stored.ask_levels.flat())
+      self.assertIsNot(cached, depths[0])
+
+      # A second refresh moves the existing depth to the new quote
+      Depth.refresh({'S00': quote(9.90, 9.95)})
+      stored = Depth.key_for('S00').get(use_cache=False)
+      self.assertEqual(stored.max_bid, 9.90)
+      self.assertEqual(stored.ask_levels.prices[0], 995)
+
+   def test_get_keeps_a_depth_refreshed_meanwhile(self):
+      data = {'stock': 'ABC', 'max_bid': 9.50, 'min_ask': 9.60, 'avg_volume': 1000000.0}
+      make_depth().put()
+      depth = Depth.get(data)
+      self.assertEqual(depth.max_bid, 9.99)
+      self.assertEqual(Depth.key_for('ABC').get(use_cache=False).max_bid, 9.99)
+
+   def test_get_updates_a_stale_depth(self):
+      data = {'stock': 'ABC', 'max_bid': 9.50, 'min_ask': 9.60, 'avg_volume': 1000000.0}
+      make_depth(refreshed=datetime.datetime.utcnow() - datetime.timedelta(hours=1)).put()
+      depth = Depth.get(data)
+      self.assertTrue(depth.is_fresh())
+      stored = Depth.key_for('ABC').get(use_cache=False)
+      self.assertEqual(stored.max_bid, 9.50)
+      self.assertEqual(stored.bid_levels.prices[0], 950)
+
+   def test_get_moves_a_legacy_depth(self):
+      data = {'stock': 'ABC', 'max_bid': 9.99, 'min_ask': 10.01, 'avg_volume': 1000000.0}
+      legacy = make_depth()
+      legacy.key = None
+      legacy.put()
+      Depth.get(data)
+      self.assertIsNone(legacy.key.get(use_cache=False))
+      self.assertEqual(Depth.key_for('ABC').get(use_cache=False).ask_levels.prices[0], 1001)
+
+   def test_cache_serves_a_stale_depth_while_regenerated_elsewhere(self):
+      data = {'stock': 'ABC', 'max_bid': 9.50, 'min_ask': 9.60, 'avg_volume': 1000000.0}
+      stale = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+      make_depth(refreshed=stale).put()
+      memcache.add(DepthCache.LOCK_PREFIX + 'ABC', 1)
+      depth = DEPTHS.get(data)
+      self.assertEqual(depth.max_bid, 9.99)
+      self.assertEqual(Depth.key_for('ABC').get(use_cache=False).refreshed, stale)
+
+      # A depth that does not exist yet is not stored
+      data['stock'] = 'XYZ'
+      memcache.add(DepthCache.LOCK_PREFIX + 'XYZ', 1)
+      self.assertEqual(DEPTHS.get(data).bid_levels.prices[0], 950)
+      self.assertIsNone(Depth.key_for('XYZ').get(use_cache=False))
+
+   def test_cache_regenerates_a_stale_depth_once(self):
+      data = {'stock': 'ABC', 'max_bid': 9.99, 'min_ask': 10.01, 'avg_volume': 1000000.0}
+      stale = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+      make_depth(refreshed=stale).put()
+      depth = DEPTHS.get(data)
+      self.assertTrue(depth.is_fresh())
+      self.assertIs(DEPTHS.get(data), DEPTHS.get_local('ABC', time.time()))
+      self.assertIsNot(DEPTHS.get_local('ABC', time.time()), depth)
+
+if __name__ == '__main__':
+   unittest.main()
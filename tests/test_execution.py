@@ -0,0 +1,204 @@
+"""Tests of order execution (py.execution)."""
+
+import datetime
+import unittest
+
+from google.appengine.ext import ndb
+
+from tests import StubTestCase
+from py.book import *
+from py.depth import *
+from py.player import *
+from py.position import *
+from py.transaction import *
+import py.execution as execution
+from py.execution import *
+
+def quote(bid=9.99, ask=10.01, last=10.0, volume=0):
+   """Makes a quote as in the quote snapshot. Without a volume, orders fill
+      in full at the bid or ask rather than against the depth.
+   """
+   return {'Bid': str(bid), 'Ask': str(ask), 'LastTradePriceOnly': str(last),
+      'AverageDailyVolume': str(volume)}
+
+def order(type='buy', subtype='market', stock='ABC', price=10.05, quantity=10, fee=20.0):
+   """Makes an order dictionary as placed by a client."""
+   return {'type': type, 'subtype': subtype, 'stock': stock, 'price': price,
+      'quantity': quantity, 'fee': fee}
+
+class ExecutionTest(StubTestCase):
+
+   def setUp(self):
+      super(ExecutionTest, self).setUp()
+      # Each test starts with empty order books
+      self.market = execution.MARKET
+      execution.MARKET = Market()
+      DEPTHS.local.clear()
+      self.player = Player(email='player@test', cash=50000.0, ledger=True)
+      self.player.put()
+
+   def tearDown(self):
+      execution.MARKET = self.market
+      super(ExecutionTest, self).tearDown()
+
+   def place(self, *orders):
+      """Places orders for the player, returning their Transactions."""
+      results = self.player.place_orders(list(orders))
+      self.assertEqual([error for (transaction, error) in results], [None] * len(orders))
+      ndb.get_context().clear_cache()
+      return [transaction for (transaction, error) in results]
+
+   def hold(self, quantity, stock='ABC', price=5.0):
+      """Gives the player a holding of a stock."""
+      Position(key=Position.key_for(self.player.key, stock), stock=stock,
+         quantity=quantity, bought=quantity, cost=quantity * price).put()
+
+   def stored_player(self):
+      return self.player.key.get(use_cache=False)
+
+   def stored_position(self, stock='ABC'):
+      return Position.key_for(self.player.key, stock).get(use_cache=False)
+
+   def fill_in_memory(self, transaction, share_quote):
+      """Executes a pending order against the player as read, as a shard
+         does before settling.
+
+      Returns:
+         The fill tuple for settle_fills.
+      """
+      order = transaction.key.get(use_cache=False)
+      player = self.player.key.get(use_cache=False)
+      bid, ask, last_price = quote_prices(share_quote)
+      quantity = order.quantity
+      cash = player.cash
+      executed = execute_order(order, player, bid, ask, last_price)
+      self.assertIs(executed, order)
+      return (order, executed, quantity, player.cash - cash)
+
+   def test_executes_a_triggered_market_buy(self):
+      transaction = self.place(order(price=10.05, quantity=10))[0]
+      self.assertEqual(execute_stocks(set(['ABC']), {'ABC': quote(ask=10.01)}), (1, 1))
+
+      executed = transaction.key.get(use_cache=False)
+      self.assertTrue(executed.executed)
+      self.assertEqual(executed.price, 10.01)
+      # The difference to the price placed at is refunded
+      self.assertAlmostEqual(self.stored_player().cash, 50000.0 - 20.0 - 100.1)
+      self.assertEqual(self.stored_position().quantity, 10)
+      self.assertNotIn(transaction.key, execution.MARKET.stocks)
+
+   def test_leaves_untriggered_and_other_stocks_pending(self):
+      limit, other = self.place(order(subtype='limit', price=9.0),
+         order(stock='XYZ', price=10.05))
+      share_dict = {'ABC': quote(ask=10.01), 'XYZ': quote(ask=10.01)}
+      self.assertEqual(execute_stocks(set(['ABC']), share_dict), (0, 0))
+      self.assertFalse(limit.key.get(use_cache=False).executed)
+      self.assertFalse(other.key.get(use_cache=False).executed)
+      self.assertEqual(self.stored_player().cash, 50000.0 - 40.0 - 90.0 - 100.5)
+
+   def test_settles_many_fills_in_batches(self):
+      # More orders than fit in one cross-group transaction with the player
+      count = SETTLE_GROUPS + 6
+      self.place(*[order(price=10.01, quantity=1)] * (count // 2))
+      self.place(*[order(price=10.01, quantity=1)] * (count - count // 2))
+      self.assertEqual(execute_stocks(set(['ABC']), {'ABC': quote(ask=10.01)}), (count, count))
+      self.assertEqual(Transaction.for_owner(self.player.key, executed=False).count(), 0)
+      self.assertEqual(self.stored_position().quantity, count)
+      self.assertAlmostEqual(self.stored_player().cash, 50000.0 - count * (20.0 + 10.01))
+
+   def test_partly_filled_order_stays_pending(self):
+      Depth(id='ABC', stock='ABC', max_bid=9.99, min_ask=10.01,
+         bid_levels=Levels([999], [100]), ask_levels=Levels([1001, 1010], [5, 100]),
+         refreshed=datetime.datetime.utcnow()).put()
+      transaction = self.place(order(subtype='limit', price=10.01, quantity=10))[0]
+      share_dict = {'ABC': quote(ask=10.01, volume=1000000)}
+      self.assertEqual(execute_stocks(set(['ABC']), share_dict), (1, 1))
+
+      pending = transaction.key.get(use_cache=False)
+      self.assertFalse(pending.executed)
+      self.assertEqual(pending.quantity, 5)
+      self.assertIn(transaction.key, execution.MARKET.stocks)
+      executed = Transaction.for_owner(self.player.key, executed=True).fetch()
+      self.assertEqual([(t.quantity, t.price) for t in executed], [(5, 10.01)])
+      self.assertEqual(self.stored_position().quantity, 5)
+      # The volume filled is taken from the stored depth
+      depth = Depth.key_for('ABC').get(use_cache=False)
+      self.assertEqual(depth.ask_levels.flat(), [1010, 100])
+
+   def set_cash(self, cash):
+      player = self.stored_player()
+      player.cash = cash
+      player.put()
+
+   def test_market_buy_needs_cash_for_the_whole_quantity(self):
+      transaction = self.place(order(price=10.05, quantity=100))[0]
+      # Enough for one share at the ask, but not for a hundred
+      self.set_cash(50.0)
+      execute_stocks(set(['ABC']), {'ABC': quote(ask=10.60)})
+      self.assertFalse(transaction.key.get(use_cache=False).executed)
+      self.assertEqual(self.stored_player().cash, 50.0)
+
+   def test_market_buy_needs_cash_at_the_depth_price(self):
+      Depth(id='ABC', stock='ABC', max_bid=9.99, min_ask=10.01,
+         bid_levels=Levels([999], [100]), ask_levels=Levels([1001, 1100], [5, 100]),
+         refreshed=datetime.datetime.utcnow()).put()
+      transaction = self.place(order(price=10.05, quantity=10))[0]
+      # Enough at the ask, but not at the 10.505 the depth fills at
+      self.set_cash(4.0)
+      execute_stocks(set(['ABC']), {'ABC': quote(ask=10.01, volume=1000000)})
+      self.assertFalse(transaction.key.get(use_cache=False).executed)
+      self.assertEqual(self.stored_player().cash, 4.0)
+      # Nothing is taken from the depth
+      depth = Depth.key_for('ABC').get(use_cache=False)
+      self.assertEqual(depth.ask_levels.flat(), [1001, 5, 1100, 100])
+
+   def test_settlement_keeps_cash_changed_by_another_shard(self):
+      self.hold(10)
+      transaction = self.place(order(type='sell', subtype='market', price=0.0, quantity=10))
+      fill = self.fill_in_memory(transaction[0], quote(bid=9.99))
+      self.assertAlmostEqual(fill[3], 99.9)
+
+      # Another shard settles a fill of the same player meanwhile
+      stored = self.stored_player()
+      stored.cash += 1000.0
+      stored.put()
+
+      settled = settle_fills(self.player.key, [fill])
+      self.assertEqual(settled, [fill[1]])
+      self.assertAlmostEqual(self.stored_player().cash, 50000.0 - 20.0 + 1000.0 + 99.9)
+      self.assertAlmostEqual(settled[0].cashHistory, self.stored_player().cash)
+      self.assertTrue(transaction[0].key.get(use_cache=False).executed)
+
+   def test_settlement_skips_an_order_cancelled_meanwhile(self):
+      transaction = self.place(order(price=10.05, quantity=10))[0]
+      fill = self.fill_in_memory(transaction, quote(ask=10.01))
+      self.player.delete_transaction(transaction.key)
+
+      self.assertEqual(settle_fills(self.player.key, [fill]), [])
+      self.assertIsNone(transaction.key.get(use_cache=False))
+      self.assertAlmostEqual(self.stored_player().cash, 50000.0 - 20.0)
+      self.assertEqual(self.stored_position().quantity, 0)
+
+class ExecutionLeaseTest(StubTestCase):
+
+   def test_a_stock_is_leased_to_one_run_at_a_time(self):
+      self.assertEqual(ExecutionLease.acquire(['ABC', 'XYZ'], 1), ['ABC', 'XYZ'])
+      self.assertEqual(ExecutionLease.acquire(['ABC', 'DEF'], 2), ['DEF'])
+      # A retried task takes its own leases again
+      self.assertEqual(ExecutionLease.acquire(['ABC'], 1), ['ABC'])
+
+   def test_release_keeps_the_leases_of_other_runs(self):
+      ExecutionLease.acquire(['ABC', 'XYZ'], 1)
+      ExecutionLease.release(['ABC', 'XYZ'], 2)
+      self.assertEqual(ExecutionLease.acquire(['ABC', 'XYZ'], 2), [])
+      ExecutionLease.release(['ABC'], 1)
+      self.assertEqual(ExecutionLease.acquire(['ABC', 'XYZ'], 2), ['ABC'])
+
+   def test_a_lapsed_lease_is_taken_over(self):
+      ExecutionLease(id='ABC', run=1,
+         expires=datetime.datetime.utcnow() - datetime.timedelta(seconds=1)).put()
+      self.assertEqual(ExecutionLease.acquire(['ABC'], 2), ['ABC'])
+      self.assertEqual(ExecutionLease.get_by_id('ABC', use_cache=False).run, 2)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,75 @@
+"""Tests of the request handlers added for the charts, updates and admin
+   reports (user_system).
+"""
+
+import datetime
+import json
+import os
+import unittest
+
+import webapp2
+
+from tests import StubTestCase
+from py.intraday import *
+from py.push import *
+import user_system
+
+class HandlerTest(StubTestCase):
+
+   def setUp(self):
+      super(HandlerTest, self).setUp()
+      set_broker(LocalBroker())
+
+   def tearDown(self):
+      set_broker(None)
+      super(HandlerTest, self).tearDown()
+
+   def get(self, url):
+      return webapp2.Request.blank(url).get_response(user_system.application)
+
+   def test_intraday_serves_the_bars_of_a_day(self):
+      BARS.record({'ABC': {'LastTradePriceOnly': '1.50'}}, datetime.datetime(2015, 3, 1, 23, 0))
+      response = self.get('/intraday?symbol=ABC&date=2015-03-02')
+      self.assertEqual(response.status_int, 200)
+      bars = json.loads(response.body)
+      self.assertEqual(bars['time'], ['10:00'])
+      self.assertEqual(bars['close'], [1.5])
+      self.assertEqual(json.loads(self.get('/intraday?symbol=ABC&date=2015-03-03').body)['time'], [])
+
+   def test_intraday_rejects_a_missing_symbol_or_bad_date(self):
+      self.assertEqual(self.get('/intraday?date=2015-03-02').status_int, 400)
+      self.assertEqual(self.get('/intraday?symbol=ABC&date=March').status_int, 400)
+
+   def test_updates_subscribe_from_the_latest_event(self):
+      get_broker().publish([{'type': 'quotes', 'quotes': {}}])
+      response = self.get('/updates?symbols=ABC')
+      self.assertEqual(response.status_int, 200)
+      self.assertEqual(json.loads(response.body)['seq'], 1)
+      self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+   def test_updates_reject_bad_parameters(self):
+      self.assertEqual(self.get('/updates?since=-1').status_int, 400)
+      self.assertEqual(self.get('/updates?since=x').status_int, 400)
+      symbols = ','.join('S%d' % i for i in range(user_system.UpdatesHandler.MAX_SYMBOLS + 1))
+      self.assertEqual(self.get('/updates?symbols=' + symbols).status_int, 400)
+
+   def test_portfolio_needs_a_player(self):
+      self.assertEqual(self.get('/portfolio').status_int, 404)
+
+   def test_metrics_report(self):
+      response = self.get('/admin/metrics')
+      self.assertEqual(response.status_int, 200)
+      self.assertEqual(json.loads(response.body)['buckets_ms'], user_system.BUCKETS_MS)
+
+   def test_profile_report(self):
+      secret = os.environ.pop('PROFILE_SECRET', None)
+      try:
+         self.assertEqual(self.get('/admin/profile?token=1').status_int, 404)
+      finally:
+         if secret is not None:
+            os.environ['PROFILE_SECRET'] = secret
+      report = json.loads(self.get('/admin/profile').body)
+      self.assertEqual((report['samples'], report['top']), (0, []))
+
+if __name__ == '__main__':
+   unittest.main()
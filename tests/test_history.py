@@ -0,0 +1,67 @@
+"""Tests of paging through a player's history (py.player)."""
+
+import base64
+import datetime
+import json
+import unittest
+
+from tests import StubTestCase
+from py.player import *
+from py.transaction import *
+
+class HistoryPageTest(StubTestCase):
+
+   def setUp(self):
+      super(HistoryPageTest, self).setUp()
+      self.player = Player(email='player@test', cash=50000.0, ledger=True)
+      self.player.put()
+      self.start = datetime.datetime(2015, 3, 2)
+
+   def executed(self, type, price, days, stock='ABC'):
+      """Stores an executed transaction of the player a number of days after
+         the start.
+      """
+      Transaction(type=type, subtype='market', stock=stock, price=price, quantity=10,
+         executed=True, fee=20.0, cashHistory=50000.0, owner=self.player.key,
+         timestamp=self.start + datetime.timedelta(days=days)).put()
+
+   def test_pages_carry_the_average_purchase_price(self):
+      self.executed('buy', 10.0, 0)
+      self.executed('buy', 20.0, 1)
+      self.executed('sell', 18.0, 2)
+
+      first, token = self.player.get_history_page(page_size=2)
+      self.assertEqual([t['price'] for t in first], [10.0, 20.0])
+      self.assertIsNotNone(token)
+      second, token = self.player.get_history_page(token, page_size=2)
+      self.assertIsNone(token)
+      self.assertEqual(len(second), 1)
+      self.assertAlmostEqual(second[0]['net_gain'], 10 * (18.0 - 15.0))
+
+   def test_range_starts_with_the_earlier_averages(self):
+      self.executed('buy', 10.0, 0)
+      self.executed('sell', 12.0, 5)
+      page, token = self.player.get_history_page(page_size=10,
+         start=self.start + datetime.timedelta(days=1))
+      self.assertEqual([t['type'] for t in page], ['sell'])
+      self.assertAlmostEqual(page[0]['net_gain'], 20.0)
+
+   def test_rejects_malformed_tokens(self):
+      self.executed('buy', 10.0, 0)
+      self.executed('buy', 20.0, 1)
+      token = self.player.get_history_page(page_size=1)[1]
+      state = json.loads(base64.urlsafe_b64decode(str(token)))
+
+      def encode(value):
+         return base64.urlsafe_b64encode(json.dumps(value))
+      for bad in ['not a token', u'é', encode([1, 2]), encode({}),
+         encode({'cursor': state['cursor']}),
+         encode({'cursor': state['cursor'], 'averages': []}),
+         encode({'cursor': state['cursor'], 'averages': {'ABC': 1}}),
+         encode({'cursor': state['cursor'], 'averages': {'ABC': ['x', 1]}}),
+         encode({'cursor': 'bad', 'averages': {}})]:
+         with self.assertRaises(ValueError):
+            self.player.get_history_page(bad, page_size=1)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,72 @@
+"""Tests of the intraday bars (py.intraday)."""
+
+import datetime
+import unittest
+
+from google.appengine.api import memcache
+
+from tests import StubTestCase
+from py.intraday import *
+
+# 10:00 in Sydney
+OPEN = datetime.datetime(2015, 3, 1, 23, 0)
+DAY = datetime.date(2015, 3, 2)
+
+def snapshot(last, bid=None, ask=None):
+   """Makes a quote snapshot of one stock."""
+   quote = {'LastTradePriceOnly': str(last)}
+   if bid is not None:
+      quote.update({'Bid': str(bid), 'Ask': str(ask)})
+   return {'ABC': quote}
+
+class IntradayBarsTest(StubTestCase):
+
+   def setUp(self):
+      super(IntradayBarsTest, self).setUp()
+      self.bars = IntradayBars()
+
+   def record(self, minutes, *args, **kwargs):
+      self.bars.record(snapshot(*args, **kwargs), OPEN + datetime.timedelta(minutes=minutes))
+
+   def test_snapshots_make_one_bar_a_minute(self):
+      self.record(0, 10.0, 9.99, 10.01)
+      self.record(0.25, 10.5)
+      self.record(0.5, 9.5)
+      self.record(0.75, 9.8, 9.79, 9.82)
+      self.record(1, 9.9)
+      series = self.bars.get('ABC', DAY)
+      self.assertEqual(series['time'], ['10:00', '10:01'])
+      self.assertEqual(series['open'], [10.0, 9.9])
+      self.assertEqual(series['high'], [10.5, 9.9])
+      self.assertEqual(series['low'], [9.5, 9.9])
+      self.assertEqual(series['close'], [9.8, 9.9])
+      self.assertAlmostEqual(series['spread'][0], 0.03)
+      self.assertEqual(self.bars.get('XYZ', DAY)['time'], [])
+
+   def test_every_tick_stores_its_batch(self):
+      for minute in range(BarBuffer.BATCH + 2):
+         self.record(minute, 10.0 + minute / 100.0)
+      batches = IntradayBatch.query(IntradayBatch.day == DAY).fetch()
+      self.assertEqual(len(batches), 2)
+      self.assertEqual(sorted(len(batch.unpack()[0]) for batch in batches),
+         [2, BarBuffer.BATCH])
+
+   def test_evicted_ring_is_restored_from_the_stored_batch(self):
+      self.record(0, 10.0)
+      self.record(1, 11.0)
+      memcache.flush_all()
+      self.record(1.5, 12.0)
+      self.record(2, 13.0)
+      series = self.bars.get('ABC', DAY)
+      self.assertEqual(series['time'], ['10:00', '10:01', '10:02'])
+      self.assertEqual(series['open'], [10.0, 11.0, 13.0])
+      self.assertEqual(series['close'], [10.0, 12.0, 13.0])
+
+   def test_a_new_day_starts_a_new_ring(self):
+      self.record(0, 10.0)
+      self.record(24 * 60, 11.0)
+      self.assertEqual(self.bars.get('ABC', DAY)['close'], [10.0])
+      self.assertEqual(self.bars.get('ABC', DAY + datetime.timedelta(days=1))['close'], [11.0])
+
+if __name__ == '__main__':
+   unittest.main()
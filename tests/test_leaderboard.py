@@ -0,0 +1,80 @@
+"""Tests of the leaderboard snapshots (py.leaderboard)."""
+
+import unittest
+
+from google.appengine.ext import testbed
+
+from tests import StubTestCase
+from py.leaderboard import *
+
+class NoQuotes(QuoteProvider):
+   """Has no quote for any stock."""
+
+   def get_quotes(self, symbols, fields=FIELDS):
+      return {}
+
+class LeaderboardTest(StubTestCase):
+
+   def setUp(self):
+      super(LeaderboardTest, self).setUp()
+      set_provider(NoQuotes())
+      QUOTES.local.clear()
+      QUOTES.set({'ABC': {'LastTradePriceOnly': '2.00'}})
+
+   def tearDown(self):
+      set_provider(None)
+      super(LeaderboardTest, self).tearDown()
+
+   def player(self, email, cash, holdings=()):
+      """Stores a player with a position in each (stock, quantity, cost)."""
+      player = Player(email=email, cash=cash, ledger=True)
+      player.put()
+      for stock, quantity, cost in holdings:
+         Position(key=Position.key_for(player.key, stock), stock=stock,
+            quantity=quantity, bought=quantity, cost=cost).put()
+      return player
+
+   def test_build_without_players(self):
+      snapshot = LeaderboardSnapshot.build()
+      self.assertEqual(snapshot.count, 0)
+      self.assertTrue(snapshot.complete)
+      self.assertEqual(snapshot.page(0, 100), [])
+
+   def test_build_ranks_players_by_total_value(self):
+      self.player('cash@test', 1000.0)
+      # Holdings without a quote are valued at what was paid for them
+      self.player('shares@test', 100.0, [('ABC', 1000, 1000.0), ('XYZ', 10, 50.0)])
+      pending = self.player('pending@test', 500.0)
+      Transaction(type='buy', subtype='limit', stock='ABC', price=1.0, quantity=600,
+         executed=False, fee=0.0, owner=pending.key).put()
+
+      snapshot = LeaderboardSnapshot.build()
+      rows = snapshot.page(0, 10)
+      self.assertEqual([(row[0], row[-2], row[-1]) for row in rows],
+         [('shares@test', 2150.0, 1), ('pending@test', 1100.0, 2), ('cash@test', 1000.0, 3)])
+      self.assertEqual(rows[0][4], 2050.0)
+      self.assertEqual(rows[1][5], 600.0)
+      self.assertEqual(snapshot.rank_of('cash@test')[-1], 3)
+      self.assertIsNone(snapshot.rank_of('nobody@test'))
+
+   def test_pages_span_several_stored_pages(self):
+      for i in range(LeaderboardSnapshot.PAGE_SIZE + 5):
+         self.player('p%03d@test' % i, 1000.0 + i)
+      snapshot = LeaderboardSnapshot.build()
+      rows = snapshot.page(LeaderboardSnapshot.PAGE_SIZE - 2, 4)
+      self.assertEqual([row[-1] for row in rows], range(99, 103))
+      self.assertEqual(rows[0][0], 'p006@test')
+      self.assertEqual(snapshot.rank_of('p000@test')[-1], LeaderboardSnapshot.PAGE_SIZE + 5)
+
+   def test_current_requests_the_first_snapshot_from_the_task(self):
+      taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+      self.assertIsNone(LeaderboardSnapshot.current())
+      self.assertIsNone(LeaderboardSnapshot.current())
+      self.assertEqual(len(taskqueue.get_filtered_tasks(url='/tasks/leaderboard')), 1)
+      self.assertEqual(LeaderboardSnapshot.query().count(), 0)
+
+      built = LeaderboardSnapshot.build()
+      self.assertEqual(LeaderboardSnapshot.current().key, built.key)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,91 @@
+"""Tests of the request metrics (py.metrics)."""
+
+import unittest
+
+import webapp2
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+from tests import StubTestCase
+from py.metrics import *
+
+class Page(webapp2.RequestHandler):
+   def get(self):
+      tag_request('quotes')
+      memcache.get_multi(['a', 'b'])
+      self.response.write('ok')
+
+class Broken(webapp2.RequestHandler):
+   def get(self):
+      raise RuntimeError()
+
+application = webapp2.WSGIApplication([('/page', Page), ('/broken', Broken)])
+
+def call(path):
+   """Calls the application through the middleware, returning its status."""
+   response = []
+   environ = webapp2.Request.blank(path).environ
+   try:
+      MetricsMiddleware(application, application.router)(environ,
+         lambda status, headers, exc_info=None: response.append(status))
+   except RuntimeError:
+      pass
+   return response[-1] if response else None
+
+class MetricsTest(StubTestCase):
+
+   def setUp(self):
+      super(MetricsTest, self).setUp()
+      METRICS.series.clear()
+      METRICS.calls.clear()
+      # The hooks go on the API proxy of the testbed
+      for service in SERVICES:
+         apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'metrics_' + service, METRICS.before_call, service)
+         apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'metrics_' + service, METRICS.after_call, service)
+
+   def test_buckets(self):
+      self.assertEqual(bucket(0), 0)
+      self.assertEqual(bucket(5), 0)
+      self.assertEqual(bucket(6), 1)
+      self.assertEqual(bucket(BUCKETS_MS[-1] + 1), len(BUCKETS_MS))
+
+   def test_counts_requests_by_handler_and_tag(self):
+      memcache.set('a', 1)
+      self.assertEqual(call('/page'), '200 OK')
+      series = METRICS.series['Page.get']
+      self.assertEqual(series['requests'], 1)
+      self.assertEqual(series['errors'], 0)
+      self.assertEqual(series['calls']['memcache.Get'][0], 1)
+      self.assertEqual((series['memcache_hits'], series['memcache_misses']), (1, 1))
+      self.assertEqual(sum(series['histogram']), 1)
+      self.assertEqual(METRICS.series['Page.get:quotes']['requests'], 1)
+      self.assertIsNone(METRICS.current())
+
+   def test_counts_failed_and_unmatched_requests(self):
+      call('/broken')
+      self.assertEqual(METRICS.series['Broken.get']['errors'], 1)
+      # webapp2 answers an unknown path with a 404 of its own
+      self.assertEqual(call('/missing'), '404 Not Found')
+      self.assertEqual(METRICS.series['unmatched']['errors'], 0)
+
+   def test_calls_outside_a_request_are_not_counted(self):
+      memcache.get('a')
+      self.assertEqual(METRICS.calls, {})
+
+   def test_collects_the_totals_of_every_instance(self):
+      other = Metrics()
+      other.instance = 'other'
+      other.end(RequestStats('Page.get'), 200, 12.0)
+      other.publish(other.snapshot())
+      call('/page')
+
+      merged = METRICS.collect()
+      self.assertEqual(merged['instances'], 2)
+      self.assertEqual(merged['series']['Page.get']['requests'], 2)
+      self.assertEqual(merged['buckets_ms'], BUCKETS_MS)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,147 @@
+"""Tests of placing and cancelling orders against a player's positions
+   (py.player and py.position).
+"""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+from tests import StubTestCase
+from py.player import *
+from py.position import *
+from py.transaction import *
+
+def order(type='buy', subtype='limit', stock='ABC', price=10.0, quantity=10, fee=20.0):
+   """Makes an order dictionary as placed by a client."""
+   return {'type': type, 'subtype': subtype, 'stock': stock, 'price': price,
+      'quantity': quantity, 'fee': fee}
+
+class PositionTest(StubTestCase):
+
+   def setUp(self):
+      super(PositionTest, self).setUp()
+      self.player = Player(email='player@test', cash=50000.0, ledger=True)
+      self.player.put()
+
+   def stored_player(self):
+      return self.player.key.get(use_cache=False)
+
+   def stored_position(self, stock='ABC'):
+      return Position.key_for(self.player.key, stock).get(use_cache=False)
+
+   def hold(self, quantity, stock='ABC', price=5.0):
+      """Gives the player a holding of a stock."""
+      Position(key=Position.key_for(self.player.key, stock), stock=stock,
+         quantity=quantity, bought=quantity, cost=quantity * price).put()
+
+   def test_buy_takes_the_cost_and_fee(self):
+      results = self.player.place_orders([order(price=10.0, quantity=10, fee=20.0)])
+      self.assertEqual(len(results), 1)
+      transaction, error = results[0]
+      self.assertIsNone(error)
+      self.assertEqual(transaction.owner, self.player.key)
+      self.assertEqual(self.stored_player().cash, 50000.0 - 20.0 - 100.0)
+      self.assertEqual(self.player.cash, self.stored_player().cash)
+      self.assertFalse(transaction.key.get(use_cache=False).executed)
+
+   def test_sell_reserves_the_shares(self):
+      self.hold(30)
+      results = self.player.place_orders([order(type='sell', quantity=20)])
+      self.assertEqual([error for (transaction, error) in results], [None])
+      position = self.stored_position()
+      self.assertEqual(position.quantity, 30)
+      self.assertEqual(position.reserved, 20)
+      self.assertEqual(self.stored_player().cash, 50000.0 - 20.0)
+
+   def test_rejects_what_the_player_cannot_afford(self):
+      self.hold(30)
+      results = self.player.place_orders([
+         order(type='sell', quantity=20),
+         order(type='sell', quantity=20),
+         order(price=10000.0, quantity=10),
+         {'type': 'swap'},
+      ])
+      self.assertEqual([error for (transaction, error) in results],
+         [None, 'Not enough shares', 'Not enough cash', 'Invalid order'])
+      self.assertIsNotNone(results[0][0])
+      self.assertEqual([transaction for (transaction, error) in results[1:]], [None] * 3)
+      self.assertEqual(self.stored_position().reserved, 20)
+      self.assertEqual(Transaction.for_owner(self.player.key).count(), 1)
+
+   def test_rejects_too_many_orders(self):
+      with self.assertRaises(ValueError):
+         self.player.place_orders([order()] * (Player.MAX_ORDERS + 1))
+
+   def test_placement_keeps_changes_made_meanwhile(self):
+      self.hold(30)
+      # A fill settled by an execution shard after the player was read
+      stored = self.stored_player()
+      stored.cash += 1000.0
+      stored.put()
+      position = self.stored_position()
+      position.quantity = 10
+      position.put()
+
+      results = self.player.place_orders([order(type='sell', quantity=20), order(quantity=1)])
+      self.assertEqual([error for (transaction, error) in results], ['Not enough shares', None])
+      self.assertEqual(self.stored_player().cash, 51000.0 - 20.0 - 10.0)
+      self.assertEqual(self.player.cash, self.stored_player().cash)
+
+   def test_cancel_refunds_a_buy(self):
+      transaction = self.player.place_orders([order(price=10.0, quantity=10)])[0][0]
+      self.player.delete_transaction(transaction.key)
+      self.assertIsNone(transaction.key.get(use_cache=False))
+      # The fee is kept
+      self.assertEqual(self.stored_player().cash, 50000.0 - 20.0)
+      self.assertEqual(self.player.cash, 50000.0 - 20.0)
+
+   def test_cancel_releases_a_sell(self):
+      self.hold(30)
+      transaction = self.player.place_orders([order(type='sell', quantity=20)])[0][0]
+      self.player.delete_transaction(transaction.key)
+      self.assertEqual(self.stored_position().reserved, 0)
+      self.assertEqual(self.stored_position().quantity, 30)
+
+   def test_cancel_keeps_changes_made_meanwhile(self):
+      transaction = self.player.place_orders([order(price=10.0, quantity=10)])[0][0]
+      stored = self.stored_player()
+      stored.cash += 1000.0
+      stored.put()
+      self.player.delete_transaction(transaction.key)
+      self.assertEqual(self.stored_player().cash, 51000.0 - 20.0)
+
+   def test_cancel_rejects_an_executed_order(self):
+      transaction = self.player.place_orders([order()])[0][0]
+      stored = transaction.key.get(use_cache=False)
+      stored.executed = True
+      stored.put()
+      with self.assertRaises(ValueError):
+         self.player.delete_transaction(transaction.key)
+      self.assertIsNotNone(transaction.key.get(use_cache=False))
+
+   def test_cancel_rejects_another_players_order(self):
+      other = Player(email='other@test', cash=50000.0, ledger=True)
+      other.put()
+      transaction = other.place_orders([order()])[0][0]
+      with self.assertRaises(ValueError):
+         self.player.delete_transaction(transaction.key)
+
+   def test_replay_matches_the_ledger(self):
+      self.player.place_orders([order(price=10.0, quantity=10)])
+      bought = Transaction.for_owner(self.player.key).get()
+      bought.executed = True
+      bought.put()
+      position = self.stored_position()
+      position.execute(bought)
+      position.put()
+      self.player.place_orders([order(type='sell', quantity=4)])
+
+      transactions = Transaction.for_owner(self.player.key).fetch()
+      replayed = Position.replay(self.player.key, transactions)['ABC']
+      self.assertFalse(replayed.differs(self.stored_position()))
+      self.assertEqual(replayed.quantity, 10)
+      self.assertEqual(replayed.reserved, 4)
+      self.assertEqual(replayed.purchase_price(), 10.0)
+
+if __name__ == '__main__':
+   unittest.main()
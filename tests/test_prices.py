@@ -0,0 +1,109 @@
+"""Tests of the price history store (py.history) and its endpoint."""
+
+import datetime
+import json
+import unittest
+
+import webapp2
+
+from tests import StubTestCase
+from py.history import *
+from py.quotes import get_symbols
+import user_system
+
+START = datetime.date(2015, 1, 5)
+END = datetime.date(2015, 1, 9)
+
+class CountingSource(HistorySource):
+   """Has a price for every stock on every day, counting the stocks asked
+      for, and fails for the stocks in 'failing'.
+   """
+   def __init__(self, failing=()):
+      self.asked = []
+      self.failing = set(failing)
+
+   def get_history(self, stock, start, end):
+      self.asked.append(stock)
+      if stock in self.failing:
+         return None
+      days = (end - start).days + 1
+      return PriceSeries.from_rows([(start + datetime.timedelta(days=i), 1, 2, 0.5, 1.5, 100)
+         for i in range(days)])
+
+class PriceStoreTest(StubTestCase):
+
+   def setUp(self):
+      super(PriceStoreTest, self).setUp()
+      self.source = CountingSource(failing=['BAD'])
+      set_source(self.source)
+
+   def tearDown(self):
+      set_source(None)
+      super(PriceStoreTest, self).tearDown()
+
+   def test_fetches_a_range_once(self):
+      history = PriceStore().get(['ABC'], START, END)
+      self.assertEqual(len(history['ABC']), 5)
+      self.assertEqual(history['ABC'].column('close')[0], 150)
+      history = PriceStore().get(['ABC'], START + datetime.timedelta(days=1), END)
+      self.assertEqual(len(history['ABC']), 4)
+      self.assertEqual(self.source.asked, ['ABC'])
+
+   def test_load_fetches_at_most_some_stocks(self):
+      store = PriceStore()
+      history, unloaded = store.load(['ABC', 'DEF', 'XYZ'], START, END, max_fetch=2)
+      self.assertEqual(self.source.asked, ['ABC', 'DEF'])
+      self.assertEqual(unloaded, ['XYZ'])
+      self.assertEqual(len(history['XYZ']), 0)
+
+      # The next request fetches the rest
+      history, unloaded = store.load(['ABC', 'DEF', 'XYZ'], START, END, max_fetch=2)
+      self.assertEqual(self.source.asked, ['ABC', 'DEF', 'XYZ'])
+      self.assertEqual(unloaded, [])
+      self.assertEqual(len(history['XYZ']), 5)
+
+   def test_failed_fetch_is_tried_again(self):
+      history, unloaded = PriceStore().load(['BAD', 'ABC'], START, END)
+      self.assertEqual(unloaded, ['BAD'])
+      PriceStore().load(['BAD', 'ABC'], START, END)
+      self.assertEqual(self.source.asked, ['BAD', 'ABC', 'BAD'])
+
+class HistoryHandlerTest(StubTestCase):
+
+   def setUp(self):
+      super(HistoryHandlerTest, self).setUp()
+      self.source = CountingSource()
+      set_source(self.source)
+
+   def tearDown(self):
+      set_source(None)
+      super(HistoryHandlerTest, self).tearDown()
+
+   def get(self, symbols):
+      request = webapp2.Request.blank('/history?symbols=%s&start=%s&end=%s'
+         % (','.join(symbols), START, END))
+      return request.get_response(user_system.application)
+
+   def test_serves_the_stocks_in_the_market(self):
+      symbols = get_symbols()[:2] + ['ASX.AX']
+      response = self.get(symbols)
+      self.assertEqual(response.status_int, 200)
+      self.assertEqual(sorted(json.loads(response.body).keys()), sorted(symbols))
+      self.assertIn('max-age', response.headers['Cache-Control'])
+
+   def test_rejects_unknown_and_too_many_stocks(self):
+      self.assertEqual(self.get(['NOTASTOCK']).status_int, 400)
+      self.assertEqual(self.get(get_symbols()[:1] + ['NOTASTOCK']).status_int, 400)
+      symbols = get_symbols()[:user_system.HistoryHandler.MAX_SYMBOLS + 1]
+      self.assertEqual(self.get(symbols).status_int, 400)
+      self.assertEqual(self.source.asked, [])
+
+   def test_incomplete_response_is_not_cached(self):
+      symbols = get_symbols()[:user_system.HistoryHandler.MAX_FETCH + 1]
+      response = self.get(symbols)
+      self.assertEqual(response.status_int, 200)
+      self.assertEqual(len(self.source.asked), user_system.HistoryHandler.MAX_FETCH)
+      self.assertNotIn('max-age', response.headers.get('Cache-Control', ''))
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,97 @@
+"""Tests of the request profiler (py.profiler)."""
+
+import marshal
+import os
+import unittest
+
+from google.appengine.api import datastore_errors
+
+from tests import StubTestCase
+from py.profiler import *
+
+def work(count):
+   """Does something worth profiling."""
+   return sum(i * i for i in range(count))
+
+def app(environ, start_response):
+   """A WSGI application with some work to profile."""
+   work(1000)
+   start_response('200 OK', [])
+   return ['done']
+
+def call(middleware, environ=None):
+   """Calls a WSGI application, returning its status and body."""
+   response = []
+   body = middleware(environ or {}, lambda status, headers, exc_info=None: response.append(status))
+   return response[0], ''.join(body)
+
+class ProfilerTest(StubTestCase):
+
+   def setUp(self):
+      super(ProfilerTest, self).setUp()
+      self.environ = dict(os.environ)
+      os.environ['PROFILE_SECRET'] = 'secret'
+      os.environ.pop('PROFILE_SAMPLE_RATE', None)
+
+   def tearDown(self):
+      os.environ.clear()
+      os.environ.update(self.environ)
+      super(ProfilerTest, self).tearDown()
+
+   def header(self, token):
+      return {'HTTP_X_PROFILE': token}
+
+   def test_profiles_requests_with_a_signed_token(self):
+      self.assertTrue(should_profile(self.header(make_token())))
+      self.assertFalse(should_profile({}))
+      self.assertFalse(should_profile(self.header(make_token(seconds=-1))))
+      expires = make_token().split(':')[0]
+      self.assertFalse(should_profile(self.header(expires + ':forged')))
+      self.assertFalse(should_profile(self.header('nonsense')))
+
+   def test_sampling_rate(self):
+      os.environ['PROFILE_SAMPLE_RATE'] = '1'
+      self.assertTrue(should_profile({}))
+      os.environ['PROFILE_SAMPLE_RATE'] = '0'
+      self.assertFalse(should_profile({}))
+
+   def test_stores_a_sample_of_a_profiled_request(self):
+      middleware = ProfilerMiddleware(app)
+      self.assertEqual(call(middleware), ('200 OK', 'done'))
+      self.assertEqual(ProfileSample.query().count(), 0)
+
+      self.assertEqual(call(middleware, self.header(make_token())), ('200 OK', 'done'))
+      samples = ProfileSample.recent()
+      self.assertEqual(len(samples), 1)
+      self.assertEqual(samples[0].route, 'unmatched')
+      names = [row['function'] for row in top_functions(merge_samples(samples), count=1000)]
+      self.assertTrue(any(name.startswith('work ') for name in names))
+      stacks = collapsed_stacks(merge_samples(samples), min_seconds=0)
+      self.assertTrue(any('work (' in stack for stack in stacks))
+
+   def test_a_sample_that_cannot_be_saved_leaves_the_request(self):
+      def fail(sample):
+         raise datastore_errors.BadRequestError('too big')
+      put = ProfileSample.put
+      ProfileSample.put = fail
+      try:
+         self.assertEqual(call(ProfilerMiddleware(app), self.header(make_token())),
+            ('200 OK', 'done'))
+      finally:
+         ProfileSample.put = put
+
+   def test_large_stats_keep_the_slowest_functions(self):
+      stats = dict((('file.py', i, 'f%d' % i), (1, 1, 0.001, i / 1000.0,
+         {('file.py', i - 1, 'f%d' % (i - 1)): (1, 1, 0.001, i / 1000.0)}))
+         for i in range(2000))
+      data = pack_stats(stats, max_bytes=20000)
+      self.assertLessEqual(len(data), 20000)
+      kept = marshal.loads(data)
+      self.assertIn(('file.py', 1999, 'f1999'), kept)
+      self.assertNotIn(('file.py', 0, 'f0'), kept)
+      for function, (cc, nc, tt, ct, callers) in kept.iteritems():
+         self.assertTrue(all(caller in kept for caller in callers))
+      self.assertEqual(marshal.loads(pack_stats(kept)), kept)
+
+if __name__ == '__main__':
+   unittest.main()
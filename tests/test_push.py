@@ -0,0 +1,95 @@
+"""Tests of the push updates (py.push)."""
+
+import datetime
+import time
+import unittest
+
+from google.appengine.api import memcache
+
+from tests import StubTestCase
+from py.push import *
+
+# 10:30, 09:50 and 17:00 in Sydney
+OPEN = datetime.datetime(2015, 3, 1, 23, 30)
+BEFORE_OPEN = datetime.datetime(2015, 3, 1, 22, 50)
+AFTER_CLOSE = datetime.datetime(2015, 3, 2, 6, 0)
+
+def fill(player, stock='ABC'):
+   """Makes a fill event."""
+   return {'type': 'fill', 'player': player, 'key': 'k', 'stock': stock,
+      'order_type': 'buy', 'quantity': 10, 'price': 1.0}
+
+class BrokerTest(StubTestCase):
+
+   def check_broker(self, broker):
+      self.assertEqual(broker.latest(), 0)
+      broker.publish([fill(1), fill(2)])
+      broker.publish([fill(3)])
+      self.assertEqual(broker.latest(), 3)
+      events, latest = broker.read(1)
+      self.assertEqual(latest, 3)
+      self.assertEqual([(seq, event['player']) for (seq, event) in events], [(2, 2), (3, 3)])
+      self.assertEqual(broker.read(3), ([], 3))
+      # A subscriber ahead of the broker is told to start again
+      self.assertEqual(broker.read(4), (None, 3))
+
+   def test_local_broker(self):
+      self.check_broker(LocalBroker())
+
+   def test_memcache_broker(self):
+      self.check_broker(MemcacheBroker())
+
+   def test_memcache_broker_resyncs_after_an_eviction(self):
+      broker = MemcacheBroker()
+      broker.publish([fill(1), fill(2)])
+      memcache.delete(MemcacheBroker.PREFIX + '1')
+      self.assertEqual(broker.read(0), (None, 2))
+
+   def test_wait_returns_at_the_timeout(self):
+      broker = LocalBroker()
+      broker.publish([fill(1)])
+      started = time.time()
+      events, latest = broker.wait(0, 0.1, lambda event: event['player'] == 2)
+      self.assertGreaterEqual(time.time() - started, 0.1)
+      self.assertEqual(len(events), 1)
+
+class UpdatesTest(StubTestCase):
+
+   def setUp(self):
+      super(UpdatesTest, self).setUp()
+      set_broker(LocalBroker())
+
+   def tearDown(self):
+      set_broker(None)
+      super(UpdatesTest, self).tearDown()
+
+   def test_seconds_until_open(self):
+      self.assertEqual(seconds_until_open(OPEN), 0)
+      self.assertEqual(seconds_until_open(BEFORE_OPEN), 10 * 60)
+      self.assertEqual(seconds_until_open(AFTER_CLOSE), 17 * 60 * 60)
+
+   def test_updates_hold_only_what_the_subscriber_wants(self):
+      publish_quotes({'ABC': {'Bid': '1.00', 'Ask': '1.01', 'LastTradePriceOnly': '1.00'},
+         'XYZ': {'Bid': '2.00', 'Ask': '2.01', 'LastTradePriceOnly': '2.00'}})
+      get_broker().publish([fill(1), fill(2)])
+      updates = get_updates(0, set(['ABC']), 1, 0, OPEN)
+      self.assertEqual(updates['seq'], 3)
+      self.assertEqual(updates['quotes'].keys(), ['ABC'])
+      self.assertEqual([event['player'] for event in updates['fills']], [1])
+      self.assertEqual(updates['retry'], 0)
+
+   def test_unchanged_quotes_are_not_published(self):
+      quotes = {'ABC': {'Bid': '1.00', 'Ask': '1.01', 'LastTradePriceOnly': '1.00'}}
+      publish_quotes(quotes)
+      publish_quotes(quotes)
+      self.assertEqual(get_broker().latest(), 1)
+
+   def test_closed_market_returns_at_once_with_a_retry(self):
+      started = time.time()
+      updates = get_updates(0, set(['ABC']), 1, 25, AFTER_CLOSE)
+      self.assertLess(time.time() - started, 1)
+      self.assertEqual(updates['retry'], MAX_RETRY_SECONDS)
+      self.assertEqual(get_updates(0, set(), 1, 25, BEFORE_OPEN)['retry'], 10 * 60)
+
+if __name__ == '__main__':
+   unittest.main()
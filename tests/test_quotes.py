@@ -0,0 +1,94 @@
+"""Tests of the quote providers and cache (py.quotes)."""
+
+import os
+import tempfile
+import time
+import unittest
+
+from google.appengine.api import memcache
+
+from tests import StubTestCase
+from py.quotes import *
+
+class CountingProvider(QuoteProvider):
+   """Gives a fixed quote for every stock, counting the stocks asked for."""
+
+   def __init__(self):
+      self.asked = []
+
+   def get_quotes(self, symbols, fields=FIELDS):
+      self.asked.extend(symbols)
+      return dict((symbol, {'Bid': '1.00', 'Ask': '1.01'}) for symbol in symbols)
+
+class QuoteCacheTest(StubTestCase):
+
+   def setUp(self):
+      super(QuoteCacheTest, self).setUp()
+      self.provider = CountingProvider()
+      set_provider(self.provider)
+
+   def tearDown(self):
+      set_provider(None)
+      super(QuoteCacheTest, self).tearDown()
+
+   def test_fetches_only_what_is_missing(self):
+      cache = QuoteCache()
+      cache.set({'ABC': {'Bid': '2.00'}})
+      quotes = cache.get(['ABC', 'XYZ'])
+      self.assertEqual(quotes['ABC'], {'Bid': '2.00'})
+      self.assertEqual(quotes['XYZ'], {'Bid': '1.00', 'Ask': '1.01'})
+      self.assertEqual(self.provider.asked, ['XYZ'])
+      cache.get(['ABC', 'XYZ'])
+      self.assertEqual(self.provider.asked, ['XYZ'])
+
+   def test_local_layer_keeps_the_memcache_expiry(self):
+      cron = QuoteCache(ttl=120)
+      cron.set({'ABC': {'Bid': '2.00'}})
+      expiry = cron.local['ABC'][0]
+
+      # Another instance fills its local layer from memcache
+      time.sleep(0.01)
+      cache = QuoteCache(ttl=120)
+      self.assertEqual(cache.get(['ABC']), {'ABC': {'Bid': '2.00'}})
+      self.assertEqual(cache.local['ABC'][0], expiry)
+      self.assertEqual(self.provider.asked, [])
+
+   def test_expired_and_old_entries_are_fetched_again(self):
+      memcache.set_multi({'ABC': (time.time() - 1, {'Bid': '2.00'}), 'XYZ': {'Bid': '2.00'}},
+         key_prefix=QuoteCache.PREFIX)
+      quotes = QuoteCache().get(['ABC', 'XYZ'])
+      self.assertEqual(quotes['ABC']['Bid'], '1.00')
+      self.assertEqual(quotes['XYZ']['Bid'], '1.00')
+      self.assertEqual(sorted(self.provider.asked), ['ABC', 'XYZ'])
+
+   def test_local_layer_evicts_the_least_recently_used(self):
+      cache = QuoteCache(size=2)
+      cache.set({'ABC': {}, 'DEF': {}})
+      cache.get(['ABC'])
+      cache.set({'XYZ': {}})
+      self.assertEqual(sorted(cache.local.keys()), ['ABC', 'XYZ'])
+
+class QuoteProviderTest(unittest.TestCase):
+
+   def test_yahoo_batches_fit_the_url_limit(self):
+      provider = YahooQuoteProvider()
+      symbols = ['S%03d' % i for i in range(200)]
+      batches = provider.batches(symbols, FIELDS)
+      self.assertGreater(len(batches), 1)
+      self.assertEqual(sum(batches, []), symbols)
+      for batch in batches:
+         self.assertLessEqual(len(provider.url(batch, FIELDS)), provider.MAX_URL_LENGTH)
+
+   def test_file_provider_replays_saved_quotes(self):
+      handle, path = tempfile.mkstemp(suffix='.json')
+      os.close(handle)
+      try:
+         provider = FileQuoteProvider(path)
+         provider.save({'ABC': {'Bid': '1.00', 'Ask': '1.01', 'Other': 'x'}})
+         self.assertEqual(provider.get_quotes(['ABC', 'XYZ'], ['Bid', 'Ask']),
+            {'ABC': {'Bid': '1.00', 'Ask': '1.01'}})
+      finally:
+         os.remove(path)
+
+if __name__ == '__main__':
+   unittest.main()
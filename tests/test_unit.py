@@ -0,0 +1,126 @@
+"""Tests of the unit of work (py.unit)."""
+
+import unittest
+
+from google.appengine.ext import ndb
+
+from tests import StubTestCase
+from py.unit import *
+
+class Counter(ndb.Model):
+   value = ndb.IntegerProperty(default=0)
+
+class UnitOfWorkTest(StubTestCase):
+
+   def test_writes_straight_away_outside_a_unit(self):
+      counter = Counter(id='a', value=1)
+      mark_dirty(counter)
+      self.assertEqual(Counter.get_by_id('a', use_cache=False).value, 1)
+      mark_deleted(counter.key)
+      self.assertIsNone(Counter.get_by_id('a', use_cache=False))
+
+   def test_writes_each_entity_once_when_the_block_ends(self):
+      counter = Counter(id='a')
+      with unit_of_work() as unit:
+         for i in range(3):
+            counter.value += 1
+            mark_dirty(counter)
+         new = Counter(value=7)
+         mark_dirty(new, new)
+         self.assertIsNone(Counter.get_by_id('a', use_cache=False))
+         self.assertEqual(len(unit.dirty), 1)
+         self.assertEqual(len(unit.new), 1)
+      self.assertEqual(Counter.get_by_id('a', use_cache=False).value, 3)
+      self.assertEqual(new.key.get(use_cache=False).value, 7)
+
+   def test_discards_the_changes_of_a_failed_block(self):
+      Counter(id='a', value=1).put()
+      with self.assertRaises(RuntimeError):
+         with unit_of_work():
+            mark_dirty(Counter(id='a', value=2))
+            mark_dirty(Counter(id='b'))
+            raise RuntimeError()
+      self.assertEqual(Counter.get_by_id('a', use_cache=False).value, 1)
+      self.assertIsNone(Counter.get_by_id('b', use_cache=False))
+      self.assertIsNone(current_unit())
+
+   def test_loads_the_changed_instance(self):
+      Counter(id='a', value=1).put()
+      with unit_of_work():
+         counter = load_multi([ndb.Key(Counter, 'a')])[0]
+         counter.value = 2
+         mark_dirty(counter)
+         self.assertIs(load_multi([ndb.Key(Counter, 'a')])[0], counter)
+         mark_deleted(counter.key)
+         self.assertEqual(load_multi([ndb.Key(Counter, 'a')]), [None])
+      self.assertIsNone(Counter.get_by_id('a', use_cache=False))
+
+   def test_nested_block_joins_the_outer_unit(self):
+      with unit_of_work() as outer:
+         with unit_of_work() as inner:
+            mark_dirty(Counter(id='a'))
+         self.assertIs(inner, outer)
+         self.assertIsNone(Counter.get_by_id('a', use_cache=False))
+      self.assertIsNotNone(Counter.get_by_id('a', use_cache=False))
+
+   def test_failed_nested_block_leaves_the_outer_unit(self):
+      with unit_of_work():
+         mark_dirty(Counter(id='a'))
+         try:
+            with unit_of_work():
+               mark_dirty(Counter(id='b'))
+               raise RuntimeError()
+         except RuntimeError:
+            pass
+         self.assertIsNone(Counter.get_by_id('a', use_cache=False))
+      # The outer block decides what is written
+      self.assertIsNotNone(Counter.get_by_id('a', use_cache=False))
+      self.assertIsNotNone(Counter.get_by_id('b', use_cache=False))
+
+   def test_block_inside_a_request_does_not_write(self):
+      def app(environ, start_response):
+         with unit_of_work():
+            mark_dirty(Counter(id='a'))
+         self.assertIsNone(Counter.get_by_id('a', use_cache=False))
+         start_response('200 OK', [])
+         return ['']
+      UnitOfWorkMiddleware(app)({}, lambda status, headers, exc_info=None: None)
+      self.assertIsNotNone(Counter.get_by_id('a', use_cache=False))
+
+class UnitOfWorkMiddlewareTest(StubTestCase):
+
+   def call(self, status):
+      """Calls an app writing a Counter through the middleware.
+
+      Returns:
+         The status the middleware responded with.
+      """
+      def app(environ, start_response):
+         mark_dirty(Counter(id='a'))
+         start_response(status, [])
+         return ['']
+      response = []
+      UnitOfWorkMiddleware(app)({}, lambda status, headers, exc_info=None: response.append(status))
+      return response[0]
+
+   def test_writes_the_changes_of_a_successful_request(self):
+      self.assertEqual(self.call('200 OK'), '200 OK')
+      self.assertIsNotNone(Counter.get_by_id('a', use_cache=False))
+      self.assertIsNone(current_unit())
+
+   def test_app_that_never_starts_a_response(self):
+      def app(environ, start_response):
+         mark_dirty(Counter(id='a'))
+         return []
+      response = []
+      UnitOfWorkMiddleware(app)({}, lambda status, headers, exc_info=None: response.append(status))
+      self.assertEqual(response, [])
+      self.assertIsNone(Counter.get_by_id('a', use_cache=False))
+
+   def test_discards_the_changes_of_a_failed_request(self):
+      self.assertEqual(self.call('500 Internal Server Error'), '500 Internal Server Error')
+      self.assertIsNone(Counter.get_by_id('a', use_cache=False))
+      self.assertIsNone(current_unit())
+
+if __name__ == '__main__':
+   unittest.main()
@@ -11,6 +11,7 @@ import datetime
 from google.appengine.ext import ndb
 from google.appengine.api import urlfetch
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 
 import os
 import jinja2
@@ -21,6 +22,17 @@ import datetime
 from py.transaction import *
 from py.player import *
 from py.depth import *
+from py.book import *
+from py.quotes import *
+from py.position import *
+from py.leaderboard import *
+from py.execution import *
+from py.history import *
+from py.intraday import *
+from py.push import *
+from py.unit import *
+from py.metrics import *
+from py.profiler import *
 
 JINJA_ENVIRONMENT = jinja2.Environment(
    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
@@ -144,24 +156,45 @@ class OrderHandler(UserHandler):
          self.put()
 
    def post(self):
-      """Creates a new Transaction from an order.
+      """Places orders for the current player.
 
-      The request body contains the information for creating the Transaction.
+      The request body contains either a list of 'orders' or a single JSON
+      encoded 'order'. Every order is validated against the player's cash
+      and sellable shares, and the valid ones are placed together (see
+      Player.place_orders).
+
+      Returns:
+         A list of 'results', one per order: whether it was placed, and its
+         'key' or the 'error' it was rejected with. The status is 400 if no
+         order was placed.
       """
       # Load the transaction data from the request body into a dictionary.
       data = json.loads(self.request.body)
-      if ('order' in data):
-         order = json.loads(data['order'])
-         if (order and Transaction.is_valid(order)):
-            player = Player.query(Player.email==order['email']).get()
-            order['cashHistory'] = 0;
-            transaction = Transaction.new(order)
-            player.add_transaction(transaction)
-            transaction.cashHistory = player.cash;
-            transaction.put();
+      if ('orders' in data):
+         orders = data['orders']
+      elif ('order' in data):
+         orders = [json.loads(data['order'])]
+      else:
+         orders = None
+      cur_user = self.user_model
+      if (not cur_user):
+         self.response.set_status(401)
+         return
+      if (not isinstance(orders, list) or not orders or len(orders) > Player.MAX_ORDERS):
+         # Data is invalid.
+         self.response.set_status(400)
+         return
+
+      results = []
+      for transaction, error in cur_user.place_orders(orders):
+         if transaction is not None:
+            results.append({'success': True, 'key': transaction.key.urlsafe()})
          else:
-            # Data is invalid.
-            self.response.set_status(400)
+            results.append({'success': False, 'error': error})
+      if not any(result['success'] for result in results):
+         self.response.set_status(400)
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.write(json.dumps({'results': results}))
 
    def delete(self):
       """Cancels a transaction corresponding to the transaction key parsed in
@@ -179,7 +212,7 @@ class OrderHandler(UserHandler):
                # Delete the transaction from the user's records as well
                # as from transaction records
                cur_user.delete_transaction(transaction_key)
-               Transaction.delete(transaction_key)
+               MARKET.remove(transaction_key)
                self.response.set_status(200)
             except ValueError, AttributeError:
                # Invalid key
@@ -191,6 +224,9 @@ class OrderHandler(UserHandler):
       """Compares the current bid/ask of the corresponding stock to all pending
          orders and executes if the normal order execution conditions are
          satisfied.
+
+      The quotes are fetched once here and the execution itself is fanned out
+      to one task per shard of stocks (see ExecutionHandler).
       """
       # We only want to trade on weekdays, so return if Saturday or Sunday
       # For speed when daylight savings occurs does not need to be considered
@@ -203,125 +239,28 @@ class OrderHandler(UserHandler):
 
       # Cache latest share data
       share_dict = self.get_share_data()
-      memcache.set('share_data', share_dict)
-
-      # Creates a ndb query to get the stocks that are not executed, sorted
-      # in order of stock code.
-      order_stocks = Transaction.query(projection=["stock"], distinct=True).filter(Transaction.executed == False).order(Transaction.stock)
-      for order_stock in order_stocks:
-         # For each stock code get the bid and ask
-         bid = float(share_dict[str(order_stock.stock)]['Bid'])
-         ask = float(share_dict[str(order_stock.stock)]['Ask'])
-         last_price = float(share_dict[str(order_stock.stock)]['LastTradePriceOnly'])
-
-         # Get all the pending orders of that stock code
-         pending_orders = Transaction.query(ndb.AND(Transaction.executed == False, Transaction.stock == order_stock.stock))
-         for order in pending_orders:
-            if (order.subtype == 'market'):
-               # If the order is a market transaction, it executes at current bid/ask and
-               # A) refunds/charges the difference in money for a buy
-               # B) updates cash for a sell
-               player = Player.query(Player.transactions == order.key).get()
-               if (order.type == 'buy'):
-                  # Refunds money if order.price >= ask, otherwise charges extra if
-                  # order.price <= ask. Order will not be executed if it puts the player in debt
-                  difference = order.price - ask
-                  if (player.cash + difference >= 0):
-                     order.price = ask
-                     player.update_cash(difference, order)
-                     order.timestamp = datetime.datetime.now()
-                     order.executed = True
-                     order.put()
-               elif (order.type == 'sell'):
-                  # Sells at the bid and updates the cash based off that price
-                  order.price = bid
-                  player.update_cash(order.price, order)
-                  order.timestamp = datetime.datetime.now()
-                  order.executed = True
-                  order.put()
-            elif (order.subtype == 'limit') and \
-               ((order.type == 'buy' and order.price >= ask) or (order.type == 'sell' and order.price <= bid)):
-               # If the order is a limit transaction it will get executed only
-               # when certain conditions are met.
-               player = Player.query(Player.transactions == order.key).get()
-               if (order.type == 'buy' and order.price >= ask):
-                  # The order will get executed at the lowest ask
-                  # and you will be refunded the difference
-                  difference = order.price - ask
-                  order.price = ask
-                  player.update_cash(difference, order)
-               if (order.type == 'sell' and order.price <= bid):
-                  # The order will get executed at the largest bid
-                  # and your cash will get updated accordingly
-                  order.price = bid
-                  player.update_cash(order.price, order)
-               order.timestamp = datetime.datetime.now()
-               order.executed = True
-               order.put()
-            elif (order.subtype == 'stop') and \
-               ((order.type == 'buy' and last_price >= order.price) or (order.type == 'sell' and last_price <= order.price)):
-               # A stop buy order is executed when the price goes above your price
-               # You only need to execute the order
-               # A stop sell order is executed when the price goes below your price
-               # You want to update the cash and execute the order
-               if (order.type == 'sell' and last_price <= order.price):
-                  player = Player.query(Player.transactions == order.key).get()
-                  player.update_cash(order.price, order)
-               order.timestamp = datetime.datetime.now()
-               order.executed = True
-               order.put()
+      QUOTES.set(share_dict)
+      # Keep the snapshot as this minute's intraday bars
+      BARS.record(share_dict)
+      # Push the quotes that have changed to subscribed pages
+      publish_quotes(share_dict)
 
-   def get_share_data(self):
-      """Places the most recent Bid, Ask and LastTradePriceOnly in the Cache
-         to speed up the website.
-      """
-      # Open the list of 200 shares
-      with open('app/static/codes200A.json') as share_data_list:
-         share_list = json.load(share_data_list)
-
-      # Grab the first hundred shares and second hundred shares separately
-      # in order to take into account the maximum length of urls
-      share_dict_1 = {}
-      share_dict_2 = {}
-      i = 0
-      for share in share_list:
-         # Handle max length of url
-         if i < 100:
-            share_dict_1[str(share['code'])] = 0
-         if i >= 100:
-            share_dict_2[str(share['code'])] = 0
-         i+=1
-
-      data_1 = self.grab_yahoo_data(share_dict_1)
-      data_2 = self.grab_yahoo_data(share_dict_2)
-
-      # Merge the two dicts into share_dict
-      share_dict = {}
-      i = 0
-      for share in share_dict_1.keys():
-         share_dict[str(share)] = data_1['query']['results']['quote'][i]
-         i += 1
-      i = 0
-      for share in share_dict_2.keys():
-         share_dict[str(share)] = data_2['query']['results']['quote'][i]
-         i += 1
-
-      return share_dict
-
-   def grab_yahoo_data(self, share_dict):
-      """Gets the LastTradePriceOnly for a dictionary of stocks from the Yahoo
-         Finance API.
+      # Execute every stock with pending orders in parallel tasks, against
+      # the same quotes
+      MARKET.sync()
+      run = ExecutionRun.start(share_dict, MARKET.books.keys())
 
-      Args:
-         share_dict: A dictionary of shares to fetch data for.
+      # Refresh the market depth of every stock at the new prices
+      taskqueue.add(url='/tasks/depth', params={'run': run.key.id()})
+
+   def get_share_data(self):
+      """Gets the most recent Bid, Ask and LastTradePriceOnly for every stock in
+         the market from the configured quote provider.
 
       Returns:
-         A JSON object with the price data for each stock in the dictionary.
+         A dictionary mapping stock codes to their quote data.
       """
-      yahoo_url = "https://query.yahooapis.com/v1/public/yql?q=select%20Ask%2C%20Bid%2C%20LastTradePriceOnly%20from%20yahoo.finance.quotes%20where%20symbol%20IN%20(" + ",%20".join('"' + key + '"' for key in share_dict.keys()) + ")%20&format=json&diagnostics=false&env=store%3A%2F%2Fdatatables.org%2Falltableswithkeys&callback="
-      response = urlfetch.fetch(yahoo_url)
-      data = json.loads(response.content)
-      return data
+      return get_provider().get_quotes(get_symbols())
 
 class StatusHandler(UserHandler):
    """Handles all requests for game information relating to a Player."""
@@ -346,6 +285,9 @@ class StatusHandler(UserHandler):
       parameters['codes'] = self.request.get('codes')
       parameters['leaderboard'] = self.request.get('leaderboard')
 
+      # Count the requests for each piece of information separately
+      tag_request(*sorted(name for (name, value) in parameters.iteritems() if value))
+
       cur_user = self.user_model
       if cur_user:
          user_info = {}
@@ -366,19 +308,320 @@ class StatusHandler(UserHandler):
                user_info['share'] = cur_user.get_total_shares_value(shares)
          if parameters['sellable_shares']:
             user_info['sellable_shares'] = cur_user.get_sellable_shares()
-         if parameters['history']:
+         if parameters['history'] and self.request.get('page_size'):
+            # A page of the history, oldest first, optionally within a range of
+            # (Sydney) dates 'start' to 'end' inclusive
+            try:
+               page_size = min(max(int(self.request.get('page_size')), 1), 200)
+               start = self.parse_date(self.request.get('start'))
+               end = self.parse_date(self.request.get('end'))
+               user_info['history'], user_info['history_cursor'] = cur_user.get_history_page(
+                  self.request.get('cursor') or None, page_size, start,
+                  end + timedelta(days=1) if end else None)
+            except ValueError:
+               self.response.set_status(400)
+               return
+         elif parameters['history']:
             user_info['history'] = cur_user.get_transactions(executed=True)
          if parameters['birthday']:
             user_info['birthday'] = str(cur_user.birthday)[0:10]
          if parameters['codes']:
             user_info['codes'] = cur_user.get_stock_code_and_dates()
          if parameters['leaderboard']:
-            user_info['leaderboard'] = Player.get_leaderboard();
+            # Served from the latest snapshot, a page at a time
+            try:
+               offset = max(int(self.request.get('offset') or 0), 0)
+               limit = min(max(int(self.request.get('limit') or 100), 1), 500)
+            except ValueError:
+               self.response.set_status(400)
+               return
+            snapshot = LeaderboardSnapshot.current()
+            if snapshot is None:
+               # The first snapshot is still being built
+               user_info['leaderboard'] = {}
+               user_info['leaderboard_rank'] = None
+               user_info['leaderboard_count'] = 0
+               user_info['leaderboard_pending'] = True
+            else:
+               user_info['leaderboard'] = dict((row[0], row[1:])
+                  for row in snapshot.page(offset, limit))
+               my_row = snapshot.rank_of(cur_user.email)
+               user_info['leaderboard_rank'] = my_row[1:] if my_row else None
+               user_info['leaderboard_count'] = snapshot.count
 
          self.response.write(json.dumps(user_info))
       else:
          self.response.set_status(404)
 
+   def parse_date(self, date):
+      """Converts a Sydney date (YYYY-MM-DD) to the UTC datetime it starts at.
+
+      Raises:
+         ValueError: if the date is not valid.
+      """
+      if not date:
+         return None
+      return datetime.datetime.strptime(date, '%Y-%m-%d') - timedelta(hours=11)
+
+class ExecutionHandler(webapp2.RequestHandler):
+   """Executes one shard of stocks for an execution run (run as a task)."""
+   def post(self):
+      execute_shard(int(self.request.get('run')), int(self.request.get('shard')),
+         self.request.get('stocks').split(','))
+
+class ExecutionRunHandler(webapp2.RequestHandler):
+   """Admin view of the timing of recent execution runs."""
+   def get(self):
+      limit = int(self.request.get('limit') or 10)
+      runs = ExecutionRun.query().order(-ExecutionRun.started).fetch(limit)
+      self.response.write(json.dumps(dict((run.key.id(), run.summary()) for run in runs)))
+
+class MetricsHandler(webapp2.RequestHandler):
+   """Admin view of the request metrics of every running instance."""
+   def get(self):
+      """Gets the merged metrics (see Metrics.collect)."""
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.write(json.dumps(METRICS.collect(), sort_keys=True))
+
+class ProfileHandler(webapp2.RequestHandler):
+   """Admin reports of the profiles of sampled requests."""
+   def get(self):
+      """Merges the most recent samples (up to 'limit') of 'route' (e.g.
+         StatusHandler.get) and 'tag' (e.g. leaderboard) if given.
+
+      With 'token', returns an X-Profile header value instead, which has the
+      requests that send it profiled for the next hour.
+
+      Returns:
+         With 'format' collapsed, collapsed stacks for flame graph tools as
+         text. Otherwise the number of samples merged and the 'top'
+         functions (30 by default) by 'sort' (tottime or cumtime).
+      """
+      if self.request.get('token'):
+         token = make_token()
+         if token is None:
+            self.response.set_status(404)
+            return
+         self.response.headers['Content-Type'] = 'application/json'
+         self.response.write(json.dumps({'header': HEADER, 'token': token}))
+         return
+
+      samples = ProfileSample.recent(self.request.get('route'), self.request.get('tag'),
+         min(int(self.request.get('limit') or 50), 500))
+      stats = merge_samples(samples)
+      if self.request.get('format') == 'collapsed':
+         self.response.headers['Content-Type'] = 'text/plain'
+         self.response.write('\n'.join(collapsed_stacks(stats) if stats else []))
+         return
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.write(json.dumps({
+         'samples': len(samples),
+         'seconds': sum(sample.seconds or 0 for sample in samples),
+         'top': top_functions(stats, int(self.request.get('top') or 30),
+            self.request.get('sort') or 'tottime') if stats else [],
+      }))
+
+class DepthRefreshHandler(webapp2.RequestHandler):
+   """Refreshes the depth of every stock from an execution run's quotes (run
+      as a task after each quote snapshot).
+   """
+   def post(self):
+      run = ExecutionRun.get_by_id(int(self.request.get('run')))
+      if run:
+         Depth.refresh(run.get_quotes())
+
+class LeaderboardHandler(webapp2.RequestHandler):
+   """Rebuilds the leaderboard snapshot (run as a task after each execution
+      run).
+   """
+   def post(self):
+      LeaderboardSnapshot.build()
+
+class PositionHandler(webapp2.RequestHandler):
+   """Admin tool to verify (and optionally rebuild) the Position ledger
+      against a replay of each player's transactions.
+   """
+   def get(self):
+      """Verifies one player, or a page of players.
+
+      Takes the parameters 'email' (a single player), 'cursor' and 'limit'
+      (to page through every player) and 'rebuild' (to replace the positions
+      of any player whose ledger disagrees with their history).
+
+      Returns:
+         A dictionary mapping the email of each player with differences to
+         the stored and replayed values for each differing stock, plus the
+         cursor for the next page.
+      """
+      email = self.request.get('email')
+      rebuild = self.request.get('rebuild')
+      if email:
+         players = Player.query(Player.email == email).fetch(1)
+         cursor = None
+      else:
+         limit = int(self.request.get('limit') or 50)
+         start = ndb.Cursor(urlsafe=self.request.get('cursor')) if self.request.get('cursor') else None
+         players, cursor, more = Player.query().fetch_page(limit, start_cursor=start)
+         if not more:
+            cursor = None
+
+      report = {}
+      for player in players:
+         differences = player.verify_positions()
+         if differences:
+            report[player.email] = dict((stock, {
+               'stored': stored.to_dict() if stored else None,
+               'replayed': replayed.to_dict() if replayed else None
+            }) for (stock, (stored, replayed)) in differences.iteritems())
+            if rebuild:
+               player.rebuild_positions()
+      self.response.write(json.dumps({
+         'differences': report,
+         'cursor': cursor.urlsafe() if cursor else None
+      }))
+
+class MigrationHandler(webapp2.RequestHandler):
+   """Admin tool to move the transaction keys still listed on players out of
+      the player entities (see Player.migrate_transactions).
+   """
+   def get(self):
+      """Migrates a page of players.
+
+      Takes the parameters 'cursor' and 'limit' to page through every player.
+
+      Returns:
+         The number of players and transactions migrated, plus the cursor for
+         the next page.
+      """
+      limit = int(self.request.get('limit') or 50)
+      start = ndb.Cursor(urlsafe=self.request.get('cursor')) if self.request.get('cursor') else None
+      players, cursor, more = Player.query().fetch_page(limit, start_cursor=start)
+      migrated = [len(player.migrate_transactions()) for player in players
+         if player.transactions]
+      self.response.write(json.dumps({
+         'players': len(migrated),
+         'transactions': sum(migrated),
+         'cursor': cursor.urlsafe() if cursor and more else None
+      }))
+
+class PortfolioHandler(UserHandler):
+   """Serves the daily value series of the current player's portfolio."""
+   def get(self):
+      """Gets the player's portfolio value series (see value_series)."""
+      cur_user = self.user_model
+      if cur_user:
+         self.response.headers['Content-Type'] = 'application/json'
+         self.response.write(json.dumps(value_series(cur_user)))
+      else:
+         self.response.set_status(404)
+
+class IntradayHandler(webapp2.RequestHandler):
+   """Serves the one minute bars of a stock recorded from the cron's quotes."""
+   def get(self):
+      """Gets the bars of 'symbol' for 'date' (YYYY-MM-DD, by default the
+         current trading day in Sydney).
+
+      Returns:
+         The bars as columns (time, open, high, low, close and spread).
+      """
+      symbol = self.request.get('symbol')
+      try:
+         day = (parse_date(self.request.get('date')) if self.request.get('date')
+            else (datetime.datetime.utcnow() + SYDNEY_OFFSET).date())
+      except ValueError:
+         day = None
+      if (not symbol or day is None):
+         self.response.set_status(400)
+         return
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.write(json.dumps(BARS.get(symbol, day)))
+
+class HistoryHandler(webapp2.RequestHandler):
+   """Serves the daily price history of stocks from the price store."""
+
+   # The most stocks that can be asked for at once
+   MAX_SYMBOLS = 50
+
+   # The most stocks whose missing history is fetched from the source per
+   # request, so that no request starts a large number of remote fetches
+   MAX_FETCH = 10
+
+   # Symbols charted besides the stocks in the market
+   INDICES = ['ASX.AX']
+
+   def get(self):
+      """Gets the history of the stocks in 'symbols' (comma separated) from
+         'start' to 'end' (YYYY-MM-DD, by default the last year).
+
+      Only the stocks in the market (and its index) can be asked for. The
+      history of a stock beyond the first MAX_FETCH missing any may be
+      incomplete until a later request, so such a response is not cached.
+
+      Returns:
+         A dictionary mapping each stock code to its history as columns
+         (date, open, high, low, close and volume), in date order.
+      """
+      symbols = [symbol for symbol in self.request.get('symbols').split(',') if symbol]
+      known = set(get_symbols()).union(self.INDICES)
+      if not all(symbol in known for symbol in symbols):
+         self.response.set_status(400)
+         return
+      try:
+         end = parse_date(self.request.get('end')) if self.request.get('end') else datetime.date.today()
+         start = parse_date(self.request.get('start')) if self.request.get('start') else end - timedelta(days=365)
+      except ValueError:
+         start = None
+      if (not symbols or len(symbols) > self.MAX_SYMBOLS or start is None or start > end):
+         self.response.set_status(400)
+         return
+
+      history, unloaded = PRICES.load(symbols, start, end, self.MAX_FETCH)
+      self.response.headers['Content-Type'] = 'application/json'
+      if not unloaded:
+         self.response.headers['Cache-Control'] = 'public, max-age=3600'
+      self.response.write(json.dumps(dict((symbol, series.to_dict())
+         for (symbol, series) in history.iteritems())))
+
+class UpdatesHandler(UserHandler):
+   """Long-polls for quote changes and the current player's fills, so that
+      pages are updated as the cron runs without polling for quotes or status.
+   """
+
+   # The most stocks that can be subscribed to at once
+   MAX_SYMBOLS = 50
+
+   # Seconds to wait for an update (within the request deadline)
+   TIMEOUT = 25
+
+   def get(self):
+      """Waits for updates after sequence number 'since' to the quotes of the
+         stocks in 'symbols' (comma separated) or the player's fills.
+
+      Without 'since', returns the current sequence number straight away for
+      the page to subscribe from once it has loaded its data.
+
+      Returns:
+         The updates (see get_updates).
+      """
+      symbols = set(symbol for symbol in self.request.get('symbols').split(',') if symbol)
+      try:
+         since = int(self.request.get('since')) if self.request.get('since') else None
+      except ValueError:
+         since = -1
+      if ((since is not None and since < 0) or len(symbols) > self.MAX_SYMBOLS):
+         self.response.set_status(400)
+         return
+
+      cur_user = self.user_model
+      player_id = cur_user.key.id() if cur_user else None
+      if since is None:
+         updates = {'seq': get_broker().latest(), 'quotes': {}, 'fills': []}
+      else:
+         updates = get_updates(since, symbols, player_id, self.TIMEOUT)
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.headers['Cache-Control'] = 'no-cache'
+      self.response.write(json.dumps(updates))
+
 class DepthHandler(webapp2.RequestHandler):
    """Handles requests relating to the market depth of stocks."""
    def post(self):
@@ -394,11 +637,12 @@ class DepthHandler(webapp2.RequestHandler):
          and request['min_ask'] > 0
          and request['avg_volume'] > 0):
 
-         # Generate the market depth
-         depth = Depth.get(request)
+         # Read the market depth (generating it if the cron has not)
+         depth = DEPTHS.get(request)
+         # Flat lists of [price in cents, volume, ...], best price first
          depth_data = {
-            'bids' : depth.bids,
-            'asks' : depth.asks
+            'bids' : depth.bid_levels.flat(),
+            'asks' : depth.ask_levels.flat()
          }
          # Write the depth to the page
          self.response.write(json.dumps(depth_data))
@@ -415,10 +659,28 @@ config['webapp2_extras.auth'] = {
    'user_model': Player,
 }
 
-app = webapp2.WSGIApplication([
+application = webapp2.WSGIApplication([
    ('/account', AccountHandler),
    ('/order', OrderHandler),
    ('/depth', DepthHandler),
+   ('/history', HistoryHandler),
+   ('/intraday', IntradayHandler),
+   ('/portfolio', PortfolioHandler),
+   ('/updates', UpdatesHandler),
    ('/user', StatusHandler),
+   ('/admin/positions', PositionHandler),
+   ('/admin/migrate', MigrationHandler),
+   ('/tasks/leaderboard', LeaderboardHandler),
+   ('/tasks/execute', ExecutionHandler),
+   ('/tasks/depth', DepthRefreshHandler),
+   ('/admin/runs', ExecutionRunHandler),
+   ('/admin/metrics', MetricsHandler),
+   ('/admin/profile', ProfileHandler),
    (r'/.*', MainPage)
 ], config=config, debug=True)
+
+# Every request writes the entities it changed once, when it completes, and
+# is measured including that write
+install_hooks()
+app = MetricsMiddleware(ProfilerMiddleware(UnitOfWorkMiddleware(application)),
+   application.router)